@@ -0,0 +1,134 @@
+import contextvars
+import os
+from contextlib import contextmanager
+
+import pandas as pd
+import pyarrow
+
+try:
+    import polars
+except ImportError:  # 没装 polars 时不提供该后端
+    polars = None
+
+try:
+    import duckdb
+except ImportError:  # 没装 duckdb 时不提供该后端
+    duckdb = None
+
+# ==============================
+# 可插拔的计算后端：聚合表的“按键分组求和”
+# ==============================
+#
+# 明细只在 aggregate_report 中扫描一次（numpy bincount），之后所有 compute_* 和多周合并
+# 都是在聚合表上“按键分组、金额列求和”。一个季度的合并要把几十份周聚合表拼起来重新分组，
+# 有几百万行，这一步可以交给多线程的列式引擎：
+#   - pandas：默认，单线程；
+#   - polars：lazy frame 的 group_by，自动使用全部 CPU 核；
+#   - duckdb：进程内 SQL 的 GROUP BY，自动使用全部 CPU 核。
+# 只有分组求和这一步可换后端：aggregate_report 对明细行的扫描始终是 numpy，其余的筛选、合并、
+# 排序也仍是 pandas。输入、输出都是 pandas DataFrame，每次调用都要先把表转成 polars / Arrow，
+# 表小时这部分开销可能超过多线程省下的时间，大表（多周合并）才划算。
+# 金额是 int64 戈比，整数求和与后端、线程数无关，输出的列类型也还原成与输入相同，
+# 因此各结果表与 pandas 完全一致（tests/test_backends.py，更大的数据量见 benchmarks/backend_parity.py）。
+# 行的顺序不保证，调用方需要时自行排序。
+#
+# 选择后端：环境变量 WB_COMPUTE_BACKEND（默认 pandas），或在一段代码内 with use_backend("polars"):。
+# 本模块不依赖 streamlit。
+
+DEFAULT_BACKEND = os.environ.get("WB_COMPUTE_BACKEND", "pandas")
+
+
+def _restore_dtypes(out: pd.DataFrame, like: pd.DataFrame, columns) -> pd.DataFrame:
+    """列式引擎返回的列类型（object 文本、Int64 等）还原成输入表的类型。"""
+    return out[columns].astype(like.dtypes[columns].to_dict()).reset_index(drop=True)
+
+
+class PandasBackend:
+    name = "pandas"
+
+    def group_sum(self, tables, keys, columns) -> pd.DataFrame:
+        """tables 拼接后按 keys 分组（缺失值单独成组）、columns 求和，返回 keys + columns。"""
+        tables = list(tables)
+        table = tables[0] if len(tables) == 1 else pd.concat(tables, ignore_index=True)
+        return (
+            table[[*keys, *columns]]
+            .groupby(keys, dropna=False, sort=False)
+            .sum()
+            .reset_index()
+        )
+
+
+class PolarsBackend:
+    name = "polars"
+
+    def group_sum(self, tables, keys, columns) -> pd.DataFrame:
+        tables = list(tables)
+        frame = polars.concat([polars.from_pandas(t[[*keys, *columns]]) for t in tables], how="vertical_relaxed")
+        out = (
+            frame.lazy()
+            .group_by(keys)
+            .agg([polars.col(c).sum() for c in columns])
+            .collect()
+            .to_pandas()
+        )
+        return _restore_dtypes(out, tables[0], [*keys, *columns])
+
+
+class DuckDBBackend:
+    name = "duckdb"
+
+    def group_sum(self, tables, keys, columns) -> pd.DataFrame:
+        tables = list(tables)
+        # 先拼成一张 Arrow 表再交给 duckdb：直接扫描 pandas 的文本列要慢好几倍
+        arrow = pyarrow.concat_tables(
+            [pyarrow.Table.from_pandas(t[[*keys, *columns]], preserve_index=False) for t in tables]
+        )
+        key_sql = ", ".join(f'"{k}"' for k in keys)
+        sum_sql = ", ".join(f'SUM("{c}")::BIGINT AS "{c}"' for c in columns)
+        with duckdb.connect() as con:
+            con.register("agg", arrow)
+            result = con.execute(f"SELECT {key_sql}, {sum_sql} FROM agg GROUP BY {key_sql}")
+            out = result.to_arrow_table() if hasattr(result, "to_arrow_table") else result.fetch_arrow_table()
+        return _restore_dtypes(out.to_pandas(), tables[0], [*keys, *columns])
+
+
+BACKENDS = {
+    "pandas": PandasBackend,
+    "polars": PolarsBackend,
+    "duckdb": DuckDBBackend,
+}
+_BACKEND_MODULES = {"pandas": pd, "polars": polars, "duckdb": duckdb}
+
+_current = contextvars.ContextVar("compute_backend", default=None)
+
+
+def available_backends() -> list:
+    """当前环境中可用的后端（对应的库已安装）。"""
+    return [name for name in BACKENDS if _BACKEND_MODULES[name] is not None]
+
+
+def get_backend(name: str = None):
+    """name 为 None 时返回当前生效的后端（use_backend 设置的，否则为 DEFAULT_BACKEND）。"""
+    if name is None:
+        current = _current.get()
+        if current is not None:
+            return current
+        name = DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"未知的计算后端：{name}（可选：{', '.join(BACKENDS)}）")
+    if _BACKEND_MODULES[name] is None:
+        raise ValueError(f"计算后端 {name} 不可用：没有安装 {name}（pip install {name}）")
+    return BACKENDS[name]()
+
+
+@contextmanager
+def use_backend(name: str = None):
+    """在 with 块内（当前线程 / 协程）使用指定的后端；name 为 None 时不改变。"""
+    if name is None:
+        yield get_backend()
+        return
+    token = _current.set(get_backend(name))
+    try:
+        yield _current.get()
+    finally:
+        _current.reset(token)
@@ -0,0 +1,267 @@
+import argparse
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from backends import BACKENDS, use_backend
+from cost_catalog import CostCatalog, week_as_of
+from dedup import NOTE_NO_ROW_ID, DuplicateLog
+from pipeline import (
+    BUNDLE_FORMATS,
+    PARSED_REPORT_FORMAT,
+    catalog_fallback_skus,
+    load_week_aggregates,
+    run_pipeline,
+)
+from profiling import StageProfiler
+from report_cache import ReportCache
+from rollup_store import RollupStore
+from trends import TrendStore, detect_anomalies, trend_week
+
+# ==============================
+# 命令行批处理：多个卖家账号并行跑整条流水线（不依赖 streamlit）
+# ==============================
+#
+# 每个账号一个目录，目录下的 .xlsx 都视为该账号的 WB 报表；
+# 目录中名为 --cost-name 的文件（默认 cost.xlsx）作为该账号的采购成本表，
+# 没有时使用 --cost 指定的公共成本表，都没有则采购成本按 0 计算。
+# 加 --cost-catalog 时使用本地采购成本库（cost_catalog.py）：上面找到的成本文件先导入成本库
+# （同一文件只导入一次，--cost-effective 指定生效日期）；成本文件中有的 SKU 直接用文件中的成本，
+# 文件中没有的 SKU 按周标签中的日期从成本库查询（输出中列出这些 SKU）。
+# 输出：<out>/<账号目录名>/<label>_summary.xlsx，与网页下载的内容一致；
+# 加 --bundle parquet/csv 时另外输出 <label>_<格式>.zip 数据包，
+# 加 --profile 时输出 <label>_profile.json（各阶段耗时、行数、内存）。
+# 全年的报表加 --out-of-core：逐份累加部分和、必要时溢出到磁盘（out_of_core.py），内存占用有上限。
+# --backend polars/duckdb 时多周合并和按 SKU 的分组求和交给多线程列式引擎（需另外安装，见 backends.py）。
+# 加 --trends DIR 时，目录中的报表都在同一周内（按文件名中的期间，见 trends.trend_week）则本周结果
+# 存入 DIR/<账号目录名> 的周趋势库（trends.py），并输出 <label>_anomalies.csv：
+# 利润率 / 取消率与此前几周相比变化剧烈的 SKU。
+# 同一份报表重复放入、或月报与周报相互覆盖时，重复的文件和重叠的行在汇总前去掉（dedup.py），输出中列出每份报表删除的行数。
+#
+#   python batch.py accounts/* --out output --label 20251103-1109 --workers 8
+
+
+class StageTimer:
+    """记录每个阶段的耗时（秒），按执行顺序保存。"""
+
+    def __init__(self):
+        self.timings = {}
+
+    def run(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.timings[name] = time.perf_counter() - start
+        return result
+
+
+def find_account_files(account_dir: Path, cost_name: str):
+    """返回 (报表文件列表, 账号自带的成本文件或 None)。"""
+    reports = []
+    cost_path = None
+    for p in sorted(account_dir.glob("*.xlsx")):
+        if p.name.startswith("~$"):  # Excel 打开时留下的锁文件
+            continue
+        if p.name == cost_name:
+            cost_path = p
+        else:
+            reports.append(p)
+    return reports, cost_path
+
+
+def run_account(account_dir, out_dir, week_label, cost_path=None, cost_name="cost.xlsx", use_cache=True,
+                bundle_format=None, profile=False, cost_catalog=None, cost_effective=None, backend=None,
+                out_of_core=False, spill_dir=None, trends_dir=None) -> dict:
+    """跑完一个账号的完整流水线并写出 summary.xlsx，返回各阶段耗时等信息。"""
+    account_dir = Path(account_dir)
+    timer = StageTimer()
+    profiler = StageProfiler(enabled=profile)
+
+    reports, own_cost = find_account_files(account_dir, cost_name)
+    if not reports:
+        raise ValueError(f"{account_dir} 下没有找到 .xlsx 报表")
+    cost_path = own_cost or cost_path
+
+    cache = ReportCache(namespace=PARSED_REPORT_FORMAT) if use_cache else None
+    store = RollupStore() if use_cache else _MemoryRollupStore()
+
+    # 多周合并和按 SKU 的分组求和使用 backend 指定的计算后端（backends.py）
+    duplicates = DuplicateLog()
+    with use_backend(backend):
+        agg, reused, processed = timer.run(
+            "load_reports", load_week_aggregates, reports, store, cache=cache, profiler=profiler,
+            out_of_core=out_of_core, spill_dir=spill_dir, duplicates=duplicates,
+        )
+
+        catalog = None
+        if cost_catalog is not None:
+            catalog = CostCatalog(cost_catalog)
+            if cost_path is not None:
+                timer.run("import_cost", catalog.import_file, cost_path, cost_effective)
+
+        # 采购成本读取、步骤1～8 和导出按阶段图执行，每个阶段只执行一次
+        results, stage_timings = run_pipeline(
+            inputs={
+                "agg": agg,
+                "cost_file": cost_path,
+                "cost_catalog": catalog,
+                "cost_as_of": week_as_of(week_label),
+                "week_label": week_label,
+                "bundle_format": bundle_format,
+            },
+            runner=profiler.wrap_runner(),
+        )
+    for t in stage_timings:
+        timer.timings[t["stage"]] = t["seconds"]
+    excel_bytes = results["summary_excel"]
+
+    out_path = Path(out_dir) / account_dir.name / f"{week_label}_summary.xlsx"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    timer.run("write_output", out_path.write_bytes, excel_bytes)
+    if results["data_bundle"] is not None:
+        bundle_path = out_path.with_name(f"{week_label}_{bundle_format}.zip")
+        timer.run("write_bundle", bundle_path.write_bytes, results["data_bundle"])
+    if profile:
+        profile_path = out_path.with_name(f"{week_label}_profile.json")
+        profile_path.write_text(
+            profiler.to_json(account=account_dir.name, week_label=week_label), encoding="utf-8",
+        )
+
+    anomalies = None
+    # 周趋势按报表文件名中的期间归到某一周（trends.trend_week），跨周的目录不计入
+    trend_label = trend_week([p.name for p in reports]) if trends_dir is not None else None
+    if trend_label is not None:
+        trends = TrendStore(Path(trends_dir) / account_dir.name)
+        if timer.run("record_trends", trends.record, trend_label, results["profit_by_sku"],
+                     results["cancellation_rate_by_sku"], results["fee_summary"]):
+            found = timer.run("detect_anomalies", lambda: detect_anomalies(trends.matrix(), week=trend_label))
+            found.to_csv(out_path.with_name(f"{week_label}_anomalies.csv"), index=False, encoding="utf-8-sig")
+            anomalies = len(found)
+
+    return {
+        "account": account_dir.name,
+        "output": str(out_path),
+        "files": len(reports),
+        "reused": reused,
+        "processed": processed,
+        "rows": agg.total_rows,
+        "removed_rows": duplicates.removed_rows,
+        "duplicates": [e for e in duplicates.entries if e["说明"] not in ("", NOTE_NO_ROW_ID)],
+        "anomalies": anomalies,
+        "cost_from_catalog": catalog_fallback_skus(results["cost_df"]),
+        "timings": timer.timings,
+    }
+
+
+class _MemoryRollupStore:
+    """--no-cache 时使用：接口与 RollupStore 相同，但不落盘。"""
+
+    def __init__(self):
+        self._tables = {}
+        self._meta = {}
+
+    def has(self, key):
+        return key in self._tables
+
+    def get(self, key):
+        return self._tables.get(key)
+
+    def put(self, key, table, **meta):
+        self._tables[key] = table
+        self._meta[key] = meta
+
+    def describe(self, key):
+        return self._meta.get(key, {})
+
+
+def _run_account_safe(*args, **kwargs) -> dict:
+    try:
+        return run_account(*args, **kwargs)
+    except Exception as e:
+        return {"account": Path(args[0]).name, "error": f"{e}\n{traceback.format_exc()}"}
+
+
+def format_timings(result: dict) -> str:
+    timings = result["timings"]
+    total = sum(timings.values())
+    lines = [
+        f"[{result['account']}] {result['files']} 份报表（复用 {result['reused']}，新处理 {result['processed']}），"
+        f"{result['rows']} 行，总耗时 {total:.2f}s -> {result['output']}"
+    ]
+    if result.get("removed_rows"):
+        lines.append(f"    重复 / 重叠的行：共删除 {result['removed_rows']} 行")
+    for entry in result.get("duplicates", []):
+        lines.append(f"    {entry['文件']}：删除 {entry['删除行数']} 行 {entry['说明']}".rstrip())
+    if result.get("anomalies") is not None:
+        lines.append(f"    周趋势异常 SKU：{result['anomalies']} 个")
+    if result.get("cost_from_catalog"):
+        skus = result["cost_from_catalog"]
+        lines.append(f"    成本文件中没有、采购成本取自成本库较早记录的 SKU：{len(skus)} 个（{'、'.join(skus[:10])}）")
+    for name, seconds in timings.items():
+        lines.append(f"    {name:<34} {seconds:8.3f}s")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="WB 财务报表批量分析（每个账号目录输出一份 summary.xlsx）")
+    parser.add_argument("account_dirs", nargs="+", type=Path, help="账号目录，目录下的 .xlsx 为该账号的报表")
+    parser.add_argument("--out", type=Path, required=True, help="输出目录")
+    parser.add_argument("--label", default=time.strftime("%Y%m%d"), help="本次分析的名称/标签（用于文件名）")
+    parser.add_argument("--cost", type=Path, default=None, help="公共采购成本文件（账号目录中没有自带成本表时使用）")
+    parser.add_argument("--cost-name", default="cost.xlsx", help="账号目录中采购成本文件的文件名")
+    parser.add_argument("--cost-catalog", type=Path, default=None,
+                        help="本地采购成本库（SQLite 文件）：成本文件导入其中，按周标签的日期查询成本")
+    parser.add_argument("--cost-effective", default=None,
+                        help="导入成本文件时的生效日期（YYYY-MM-DD，默认一直有效）")
+    parser.add_argument("--workers", type=int, default=1, help="同时处理的账号数（进程数）")
+    parser.add_argument("--backend", choices=list(BACKENDS), default=None,
+                        help="计算后端（默认取环境变量 WB_COMPUTE_BACKEND，未设置时为 pandas）")
+    parser.add_argument("--bundle", choices=BUNDLE_FORMATS, default=None,
+                        help="同时输出数据包 zip（每张结果表一个 Parquet/CSV 文件）")
+    parser.add_argument("--profile", action="store_true",
+                        help="记录各阶段的耗时、行数和内存，输出 <label>_profile.json")
+    parser.add_argument("--no-cache", action="store_true", help="不读写解析缓存和汇总库")
+    parser.add_argument("--out-of-core", action="store_true",
+                        help="大数据量模式：逐份累加部分和，超过上限时溢出到磁盘，内存占用与报表份数无关")
+    parser.add_argument("--spill-dir", type=Path, default=None, help="大数据量模式的溢出目录（默认系统临时目录）")
+    parser.add_argument("--trends", type=Path, default=None,
+                        help="周趋势库目录：本周结果按账号存入其中，并输出 <label>_anomalies.csv")
+    args = parser.parse_args(argv)
+
+    account_dirs = [d for d in args.account_dirs if d.is_dir()]
+    kwargs = dict(cost_path=args.cost, cost_name=args.cost_name, use_cache=not args.no_cache,
+                  bundle_format=args.bundle, profile=args.profile,
+                  cost_catalog=args.cost_catalog, cost_effective=args.cost_effective, backend=args.backend,
+                  out_of_core=args.out_of_core, spill_dir=args.spill_dir, trends_dir=args.trends)
+
+    start = time.perf_counter()
+    results = []
+    if args.workers <= 1:
+        for d in account_dirs:
+            results.append(_run_account_safe(d, args.out, args.label, **kwargs))
+            _print_result(results[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(_run_account_safe, d, args.out, args.label, **kwargs) for d in account_dirs]
+            for fut in as_completed(futures):
+                results.append(fut.result())
+                _print_result(results[-1])
+
+    failed = [r for r in results if "error" in r]
+    print(
+        f"完成 {len(results) - len(failed)}/{len(results)} 个账号，"
+        f"总耗时 {time.perf_counter() - start:.2f}s"
+    )
+    return 1 if failed else 0
+
+
+def _print_result(result: dict):
+    if "error" in result:
+        print(f"[{result['account']}] 失败：{result['error']}", file=sys.stderr)
+    else:
+        print(format_timings(result), flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import argparse
+import io
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from backends import BACKENDS, available_backends, use_backend  # noqa: E402
+from pipeline import SUMMARY_TABLES, aggregate_report, combine_aggregates, run_pipeline  # noqa: E402
+from synthetic_reports import (  # noqa: E402
+    generate_cost_table,
+    iter_reports,
+    parse_size,
+    report_to_parsed,
+    report_to_xlsx,
+)
+
+# ==============================
+# 计算后端一致性检查：pandas 与 polars / duckdb 的各结果表必须完全相同
+# ==============================
+#
+# 合成多份报表，每份先用 aggregate_report 聚合（与后端无关），然后每个后端各自做一遍
+# 多周合并 + 步骤1～8，逐张结果表与 pandas 的结果比较（列类型、行顺序、数值都要完全相同）。
+# 没有安装的后端跳过。任何一张表不一致时退出码为 1。
+#
+#   python benchmarks/backend_parity.py --rows 2M --rows-per-file 200k --skus 50000
+
+
+def run_backend(name: str, tables, cost_bytes: bytes):
+    """在后端 name 下合并周聚合表并跑完步骤1～8，返回 (各结果表, 合并耗时, 步骤耗时)。"""
+    with use_backend(name):
+        start = time.perf_counter()
+        agg = combine_aggregates(tables)
+        combine_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        results, _ = run_pipeline(
+            inputs={
+                "agg": agg, "cost_file": io.BytesIO(cost_bytes), "cost_catalog": None, "cost_as_of": None,
+                "week_label": "parity", "bundle_format": None,
+            },
+            targets=SUMMARY_TABLES,
+        )
+        return results, combine_seconds, time.perf_counter() - start
+
+
+def diff_tables(expected: dict, actual: dict) -> list:
+    """不一致的结果表：[(表名, 错误信息)]。"""
+    mismatches = []
+    for name in SUMMARY_TABLES:
+        try:
+            pd.testing.assert_frame_equal(expected[name], actual[name], check_exact=True)
+        except AssertionError as e:
+            mismatches.append((name, str(e).strip().splitlines()[0]))
+    return mismatches
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="检查各计算后端的结果表与 pandas 完全一致")
+    parser.add_argument("--rows", default="500k", help="总行数，支持 k/M 后缀")
+    parser.add_argument("--rows-per-file", default="100k", help="每份报表的行数（多份报表即多周合并）")
+    parser.add_argument("--skus", type=int, default=20_000, help="SKU 数量")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backends", default=",".join(b for b in BACKENDS if b != "pandas"),
+                        help="要检查的后端（逗号分隔）")
+    args = parser.parse_args(argv)
+
+    tables = [
+        aggregate_report(report_to_parsed(report)).table
+        for report in iter_reports(
+            parse_size(args.rows), rows_per_file=parse_size(args.rows_per_file), skus=args.skus, seed=args.seed,
+        )
+    ]
+    cost_buf = io.BytesIO()
+    report_to_xlsx(generate_cost_table(args.skus, seed=args.seed), cost_buf)
+    cost_bytes = cost_buf.getvalue()
+    print(f"{len(tables)} 份周聚合表，共 {sum(len(t) for t in tables)} 行")
+
+    expected, combine_seconds, steps_seconds = run_backend("pandas", tables, cost_bytes)
+    print(f"  {'pandas':<8} 合并 {combine_seconds:7.3f}s  步骤1～8 {steps_seconds:7.3f}s  （基准）")
+
+    failed = False
+    for name in [b.strip() for b in args.backends.split(",") if b.strip()]:
+        if name not in available_backends():
+            print(f"  {name:<8} 跳过：没有安装")
+            continue
+        actual, combine_seconds, steps_seconds = run_backend(name, tables, cost_bytes)
+        mismatches = diff_tables(expected, actual)
+        status = "一致" if not mismatches else f"{len(mismatches)} 张表不一致"
+        print(f"  {name:<8} 合并 {combine_seconds:7.3f}s  步骤1～8 {steps_seconds:7.3f}s  {status}")
+        for table, message in mismatches:
+            print(f"      {table}: {message}")
+        failed = failed or bool(mismatches)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from pipeline import aggregate_report, combine_aggregates, parse_report_bytes, run_pipeline  # noqa: E402
+from profiling import PeakMemory, StageProfiler  # noqa: E402
+from synthetic_reports import (  # noqa: E402
+    generate_cost_table,
+    iter_reports,
+    parse_size,
+    report_to_parsed,
+    report_to_xlsx,
+)
+
+# ==============================
+# 性能基准：合成报表跑完整条流水线（解析 -> 聚合 -> 各阶段 -> summary.xlsx）
+# ==============================
+#
+# 每个规模在独立子进程中运行，互不影响峰值内存。每个阶段用 profiling.StageProfiler 记录耗时、
+# 行数和阶段内的 RSS 峰值，结果写成 JSON，可以和基线 JSON 对比：
+#
+#   python benchmarks/run_benchmarks.py --sizes 10k,1M,10M --out bench.json
+#   python benchmarks/run_benchmarks.py --sizes 10k,1M --out new.json --baseline bench.json
+#
+# 超过 --xlsx-max-rows 的规模不再真的写出/解析 .xlsx（1000 万行的 xlsx 生成一次要几十分钟），
+# 而是直接把合成数据转成解析后的形式，结果中 ingest_mode 记为 "frame"。
+
+DEFAULT_SIZES = "10k,1M,10M"
+DEFAULT_XLSX_MAX_ROWS = 200_000
+
+
+def run_size(rows: int, skus: int, rows_per_file: int, xlsx_max_rows: int, bundle_format, seed: int = 0) -> dict:
+    """在当前进程跑一个规模，返回该规模的结果 dict。"""
+    profiler = StageProfiler(enabled=True)
+    ingest_mode = "xlsx" if rows <= xlsx_max_rows else "frame"
+    setup_seconds = 0.0
+
+    tables = []
+    files = 0
+    with PeakMemory() as total_mem:
+        reports = iter_reports(rows, rows_per_file=rows_per_file, skus=skus, seed=seed)
+        while True:
+            # 生成数据、写 xlsx 不计入流水线耗时
+            setup_start = time.perf_counter()
+            report = next(reports, None)
+            if report is None:
+                break
+            files += 1
+            if ingest_mode == "xlsx":
+                buf = io.BytesIO()
+                report_to_xlsx(report, buf)
+                payload = buf.getvalue()
+            setup_seconds += time.perf_counter() - setup_start
+
+            if ingest_mode == "xlsx":
+                df = profiler.measure("ingest", parse_report_bytes, payload)
+            else:
+                df = profiler.measure("ingest", report_to_parsed, report)
+            del report
+            agg = profiler.measure("aggregate", aggregate_report, df)
+            tables.append(agg.table)
+            del df
+
+        agg = profiler.measure("combine", combine_aggregates, tables)
+        del tables
+
+        cost_buf = io.BytesIO()
+        report_to_xlsx(generate_cost_table(skus, seed=seed), cost_buf)
+        cost_buf.seek(0)
+
+        run_pipeline(
+            inputs={
+                "agg": agg, "cost_file": cost_buf, "cost_catalog": None, "cost_as_of": None,
+                "week_label": "bench", "bundle_format": bundle_format,
+            },
+            runner=profiler.wrap_runner(),
+        )
+
+    summary = profiler.summary()
+    stages = summary.astype(object).where(summary.notna(), None).to_dict("records")
+    return {
+        "rows": rows,
+        "skus": skus,
+        "files": files,
+        "ingest_mode": ingest_mode,
+        "agg_rows": len(agg.table),
+        "total_seconds": round(sum(st["seconds"] for st in stages), 4),
+        "setup_seconds": round(setup_seconds, 4),
+        "peak_rss_mb": total_mem.as_dict()["peak_rss_mb"],
+        "stages": stages,
+    }
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True, text=True, check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_size_subprocess(rows: int, args) -> dict:
+    cmd = [
+        sys.executable, __file__, "--single", str(rows),
+        "--skus", str(args.skus),
+        "--rows-per-file", str(args.rows_per_file),
+        "--xlsx-max-rows", str(args.xlsx_max_rows),
+        "--seed", str(args.seed),
+    ]
+    if args.bundle:
+        cmd += ["--bundle", args.bundle]
+    out = subprocess.run(cmd, capture_output=True, text=True)
+    if out.returncode != 0:
+        return {"rows": rows, "error": out.stderr.strip().splitlines()[-1] if out.stderr.strip() else "failed"}
+    return json.loads(out.stdout)
+
+
+def compare(result: dict, baseline: dict, threshold: float, min_seconds: float) -> list:
+    """按 (规模, 阶段) 对比耗时，返回比基线慢超过 threshold 的条目。"""
+    base = {
+        (run["rows"], s["stage"]): s
+        for run in baseline.get("runs", []) if "stages" in run
+        for s in run["stages"]
+    }
+    regressions = []
+    print(f"\n与基线对比（基线 {baseline.get('git_commit')}，{baseline.get('created')}）：")
+    print(f"  {'rows':>10} {'stage':<26} {'base s':>9} {'new s':>9} {'ratio':>7} {'peak MB':>9}")
+    for run in result["runs"]:
+        for s in run.get("stages", []):
+            old = base.get((run["rows"], s["stage"]))
+            if old is None:
+                continue
+            ratio = s["seconds"] / old["seconds"] if old["seconds"] else 1.0
+            slower = ratio > 1 + threshold and s["seconds"] - old["seconds"] > min_seconds
+            mark = "  <-- 变慢" if slower else ""
+            print(f"  {run['rows']:>10} {s['stage']:<26} {old['seconds']:>9.3f} {s['seconds']:>9.3f} "
+                  f"{ratio:>7.2f} {s['peak_rss_mb'] or 0:>9.0f}{mark}")
+            if slower:
+                regressions.append({"rows": run["rows"], "stage": s["stage"], "ratio": round(ratio, 3)})
+    return regressions
+
+
+def print_run(run: dict):
+    if "error" in run:
+        print(f"[{run['rows']:,} 行] 失败：{run['error']}")
+        return
+    print(
+        f"[{run['rows']:,} 行，{run['files']} 份，{run['skus']} SKU，{run['ingest_mode']}] "
+        f"总耗时 {run['total_seconds']:.2f}s，峰值内存 {run['peak_rss_mb']} MB"
+    )
+    for s in run["stages"]:
+        print(f"    {s['stage']:<26} {s['seconds']:9.3f}s  峰值 {s['peak_rss_mb'] or 0:8.0f} MB  "
+              f"(+{s['rss_delta_mb'] or 0:.0f} MB)")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="WB 财务流水线性能基准（合成数据）")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="逗号分隔的行数，支持 k/M 后缀")
+    parser.add_argument("--skus", type=int, default=20_000, help="SKU 数量")
+    parser.add_argument("--rows-per-file", type=int, default=1_000_000, help="每份报表最多多少行")
+    parser.add_argument("--xlsx-max-rows", type=int, default=DEFAULT_XLSX_MAX_ROWS,
+                        help="不超过该行数的规模真实写出并解析 .xlsx，更大的规模跳过 xlsx")
+    parser.add_argument("--bundle", choices=["parquet", "csv"], default=None, help="同时测数据包导出")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=Path, default=None, help="结果 JSON 的保存路径")
+    parser.add_argument("--baseline", type=Path, default=None, help="对比的基线 JSON")
+    parser.add_argument("--threshold", type=float, default=0.2, help="比基线慢多少（比例）算变慢")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="绝对差小于该秒数时不算变慢")
+    parser.add_argument("--single", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single is not None:
+        run = run_size(args.single, args.skus, args.rows_per_file, args.xlsx_max_rows, args.bundle, args.seed)
+        json.dump(run, sys.stdout)
+        return 0
+
+    result = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "skus": args.skus,
+            "rows_per_file": args.rows_per_file,
+            "xlsx_max_rows": args.xlsx_max_rows,
+            "bundle": args.bundle,
+            "seed": args.seed,
+        },
+        "runs": [],
+    }
+    for size in args.sizes.split(","):
+        run = _run_size_subprocess(parse_size(size), args)
+        result["runs"].append(run)
+        print_run(run)
+
+    if args.out is not None:
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        args.out.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"结果已保存：{args.out}")
+
+    failed = any("error" in run for run in result["runs"])
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(result, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            print(f"{len(regressions)} 个阶段比基线慢 {args.threshold:.0%} 以上")
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
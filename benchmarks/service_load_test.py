@@ -0,0 +1,132 @@
+import argparse
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from profiling import rss_bytes  # noqa: E402
+from service_client import ServiceClient  # noqa: E402
+from synthetic_reports import generate_cost_table, iter_reports, parse_size, report_file  # noqa: E402
+
+# ==============================
+# 分析服务压测：模拟多人同时提交分析请求
+# ==============================
+#
+# 合成几份周报和一份采购成本表，--users 个模拟用户（线程）同时向服务提交请求、轮询到完成、下载 summary.xlsx，
+# 每人重复 --rounds 轮。--variants 控制请求有几种（周标签不同，报表相同）：
+#   --variants 1   所有人提交同一个请求，应当只产生 1 个任务（请求合并）；
+#   --variants N   N 种请求共用报表的解析和聚合（服务端的阶段缓存 / 汇总库），只有步骤1～8 和导出各算一次。
+# 不指定 --url 时在本进程中启动服务（临时目录中的汇总库和解析缓存，不影响本机数据），需要 fastapi + uvicorn。
+#
+#   python benchmarks/service_load_test.py --users 16 --rounds 2 --variants 2 --rows 200k --rows-per-file 100k
+
+
+def start_local_service(tmp: Path, workers: int) -> str:
+    """在后台线程中启动服务（汇总库、解析缓存都在 tmp 下），返回地址。"""
+    import uvicorn
+
+    from report_cache import ReportCache
+    from rollup_store import RollupStore
+    from pipeline import PARSED_REPORT_FORMAT
+    from service import AnalysisService, create_app
+
+    service = AnalysisService(
+        store=RollupStore(tmp / "rollups"),
+        cache=ReportCache(tmp / "parse_cache", namespace=PARSED_REPORT_FORMAT),
+        workers=workers,
+    )
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(create_app(service), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def simulate_user(client: ServiceClient, user: int, rounds: int, variants: int, reports, cost, records: list):
+    for r in range(rounds):
+        week_label = f"loadtest-{(user + r) % variants}"
+        start = time.perf_counter()
+        submitted = client.submit(reports, week_label, cost_file=cost)
+        status = client.wait(submitted["job_id"], poll=0.2)
+        excel = client.summary_excel(submitted["job_id"]) if status["status"] == "done" else b""
+        records.append({
+            "user": user,
+            "round": r,
+            "job_id": submitted["job_id"],
+            "coalesced": submitted["coalesced"],
+            "status": status["status"],
+            "seconds": time.perf_counter() - start,
+            "excel_bytes": len(excel),
+        })
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="分析服务压测：模拟多人同时提交分析请求")
+    parser.add_argument("--url", default=None, help="已启动的服务地址（不指定时在本进程中启动）")
+    parser.add_argument("--users", type=int, default=8, help="同时在线的模拟用户数")
+    parser.add_argument("--rounds", type=int, default=2, help="每个用户提交的次数")
+    parser.add_argument("--variants", type=int, default=1, help="不同请求的种类数（周标签不同，报表相同）")
+    parser.add_argument("--rows", default="100k", help="报表总行数，支持 k/M 后缀")
+    parser.add_argument("--rows-per-file", default="50k", help="每份报表的行数")
+    parser.add_argument("--skus", type=int, default=5000, help="SKU 数量")
+    parser.add_argument("--workers", type=int, default=1, help="本进程启动服务时每个任务的解析进程数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    reports = [
+        report_file(df, f"report_{i}.xlsx")
+        for i, df in enumerate(iter_reports(
+            parse_size(args.rows), rows_per_file=parse_size(args.rows_per_file), skus=args.skus, seed=args.seed,
+        ))
+    ]
+    cost = report_file(generate_cost_table(args.skus, seed=args.seed), "cost.xlsx")
+    print(f"{len(reports)} 份报表（共 {parse_size(args.rows)} 行），{args.users} 个用户 × {args.rounds} 轮，"
+          f"{args.variants} 种请求")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url or start_local_service(Path(tmp), args.workers)
+        client = ServiceClient(url)
+        records = []
+        threads = [
+            threading.Thread(
+                target=simulate_user, args=(client, user, args.rounds, args.variants, reports, cost, records),
+            )
+            for user in range(args.users)
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - start
+        stats = client.stats()
+
+    seconds = np.array([r["seconds"] for r in records])
+    failed = sum(r["status"] != "done" for r in records)
+    print(f"  请求数        {len(records)}（失败 {failed}）")
+    print(f"  实际任务数    {len({r['job_id'] for r in records})}（合并到已有任务的请求 {sum(r['coalesced'] for r in records)}）")
+    print(f"  总耗时        {wall:.2f}s，吞吐 {len(records) / wall:.2f} 请求/秒")
+    print(f"  响应时间      p50 {np.percentile(seconds, 50):.2f}s  p95 {np.percentile(seconds, 95):.2f}s  "
+          f"最大 {seconds.max():.2f}s")
+    print(f"  解析缓存      {stats['parse_cache']}")
+    for row in stats["stage_cache"]:
+        print(f"  阶段缓存      {row}")
+    if args.url is None:
+        rss = rss_bytes()
+        if rss is not None:
+            print(f"  进程内存      {rss / 1024 / 1024:.0f} MB（含服务和模拟用户）")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+import argparse
+import io
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pipeline import (  # noqa: E402
+    CATEGORICAL_COLUMNS,
+    COLUMN_MAP,
+    FEE_TYPE_MAP,
+    NUMERIC_COLUMNS,
+    REASON_RETURNS,
+    REASON_SALES,
+    TEXT_COLUMNS,
+    write_summary_xlsx,
+)
+from ingest import to_text  # noqa: E402
+
+# ==============================
+# 合成 WB 明细报表（俄文表头，与 COLUMN_MAP 一致）
+# ==============================
+#
+# 用来做性能基准和本地试跑，不依赖真实账号数据。每一行按 Обоснование для оплаты 分成：
+#   - 销售（REASON_SALES）/ 退货（REASON_RETURNS）：带零售价、WB 实现金额、应付卖家金额；
+#   - 物流（Логистика）：Виды логистики 取 FEE_TYPE_MAP 中的各类费用，外加少量未映射的类型；
+#   - 其它（罚款、仓储、扣款等）：部分没有条码。
+# 金额都精确到戈比（两位小数），同一 SKU 的价格在一份报表内保持一致。
+#
+#   python benchmarks/synthetic_reports.py out_dir --rows 200000 --files 2 --skus 5000
+
+BARCODE_BASE = 2040000000000
+WAREHOUSES = ["Коледино", "Электросталь", "Подольск", "Казань", "Краснодар", "Новосибирск", "Екатеринбург"]
+OTHER_REASONS = ["Штраф", "Хранение", "Удержание", "Корректировка продаж", "Логистика сторно"]
+UNMAPPED_FEE_TYPES = ["Возврат брака (К продавцу)", "Возврат неопознанного товара (К продавцу)"]
+
+# 真实报表有 80 多列，这里补几列不在 COLUMN_MAP 里的列，让解析时的列裁剪也被覆盖到
+FILLER_COLUMNS = ["№", "Номер поставки", "Предмет", "Бренд", "Дата продажи", "Страна"]
+
+DEFAULT_REASON_MIX = {"sales": 0.45, "returns": 0.05, "logistics": 0.42, "other": 0.08}
+
+
+def parse_size(text: str) -> int:
+    """命令行中的行数：支持 k / M 后缀和下划线（200k、1.5M、10_000）。"""
+    text = text.strip().lower().replace("_", "")
+    for suffix, factor in (("k", 1_000), ("m", 1_000_000)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+
+def _default_fee_mix() -> dict:
+    """物流行的费用类型分布：正向物流占大头，其它类型均分剩余部分。"""
+    mix = {t: 0.0 for info in FEE_TYPE_MAP.values() for t in info["ru_types"]}
+    mix.update({t: 0.0 for t in UNMAPPED_FEE_TYPES})
+    rest = [t for t in mix if t not in FEE_TYPE_MAP["sales_logistics"]["ru_types"]]
+    for t in FEE_TYPE_MAP["sales_logistics"]["ru_types"]:
+        mix[t] = 0.6 / len(FEE_TYPE_MAP["sales_logistics"]["ru_types"])
+    for t in rest:
+        mix[t] = 0.4 / len(rest)
+    return mix
+
+
+def _kopecks(values) -> np.ndarray:
+    return np.round(values, 2)
+
+
+def generate_report(rows: int,
+                    skus: int = 1000,
+                    seed: int = 0,
+                    reason_mix: dict = None,
+                    fee_mix: dict = None,
+                    filler_columns: bool = True) -> pd.DataFrame:
+    """
+    生成一份 rows 行的 WB 明细报表（俄文表头）。
+    reason_mix：sales / returns / logistics / other 四类行的占比；
+    fee_mix：物流行中各 Виды логистики 取值的占比（默认见 _default_fee_mix）。
+    """
+    rng = np.random.default_rng(seed)
+    reason_mix = {**DEFAULT_REASON_MIX, **(reason_mix or {})}
+    fee_mix = fee_mix or _default_fee_mix()
+
+    kinds = np.array(list(reason_mix))
+    p = np.array(list(reason_mix.values()), dtype=float)
+    kind = rng.choice(kinds, rows, p=p / p.sum())
+    is_sale = kind == "sales"
+    is_return = kind == "returns"
+    is_logistics = kind == "logistics"
+    is_other = kind == "other"
+
+    # 每个 SKU 一个固定的条码、货号、零售价和单件物流费；热门 SKU 出现得更频繁
+    barcodes = np.array([str(BARCODE_BASE + i) for i in range(skus)], dtype=object)
+    articles = np.array([f"ART-{i:06d}" for i in range(skus)], dtype=object)
+    list_price = _kopecks(rng.uniform(300, 9000, skus))
+    unit_logistics = _kopecks(rng.uniform(40, 250, skus))
+    sku = np.minimum(rng.zipf(1.3, rows) - 1, skus - 1)
+    sku = (sku + rng.integers(0, skus, rows) * (rng.random(rows) < 0.5)) % skus
+
+    reason = np.empty(rows, dtype=object)
+    reason[is_sale] = REASON_SALES[0]
+    reason[is_return] = REASON_RETURNS[0]
+    reason[is_logistics] = "Логистика"
+    reason[is_other] = rng.choice(OTHER_REASONS, int(is_other.sum()))
+
+    fee_types = np.array(list(fee_mix), dtype=object)
+    fee_p = np.array(list(fee_mix.values()), dtype=float)
+    fee_type = np.full(rows, None, dtype=object)
+    fee_type[is_logistics] = rng.choice(fee_types, int(is_logistics.sum()), p=fee_p / fee_p.sum())
+
+    goods = is_sale | is_return
+    quantity = np.where(goods, 1, 0).astype("int64")
+    retail = np.where(goods, list_price[sku], 0.0)
+    gmv = np.where(goods, _kopecks(retail * rng.uniform(0.55, 0.9, rows)), 0.0)
+    payable = np.where(goods, _kopecks(gmv * rng.uniform(0.7, 0.85, rows)), 0.0)
+    delivery = np.where(is_logistics, unit_logistics[sku], 0.0)
+    # 少量正向物流行费用为 0（真实报表中存在），销售物流统计时要排除
+    delivery[is_logistics & (rng.random(rows) < 0.03)] = 0.0
+    fine = np.where(reason == "Штраф", _kopecks(rng.uniform(50, 1500, rows)), 0.0)
+    loyalty_comp = np.where(is_sale & (rng.random(rows) < 0.2), _kopecks(gmv * 0.03), 0.0)
+    loyalty_fee = np.where(is_sale & (rng.random(rows) < 0.2), _kopecks(gmv * 0.02), 0.0)
+    loyalty_points = np.where(is_sale & (rng.random(rows) < 0.1), _kopecks(gmv * 0.01), 0.0)
+
+    barcode = barcodes[sku].copy()
+    article = articles[sku].copy()
+    no_barcode = is_other & (rng.random(rows) < 0.5)  # 仓储、扣款等没有具体商品
+    barcode[no_barcode] = None
+    article[no_barcode] = None
+
+    internal = {
+        "reason_for_payment": reason,
+        "logistics_fee_type": fee_type,
+        "barcode": barcode,
+        "supplier_sku": article,
+        "amount_payable_goods": payable,
+        "wb_gmv": gmv,
+        "retail_price_total": retail,
+        "delivery_to_customer": delivery,
+        "fine_total": fine,
+        "loyalty_discount_comp": loyalty_comp,
+        "loyalty_service_fee": loyalty_fee,
+        "loyalty_points_deduction": loyalty_points,
+        "quantity": quantity,
+        "warehouse": rng.choice(WAREHOUSES, rows),
+    }
+    ru_names = {v: k for k, v in COLUMN_MAP.items()}
+    data = {ru_names[name]: values for name, values in internal.items()}
+    if filler_columns:
+        data = {
+            "№": np.arange(1, rows + 1),
+            "Номер поставки": rng.integers(10_000_000, 99_999_999, rows),
+            "Предмет": "Товар",
+            **data,
+            "Бренд": "Brand",
+            "Дата продажи": "2025-11-03",
+            "Страна": "Россия",
+        }
+    return pd.DataFrame(data)
+
+
+def iter_reports(rows: int, rows_per_file: int = 1_000_000, skus: int = 1000, seed: int = 0, **kwargs):
+    """总共 rows 行，按 rows_per_file 拆成多份报表（xlsx 单表最多约 104 万行）逐份产出。"""
+    start = 0
+    i = 0
+    while start < rows:
+        n = min(rows_per_file, rows - start)
+        yield generate_report(n, skus=skus, seed=seed + i, **kwargs)
+        start += n
+        i += 1
+
+
+def report_to_xlsx(df: pd.DataFrame, output):
+    """按 WB 报表的形式写出 .xlsx（第一个工作表、第一行为表头）。"""
+    write_summary_xlsx({"Sheet1": df}, output)
+
+
+def report_file(df: pd.DataFrame, name: str) -> io.BytesIO:
+    """内存中的 .xlsx（带文件名，与网页上传的文件对象一样可以直接传给流水线）。"""
+    buf = io.BytesIO()
+    report_to_xlsx(df, buf)
+    buf.seek(0)
+    buf.name = name
+    return buf
+
+
+def report_to_parsed(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    不经过 .xlsx，直接把合成报表转换成 parse_report_bytes 的输出形式
+    （只保留映射列、相同的列类型），用于超过 xlsx 行数上限的规模。
+    """
+    out = df[[c for c in df.columns if c in COLUMN_MAP]].rename(columns=COLUMN_MAP)
+    for col in out.columns:
+        if col in TEXT_COLUMNS:
+            out[col] = out[col].map(to_text).astype("str")
+        elif col in NUMERIC_COLUMNS:
+            out[col] = pd.to_numeric(out[col], errors="coerce").astype("float64")
+        elif col in CATEGORICAL_COLUMNS:
+            out[col] = pd.Categorical(out[col])
+    return out
+
+
+def generate_cost_table(skus: int = 1000, seed: int = 0, coverage: float = 0.9) -> pd.DataFrame:
+    """采购成本表：覆盖大约 coverage 比例的 SKU（其余 SKU 采购成本按 0 计算）。"""
+    rng = np.random.default_rng(seed)
+    ids = np.flatnonzero(rng.random(skus) < coverage)
+    return pd.DataFrame({
+        "SKU": [str(BARCODE_BASE + i) for i in ids],
+        "采购成本": _kopecks(rng.uniform(100, 3000, len(ids))),
+    })
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="生成合成的 WB 明细报表（.xlsx）和采购成本表")
+    parser.add_argument("out_dir", type=Path, help="输出目录")
+    parser.add_argument("--rows", type=int, default=100_000, help="每份报表的行数")
+    parser.add_argument("--files", type=int, default=1, help="报表份数")
+    parser.add_argument("--skus", type=int, default=1000, help="SKU 数量")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(args.files):
+        region = "境内" if i % 2 == 0 else "境外"
+        path = args.out_dir / f"synthetic-{i // 2 + 1:02d}{region}.xlsx"
+        report_to_xlsx(generate_report(args.rows, skus=args.skus, seed=args.seed + i), path)
+        print(path)
+    cost_path = args.out_dir / "cost.xlsx"
+    report_to_xlsx(generate_cost_table(args.skus, seed=args.seed), cost_path)
+    print(cost_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import date
+from pathlib import Path
+
+import pandas as pd
+
+from pipeline import file_bytes, file_name, load_cost_table
+from report_cache import content_hash
+
+# ==============================
+# 本地采购成本库（SQLite）
+# ==============================
+#
+# 采购成本文件只需导入一次：每个 SKU 的单件成本按“生效日期”分版本存进 SQLite，
+# 以 (sku, effective_from) 为主键，之后每次分析按本次涉及的 SKU 集合和周的日期一次查询取出。
+# 同一份文件（内容哈希）以同一生效日期再次导入时直接跳过。
+# 生效日期留空时记为 ALWAYS_EFFECTIVE，表示“一直有效”（有更晚的版本时被覆盖）；
+# 再次以空日期导入新的成本文件，会替换这一版本中相同 SKU 的成本。
+
+DEFAULT_CATALOG_PATH = Path(
+    os.environ.get(
+        "WB_COST_CATALOG",
+        Path.home() / ".local" / "share" / "wb-finance-analyzer" / "cost_catalog.sqlite",
+    )
+)
+ALWAYS_EFFECTIVE = "0001-01-01"
+LATEST = "9999-12-31"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS imports (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_hash TEXT NOT NULL,
+    file_name TEXT,
+    effective_from TEXT NOT NULL,
+    skus INTEGER NOT NULL,
+    imported_at TEXT NOT NULL,
+    UNIQUE (file_hash, effective_from)
+);
+CREATE TABLE IF NOT EXISTS costs (
+    sku TEXT NOT NULL,
+    effective_from TEXT NOT NULL,
+    unit_cost REAL NOT NULL,
+    import_id INTEGER NOT NULL,
+    PRIMARY KEY (sku, effective_from)
+) WITHOUT ROWID;
+"""
+
+
+def _date_text(value) -> str:
+    """生效日期 / 查询日期统一成 YYYY-MM-DD 文本；None 表示一直有效。"""
+    if value is None or value == "":
+        return ALWAYS_EFFECTIVE
+    if isinstance(value, date):
+        return value.isoformat()[:10]
+    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", str(value)):
+        return str(value)
+    return pd.Timestamp(value).strftime("%Y-%m-%d")
+
+
+def week_as_of(week_label):
+    """
+    从周标签中取出查询成本用的日期：以 8 位日期开头（例如 20251103-1109）时取这一天，
+    否则（例如“Q4汇总”）返回 None，表示使用每个 SKU 的最新版本。
+    """
+    m = re.match(r"\s*(\d{8})", str(week_label or ""))
+    if m is None:
+        return None
+    try:
+        return pd.Timestamp(m.group(1)).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+class CostCatalog:
+    def __init__(self, path=DEFAULT_CATALOG_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # 每次操作新开连接：网页的多个会话线程、批处理的多个进程都可能同时访问
+        return sqlite3.connect(self.path, timeout=60)
+
+    def __len__(self) -> int:
+        """成本库中的 SKU 数。"""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(DISTINCT sku) FROM costs").fetchone()[0]
+
+    def version(self) -> str:
+        """成本库内容的标识：每次导入都会变化，用作流水线缓存的输入键。"""
+        with closing(self._connect()) as conn:
+            last_id, count = conn.execute("SELECT MAX(id), COUNT(*) FROM imports").fetchone()
+        return f"{last_id or 0}-{count}"
+
+    def has_import(self, file_hash: str, effective_from=None) -> bool:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT 1 FROM imports WHERE file_hash = ? AND effective_from = ?",
+                (file_hash, _date_text(effective_from)),
+            ).fetchone()
+        return row is not None
+
+    def import_table(self, cost_df: pd.DataFrame, effective_from=None, file_hash: str = "", name: str = "") -> int:
+        """把 load_cost_table 格式的成本表（SKU / unit_cost）写成一个生效日期的版本，返回 SKU 数。"""
+        effective = _date_text(effective_from)
+        cost_df = cost_df.dropna(subset=["SKU", "unit_cost"])
+        with self._lock, closing(self._connect()) as conn, conn:
+            cur = conn.execute(
+                "INSERT OR REPLACE INTO imports (file_hash, file_name, effective_from, skus, imported_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (file_hash, name, effective, len(cost_df), time.strftime("%Y-%m-%d %H:%M:%S")),
+            )
+            import_id = cur.lastrowid
+            conn.executemany(
+                "INSERT OR REPLACE INTO costs (sku, effective_from, unit_cost, import_id) VALUES (?, ?, ?, ?)",
+                zip(
+                    cost_df["SKU"].astype(str).tolist(),
+                    [effective] * len(cost_df),
+                    cost_df["unit_cost"].astype("float64").tolist(),
+                    [import_id] * len(cost_df),
+                ),
+            )
+        return len(cost_df)
+
+    def import_file(self, cost_file, effective_from=None) -> dict:
+        """
+        导入上传的采购成本文件（列名识别规则与 load_cost_table 相同）。
+        同一份文件以同一生效日期导入过时直接跳过，返回 {"imported": False, ...}。
+        """
+        data = file_bytes(cost_file)
+        file_hash = content_hash(data)
+        effective = _date_text(effective_from)
+        if self.has_import(file_hash, effective):
+            return {"imported": False, "skus": None, "effective_from": effective}
+        skus = self.import_table(
+            load_cost_table(cost_file), effective, file_hash=file_hash, name=file_name(cost_file),
+        )
+        return {"imported": True, "skus": skus, "effective_from": effective}
+
+    def lookup(self, skus=None, as_of=None) -> pd.DataFrame:
+        """
+        一次查询取出 skus（None 表示全部）在 as_of 日期有效的单件成本：
+        每个 SKU 取生效日期不晚于 as_of 的最新版本（as_of 为 None 时取最新版本）。
+        返回与 load_cost_table 相同的两列：SKU / unit_cost。
+        """
+        as_of = LATEST if as_of is None else _date_text(as_of)
+        query = (
+            "SELECT c.sku AS SKU, c.unit_cost AS unit_cost FROM costs AS c "
+            "JOIN (SELECT sku, MAX(effective_from) AS effective_from FROM costs "
+            "      WHERE effective_from <= ? {filter} GROUP BY sku) AS v "
+            "ON c.sku = v.sku AND c.effective_from = v.effective_from "
+            "ORDER BY c.sku"
+        )
+        with closing(self._connect()) as conn:
+            if skus is None:
+                df = pd.read_sql_query(query.format(filter=""), conn, params=(as_of,))
+            else:
+                conn.execute("CREATE TEMP TABLE lookup_skus (sku TEXT PRIMARY KEY) WITHOUT ROWID")
+                keys = pd.Series(skus, dtype=object).dropna().astype(str).unique()
+                conn.executemany("INSERT INTO lookup_skus VALUES (?)", ((k,) for k in keys))
+                df = pd.read_sql_query(
+                    query.format(filter="AND sku IN (SELECT sku FROM temp.lookup_skus)"), conn, params=(as_of,),
+                )
+        df["SKU"] = df["SKU"].astype("str")
+        df["unit_cost"] = df["unit_cost"].astype("float64")
+        return df
+
+    def imports(self) -> pd.DataFrame:
+        """已导入的成本文件（按导入先后排列）。"""
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(
+                "SELECT id, file_name, effective_from, skus, imported_at FROM imports ORDER BY id", conn,
+            )
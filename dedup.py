@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+from ingest import NO_ROW_HASH
+
+# ==============================
+# 重复上传检测：文件哈希 + 行指纹
+# ==============================
+#
+# 同一份报表上传两次（内容哈希相同）时整份跳过；月报和周报、或两份时间段相互覆盖的周报之间的重叠行，
+# 靠“行指纹”找出来：解析时每行按映射列 + 行标识列（Srid，见 pipeline.ROW_ID_COLUMN_MAP）算出 uint64 哈希 row_hash，
+# 再混入该哈希在本文件中第几次出现，得到行指纹。同一文件内完全相同的行（例如同一订单的两件商品）指纹不同，都会保留；
+# 另一份文件中的同一行指纹相同，会被识别为重叠。
+# 所有参与汇总的分区按优先顺序把行指纹拼成一列，一次 duplicated(keep="first") 即可标出重叠行（哈希表，O(n)），
+# 不做逐行比较。行指纹随聚合表一起存进汇总库，复用的分区无需重新解析即可参与检测。
+# 只有带 Srid 的行才比对：没有 Srid 列的报表没有行指纹（只检查整份文件），Srid 为空的行指纹为 NO_ROW_HASH，
+# 从不算作重叠——没有行标识时，两份报表中完全相同的行（同一天同一仓库的物流费）是两笔真实的费用。
+# 本模块不依赖 streamlit。
+
+# 汇总库中行指纹分区的格式标识；改动行指纹算法时递增
+ROW_FINGERPRINT_FORMAT = "rowfp-v2"
+
+DUPLICATE_LOG_COLUMNS = ["文件", "行数", "删除行数", "说明"]
+
+NOTE_DUPLICATE_FILE = "与 {} 内容完全相同，整份跳过"
+NOTE_OVERLAP = "与前面的报表重叠的行已去掉"
+NOTE_UNTRIMMED = "与前面的报表有 {} 行重叠，但原文件不在本次上传中，未能去掉（请重新上传该文件）"
+NOTE_NO_ROW_ID = "报表中没有行标识列 Srid，只检查整份文件是否重复"
+
+
+def row_fingerprints(row_hash) -> np.ndarray:
+    """
+    每行的 row_hash 混入它在本文件中是第几次出现（0, 1, 2 …），得到行指纹（uint64）。
+    没有行标识的行（NO_ROW_HASH）保持 NO_ROW_HASH。
+    """
+    h = np.asarray(row_hash, dtype="uint64")
+    occurrence = pd.Series(h).groupby(h, sort=False).cumcount().to_numpy(dtype="uint64")
+    return np.where(h == NO_ROW_HASH, np.uint64(NO_ROW_HASH), h ^ pd.util.hash_array(occurrence))
+
+
+def overlap_masks(fingerprints) -> list:
+    """
+    fingerprints：按优先顺序排列的各分区行指纹（None 表示该分区没有行指纹）。
+    返回与之等长的列表：每个分区一个布尔掩码（True 表示该行已在前面的分区中出现过），没有行指纹的分区为 None。
+    """
+    present = [fp for fp in fingerprints if fp is not None]
+    if not present:
+        return [None] * len(fingerprints)
+    combined = np.concatenate(present)
+    duplicated = pd.Series(combined).duplicated(keep="first").to_numpy() & (combined != NO_ROW_HASH)
+    bounds = np.cumsum([0, *(len(fp) for fp in present)])
+    masks = iter(duplicated[a:b] for a, b in zip(bounds[:-1], bounds[1:]))
+    return [None if fp is None else next(masks) for fp in fingerprints]
+
+
+class DuplicateLog:
+    """每份报表的去重结果（行数、删除行数、说明），供网页和批处理展示。"""
+
+    def __init__(self):
+        self.entries = []
+        self.unresolved_rows = 0  # 发现了但未能去掉的重叠行
+
+    def add(self, name: str, rows, removed: int = 0, note: str = ""):
+        self.entries.append({"文件": name, "行数": rows, "删除行数": int(removed), "说明": note})
+
+    def add_unresolved(self, name: str, rows, overlap: int):
+        self.add(name, rows, 0, NOTE_UNTRIMMED.format(overlap))
+        self.unresolved_rows += int(overlap)
+
+    @property
+    def removed_rows(self) -> int:
+        return sum(e["删除行数"] for e in self.entries)
+
+    @property
+    def has_findings(self) -> bool:
+        """是否有需要提示的情况：删除了行，或有无法去掉的重叠。"""
+        return self.removed_rows > 0 or self.unresolved_rows > 0
+
+    def frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.entries, columns=DUPLICATE_LOG_COLUMNS).astype({"行数": "Int64"})
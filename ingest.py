@@ -0,0 +1,203 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+# ==============================
+# 报表文件解析（流式读取 + 可多进程并行）
+# ==============================
+#
+# WB 明细报表有 80 多列，真正用到的只有 COLUMN_MAP 里的十几列。
+# 这里用 openpyxl 只读模式逐行流式读取，只保留映射到的列，
+# 数值列直接转成 float64，条码等标识列统一成文本，低基数文本列存成 categorical，按块产出 DataFrame，
+# 不再先把整张表读进内存再重命名。
+#
+# openpyxl 解析是纯 Python、受 GIL 限制的 CPU 密集型工作，多线程没有帮助。
+# 多份报表时把每份 .xlsx 交给独立的子进程解析，子进程只回传裁剪后的 DataFrame
+# （按列块序列化），主进程最后统一 concat 一次。
+# 报表带行标识列（row_id_columns，例如 Srid）时，每块顺便算出每行的 uint64 哈希 row_hash
+# （映射列 + 行标识列），行标识列本身不保留，用于检测重复上传（见 dedup.py）。
+# 本模块不依赖 streamlit，子进程无需导入网页相关代码。
+
+DEFAULT_WORKERS = int(os.environ.get("WB_INGEST_WORKERS", "0")) or min(os.cpu_count() or 1, 8)
+DEFAULT_CHUNK_ROWS = 50_000
+# 行标识为空的行的 row_hash：这些行不参与行级去重（见 dedup.py）
+NO_ROW_HASH = 0
+
+
+def to_text(value):
+    """
+    条码等标识类单元格统一转成文本：Excel 里可能存成数字（2000000000000 或 2000000000000.0），
+    也可能存成文本，不统一的话同一个 SKU 在不同文件、成本表之间无法对上。
+    """
+    if value is None:
+        return None
+    if isinstance(value, float):
+        if value != value:  # NaN
+            return None
+        if value.is_integer():
+            return str(int(value))
+    if isinstance(value, str):
+        return value.strip()
+    return str(value)
+
+
+def _build_chunk(columns: dict, numeric_columns, categorical_columns, text_columns=()) -> pd.DataFrame:
+    data = {}
+    for name, values in columns.items():
+        if name in text_columns:
+            data[name] = pd.Series([to_text(v) for v in values], dtype=object).astype("str")
+        elif name in numeric_columns:
+            data[name] = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").astype("float64")
+        elif name in categorical_columns:
+            data[name] = pd.Categorical(values)
+        else:
+            data[name] = pd.Series(values)
+    return pd.DataFrame(data)
+
+
+def _with_row_hash(chunk: pd.DataFrame, row_id_columns) -> pd.DataFrame:
+    """
+    块中有行标识列时，按列名顺序把整行（映射列 + 行标识列）哈希成 row_hash（uint64），并去掉行标识列。
+    哈希按值计算（categorical 也是按类别原文），与分块方式、列在报表中的位置无关。
+    行标识列全部为空的行没有可靠的身份，row_hash 记为 NO_ROW_HASH，不参与行级去重。
+    """
+    ids = [c for c in row_id_columns if c in chunk.columns]
+    if not ids:
+        return chunk
+    row_hash = pd.util.hash_pandas_object(chunk[sorted(chunk.columns)], index=False).to_numpy(copy=True)
+    missing = np.logical_and.reduce([
+        (chunk[c].isna() | (chunk[c].astype("str").str.strip() == "")).to_numpy() for c in ids
+    ])
+    row_hash[missing] = NO_ROW_HASH
+    return chunk.drop(columns=ids).assign(row_hash=row_hash)
+
+
+def iter_report_chunks(data: bytes,
+                       column_map: dict,
+                       numeric_columns=(),
+                       categorical_columns=(),
+                       text_columns=(),
+                       chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                       row_id_columns: dict = None):
+    """
+    流式读取单份 WB 报表（.xlsx 原始字节）的第一个工作表，
+    只保留 column_map 中出现的列（已重命名），每 chunk_rows 行产出一个 DataFrame。
+    row_id_columns 为 {表头: 列名} 的行标识列：按文本读取，只用来计算 row_hash，不出现在结果中。
+    """
+    row_id_columns = row_id_columns or {}
+    column_map = {**column_map, **row_id_columns}
+    text_columns = (*text_columns, *row_id_columns.values())
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None) or ()
+
+        # 表头位置 -> 内部列名；同名列只取第一次出现的位置
+        picked = {}
+        for idx, cell in enumerate(header):
+            name = column_map.get(str(cell).strip()) if cell is not None else None
+            if name is not None and name not in picked.values():
+                picked[idx] = name
+
+        buffers = {name: [] for name in picked.values()}
+        n = 0
+        yielded = False
+        for row in rows:
+            if row is None or all(v is None for v in row):
+                continue
+            width = len(row)
+            for idx, name in picked.items():
+                buffers[name].append(row[idx] if idx < width else None)
+            n += 1
+            if n >= chunk_rows:
+                yield _with_row_hash(
+                    _build_chunk(buffers, numeric_columns, categorical_columns, text_columns), row_id_columns.values(),
+                )
+                buffers = {name: [] for name in picked.values()}
+                n = 0
+                yielded = True
+
+        # 最后不足一块的行；空表也产出一个只有表头的块，保证列存在
+        if n or not yielded:
+            yield _with_row_hash(
+                _build_chunk(buffers, numeric_columns, categorical_columns, text_columns), row_id_columns.values(),
+            )
+    finally:
+        wb.close()
+
+
+def concat_reports(dfs) -> pd.DataFrame:
+    """
+    合并多个报表块。pd.concat 遇到类别不同的 categorical 会退化成 object，
+    这里先把同名 categorical 列统一成类别并集，保证合并后仍是 categorical。
+    """
+    dfs = [df for df in dfs if df is not None]
+    if not dfs:
+        return pd.DataFrame()
+
+    cat_cols = [
+        col for col in dfs[0].columns
+        if all(col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype) for df in dfs)
+    ]
+    for col in cat_cols:
+        categories = dfs[0][col].cat.categories.append([df[col].cat.categories for df in dfs[1:]]).unique()
+        dtype = pd.CategoricalDtype(categories)
+        dfs = [df.assign(**{col: df[col].astype(dtype)}) for df in dfs]
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+def read_report_xlsx(data: bytes,
+                     column_map: dict,
+                     numeric_columns=(),
+                     categorical_columns=(),
+                     text_columns=(),
+                     row_id_columns: dict = None) -> pd.DataFrame:
+    """解析单份 WB 报表（.xlsx 原始字节），只保留 column_map 中的列并完成类型转换。"""
+    return concat_reports(
+        iter_report_chunks(data, column_map, numeric_columns, categorical_columns, text_columns,
+                           row_id_columns=row_id_columns)
+    )
+
+
+def parse_reports_parallel(blobs,
+                           column_map: dict,
+                           workers: int = DEFAULT_WORKERS,
+                           numeric_columns=(),
+                           categorical_columns=(),
+                           text_columns=(),
+                           on_parsed=None,
+                           row_id_columns: dict = None) -> list:
+    """
+    并行解析多份报表，返回与 blobs 顺序一致的 DataFrame 列表。
+    workers <= 1 或只有一份文件时直接在当前进程解析，省掉进程启动开销。
+    传入 on_parsed 时，每解析完一份（按 blobs 的顺序）调用一次 on_parsed(序号)，用于显示进度。
+    """
+    blobs = list(blobs)
+    parse = partial(
+        read_report_xlsx,
+        column_map=column_map,
+        numeric_columns=tuple(numeric_columns),
+        categorical_columns=tuple(categorical_columns),
+        text_columns=tuple(text_columns),
+        row_id_columns=row_id_columns,
+    )
+    workers = max(1, min(workers, len(blobs)))
+    if workers == 1:
+        return list(_notify_each((parse(data) for data in blobs), on_parsed))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(_notify_each(pool.map(parse, blobs), on_parsed))
+
+
+def _notify_each(results, on_parsed):
+    for i, df in enumerate(results):
+        if on_parsed is not None:
+            on_parsed(i)
+        yield df
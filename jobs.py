@@ -0,0 +1,577 @@
+import io
+import itertools
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pandas as pd
+
+from pipeline import (
+    PIPELINE_STAGES,
+    SUMMARY_TABLES,
+    catalog_fallback_skus,
+    combine_aggregates,
+    content_hash,
+    empty_cost_table,
+    file_bytes,
+    file_name,
+    ingest_reports,
+    load_week_aggregates,
+    partition_key,
+    partition_name,
+    partition_region,
+    plan_deduplication,
+    run_pipeline,
+    stage_order,
+    trimmed_aggregate,
+    with_region,
+)
+from backends import use_backend
+from cost_catalog import week_as_of
+from dedup import DuplicateLog
+from profiling import StageProfiler
+from trends import trend_week
+
+# ==============================
+# 后台分析任务：在线程池中跑完整条流水线，网页只负责轮询进度和展示结果
+# ==============================
+#
+# 点击“开始分析”后提交一个任务（Job），立即返回任务 ID；解析、聚合、各阶段和导出
+# 在后台线程中执行，每一步记录到 job.steps，网页定时读取进度。
+# 完成的结果按任务 ID 保存在 JobQueue 中（最多保留 JOB_HISTORY 个），之前的任务可以直接查看，无需重算。
+# 用线程而不是进程：结果表很大，留在同一进程内不必序列化，进度也能直接共享；
+# 耗时的 numpy / pandas / xlsx 写出大多释放 GIL，不会卡住网页的脚本线程。
+# 各阶段结果由进程内的 StageMemo 记忆，不同任务之间共用。本模块不依赖 streamlit。
+
+JOB_WORKERS = int(os.environ.get("WB_JOB_WORKERS", "1"))
+JOB_HISTORY = int(os.environ.get("WB_JOB_HISTORY", "20"))
+
+STAGE_CACHE_TTL = int(os.environ.get("WB_STAGE_CACHE_TTL", "3600"))
+STAGE_CACHE_MAX_ENTRIES = int(os.environ.get("WB_STAGE_CACHE_ENTRIES", "32"))
+# 单份报表的聚合结果条目更多（一个季度就有二十多份）
+STAGE_CACHE_MAX_FILE_ENTRIES = int(os.environ.get("WB_STAGE_CACHE_FILE_ENTRIES", "256"))
+
+# 成本文件里缺失、改用成本库旧记录的 SKU，提示中最多列出的个数
+FALLBACK_SKUS_SHOWN = 10
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+class StageMemo:
+    """
+    进程内的阶段结果缓存：键为 (阶段名, 上游输入的内容标识)，
+    每个阶段最多保留 max_entries 份（最近使用的），超过 ttl 秒的条目失效。
+    同一个键正在被其它任务计算时，后来的调用等那次计算完成、直接用它的结果，不重复计算。
+    stats 记录各阶段的调用次数和未命中（真正计算）次数。
+    """
+
+    def __init__(self, ttl: int = STAGE_CACHE_TTL, max_entries: int = STAGE_CACHE_MAX_ENTRIES, limits=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.limits = limits or {}
+        self.stats = {}
+        self._entries = {}
+        self._pending = {}  # (阶段名, 键) -> 正在计算的 Future
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, stage: str, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            stat = self.stats.setdefault(stage, {"calls": 0, "misses": 0})
+            stat["calls"] += 1
+            entries = self._entries.setdefault(stage, OrderedDict())
+            hit = entries.get(key)
+            if hit is not None and now - hit[0] <= self.ttl:
+                entries.move_to_end(key)
+                return hit[1]
+            pending = self._pending.get((stage, key))
+            computing = pending is None
+            if computing:
+                stat["misses"] += 1
+                pending = self._pending[(stage, key)] = Future()
+
+        if not computing:
+            # 其它任务正在算同一个键：等它的结果（那次计算失败时抛出同样的异常）
+            return pending.result()
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[(stage, key)]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            entries[key] = (time.monotonic(), value)
+            entries.move_to_end(key)
+            while len(entries) > self.limits.get(stage, self.max_entries):
+                entries.popitem(last=False)
+            del self._pending[(stage, key)]
+        pending.set_result(value)
+        return value
+
+    def runner(self, name, fingerprint, fn, args):
+        """run_pipeline 的 runner：按 (阶段名, fingerprint) 记忆阶段结果。"""
+        return self.get_or_compute(name, fingerprint, lambda: fn(*args))
+
+    def stats_frame(self) -> pd.DataFrame:
+        with self._lock:
+            rows = [
+                {"阶段": stage, "调用次数": s["calls"], "命中": s["calls"] - s["misses"], "未命中（实际计算）": s["misses"]}
+                for stage, s in self.stats.items()
+            ]
+        return pd.DataFrame(rows, columns=["阶段", "调用次数", "命中", "未命中（实际计算）"])
+
+
+class Job:
+    """一个后台分析任务：状态、逐步进度、提示信息和最终结果。"""
+
+    def __init__(self, job_id: str, label: str = "", meta: dict = None):
+        self.id = job_id
+        self.label = label
+        self.meta = meta or {}
+        self.status = STATUS_QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.total_steps = 0
+        self.steps = []
+        self.notes = []
+        self.result = None
+        self.error = None
+        self.profiler = None
+        self._lock = threading.Lock()
+
+    # ---- 进度 ----
+    def expect(self, steps: int):
+        """预计还要执行的步骤数（用于计算进度百分比）。"""
+        with self._lock:
+            self.total_steps += steps
+
+    def _run_step(self, name: str, call):
+        step = {"stage": name, "status": STATUS_RUNNING, "seconds": None}
+        with self._lock:
+            self.steps.append(step)
+        start = time.perf_counter()
+        try:
+            result = call()
+        except BaseException:
+            step["status"] = STATUS_FAILED
+            raise
+        finally:
+            step["seconds"] = round(time.perf_counter() - start, 4)
+        step["status"] = STATUS_DONE
+        return result
+
+    def advance(self, name: str):
+        """记录一步已完成的进度（不计时），例如并行解析中每读完一份报表。"""
+        with self._lock:
+            self.steps.append({"stage": name, "status": STATUS_DONE, "seconds": None})
+
+    def measure(self, name: str, fn, *args, **kwargs):
+        """与 StageProfiler.measure 相同的接口：记录一步进度，同时交给 profiler 记录性能数据。"""
+        profiler = self.profiler
+        if profiler is None:
+            return self._run_step(name, lambda: fn(*args, **kwargs))
+        return self._run_step(name, lambda: profiler.measure(name, fn, *args, **kwargs))
+
+    def wrap_runner(self, runner=None):
+        """给 run_pipeline 的 runner 加上逐阶段的进度记录。"""
+        def tracked(name, fingerprint, fn, args):
+            if runner is None:
+                return self._run_step(name, lambda: fn(*args))
+            return self._run_step(name, lambda: runner(name, fingerprint, fn, args))
+
+        return tracked
+
+    def note(self, level: str, text: str):
+        """给网页展示的提示信息，level 为 success / info / warning / error / caption。"""
+        with self._lock:
+            self.notes.append((level, text))
+
+    def progress(self) -> dict:
+        with self._lock:
+            steps = [dict(s) for s in self.steps]
+            total = self.total_steps
+        done = sum(1 for s in steps if s["status"] == STATUS_DONE)
+        running = [s["stage"] for s in steps if s["status"] == STATUS_RUNNING]
+        return {
+            "status": self.status,
+            "done": done,
+            "total": max(total, done),
+            "fraction": 1.0 if self.status == STATUS_DONE else (done / total if total else 0.0),
+            "current": running[-1] if running else None,
+            "steps": steps,
+        }
+
+    def steps_frame(self) -> pd.DataFrame:
+        """同名步骤（例如逐份报表的聚合）合并成一行：完成数、耗时之和。"""
+        steps = pd.DataFrame(self.progress()["steps"], columns=["stage", "status", "seconds"])
+        if steps.empty:
+            return steps
+        return (
+            steps.assign(done=steps["status"] == STATUS_DONE)
+            .groupby("stage", sort=False)
+            .agg(runs=("stage", "size"), done=("done", "sum"), seconds=("seconds", "sum"))
+            .reset_index()
+        )
+
+    def elapsed(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+
+class JobQueue:
+    """线程池 + 按任务 ID 保存的任务表（只保留最近 history 个任务）。"""
+
+    def __init__(self, workers: int = JOB_WORKERS, history: int = JOB_HISTORY):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="wb-job")
+        self._jobs = OrderedDict()
+        self._history = history
+        self._ids = itertools.count(1)
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, label: str = "", meta: dict = None, coalesce_key=None, **kwargs) -> str:
+        """
+        提交任务 fn(job, *args, **kwargs)，返回任务 ID；fn 的返回值保存为 job.result。
+        coalesce_key 不为 None 时合并相同的请求：已有同一键的任务（排队中、运行中或已完成）时不再提交，
+        直接返回该任务的 ID，多个会话同时点“开始分析”只计算一次。失败的任务不参与合并。
+        """
+        with self._lock:
+            existing = self._jobs.get(self._by_key.get(coalesce_key))
+            if coalesce_key is not None and existing is not None and existing.status != STATUS_FAILED:
+                return existing.id
+            job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{next(self._ids)}"
+            job = Job(job_id, label=label, meta=meta)
+            self._jobs[job_id] = job
+            if coalesce_key is not None:
+                self._by_key[coalesce_key] = job_id
+            self._trim()
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job_id
+
+    def _run(self, job: Job, fn, args, kwargs):
+        job.status = STATUS_RUNNING
+        job.started = time.time()
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.status = STATUS_DONE
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = STATUS_FAILED
+        finally:
+            job.finished = time.time()
+
+    def _trim(self):
+        # 超出保留数时丢弃最早的已结束任务，运行中 / 排队中的任务不会被丢弃
+        finished = [j.id for j in self._jobs.values() if j.status in (STATUS_DONE, STATUS_FAILED)]
+        for job_id in finished[:max(0, len(self._jobs) - self._history)]:
+            del self._jobs[job_id]
+        self._by_key = {key: job_id for key, job_id in self._by_key.items() if job_id in self._jobs}
+
+    def find(self, coalesce_key):
+        """coalesce_key 对应的任务（没有时为 None）。"""
+        with self._lock:
+            return self._jobs.get(self._by_key.get(coalesce_key))
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> list:
+        """所有任务，最新的在前。"""
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+
+def analysis_request_key(files,
+                         stored_keys,
+                         cost_file,
+                         week_label: str,
+                         bundle_format,
+                         cost_catalog=None,
+                         cost_effective=None,
+                         out_of_core: bool = False,
+                         backend: str = None,
+                         profile: bool = False) -> tuple:
+    """
+    一次分析请求的内容标识（JobQueue.submit 的 coalesce_key）：报表按内容哈希、采购成本按文件内容或成本库版本，
+    加上周标签和各项选项。标识相同的请求结果相同，只需计算一次。
+    """
+    return (
+        tuple(partition_key(f) for f in files),
+        tuple(stored_keys),
+        None if cost_file is None else content_hash(file_bytes(cost_file)),
+        None if cost_catalog is None else cost_catalog.version(),
+        week_label,
+        bundle_format,
+        cost_effective,
+        out_of_core,
+        backend,
+        profile,
+    )
+
+
+def snapshot_file(f, digest: str = None):
+    """
+    上传的文件对象 -> 内存中的副本（保留文件名），任务执行期间不受网页上文件增删的影响。
+    digest 为已算好的内容哈希时记在副本上（pipeline.partition_key 直接使用，不再重新计算）。
+    """
+    if f is None:
+        return None
+    buf = io.BytesIO(file_bytes(f))
+    buf.name = file_name(f)
+    if digest is not None:
+        buf.content_hash = digest
+    return buf
+
+
+def run_analysis_job(job: Job, *args, backend: str = None, **kwargs) -> dict:
+    """后台任务的入口：在 backend 指定的计算后端下（None 表示默认后端）执行 analyze。"""
+    with use_backend(backend):
+        return analyze(job, *args, **kwargs)
+
+
+def analyze(job: Job,
+            files,
+            stored_keys,
+            cost_file,
+            week_label: str,
+            bundle_format,
+            store,
+            memo: StageMemo,
+            cache=None,
+            workers: int = 1,
+            cost_catalog=None,
+            cost_effective=None,
+            profile: bool = False,
+            out_of_core: bool = False,
+            trends=None) -> dict:
+    """
+    一次完整分析（网页“开始分析”的全部工作）：
+    新报表解析、聚合并写入汇总库 -> 读取各报表的聚合表并合并 -> 采购成本 -> 步骤1～8 -> 导出。
+    out_of_core=True 时各报表的聚合表不逐份记忆，而是逐份并入部分和（见 load_week_aggregates），
+    只记忆最终的合并结果，内存占用与报表份数无关。
+    trends 为 TrendStore 时，参与的报表都在同一周内（见 trends.trend_week）则按 SKU 利润 / 取消率和费用汇总存入周趋势库。
+    重复上传的文件和与前面报表重叠的行在合并前去掉（见 load_week_aggregates），每份报表的删除行数放在结果的 duplicates 中。
+    返回展示用的结果 dict（各结果表、summary.xlsx、数据包、各阶段耗时、去重结果、性能记录）。
+    """
+    profiler = StageProfiler(enabled=profile)
+    job.profiler = profiler
+
+    file_keys = [partition_key(f) for f in files]
+    files_by_key = {}
+    for f, key in zip(files, file_keys):
+        files_by_key.setdefault(key, f)
+    new_files = [f for key, f in files_by_key.items() if not store.has(key)]
+    # 重叠的行保留先出现的那份：汇总库中选中的历史分区在前，上传的文件按顺序在后
+    stored_keys = [k for k in dict.fromkeys(stored_keys) if k not in files_by_key]
+    order = tuple(stored_keys + file_keys)
+    names = tuple([partition_name(store, k) for k in stored_keys] + [file_name(f) for f in files])
+    trimmable = tuple(k in files_by_key for k in order)
+    keys = list(dict.fromkeys(order))
+    importing_cost = cost_catalog is not None and cost_file is not None
+    # 周趋势按报表文件名中的期间归到某一周，不看周标签；跨周的分析不计入
+    trend_label = trend_week(names) if trends is not None else None
+    parse_chunks = math.ceil(len(new_files) / max(1, workers))
+    job.expect(
+        # 每批 parse_reports + 每份 parse_report、aggregate_report
+        parse_chunks + 2 * len(new_files)
+        # 大数据量模式：deduplicate + combine_aggregates；否则 deduplicate + 每份 read_partition + combine_partitions
+        + (2 if out_of_core else 1 + len(keys) + 1)
+        + (1 if importing_cost else 0)
+        + len(stage_order())
+        + (1 if trend_label is not None else 0)
+    )
+
+    # 第0步：新报表先并行解析（已解析过的文件读缓存）、单次扫描聚合并写入汇总库
+    hits_before, misses_before = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    ingest_start = time.perf_counter()
+    on_parsed = lambda name: job.advance("parse_report")  # noqa: E731
+    # 聚合结果由参与的报表集合（以及其中哪些可以去掉重叠行）唯一决定
+    # 区域按本次的文件名（见 pipeline.partition_region），同样的内容换了文件名时结果也不同
+    regions = {k: partition_region(store, k, files_by_key.get(k)) for k in keys}
+    agg_key = (tuple(sorted(keys)), tuple(sorted(files_by_key)), tuple(sorted(regions.items())))
+
+    def deduplicate():
+        duplicates = DuplicateLog()
+        unique, removals = plan_deduplication(store, order, names, trimmable, log=duplicates)
+        return unique, removals, duplicates
+
+    if out_of_core:
+        def stream_aggregates():
+            agg, _, _ = load_week_aggregates(
+                files, store, cache=cache, workers=workers, stored_keys=stored_keys, profiler=job,
+                on_parsed=on_parsed, out_of_core=True,
+            )
+            return agg
+
+        agg = memo.get_or_compute("combine_aggregates", agg_key, stream_aggregates)
+        # 去重已在 load_week_aggregates 中完成，这里只取每份报表的结果用于展示
+        _, _, duplicates = job.measure(
+            "deduplicate", memo.get_or_compute, "deduplicate", (order, names), deduplicate,
+        )
+    else:
+        if new_files:
+            ingest_reports(
+                new_files, store, cache=cache, workers=workers, measure=job.measure, on_parsed=on_parsed, keep=False,
+            )
+        unique, removals, duplicates = job.measure(
+            "deduplicate", memo.get_or_compute, "deduplicate", (order, names), deduplicate,
+        )
+
+        def read_partition(key):
+            if key in removals:
+                return trimmed_aggregate(files_by_key[key], removals[key], cache=cache)
+            table = store.get(key)
+            if table is None:
+                table = ingest_reports([files_by_key[key]], store, cache=cache)[key]
+            return table
+
+        tables = [
+            with_region(
+                job.measure(
+                    "read_partition", memo.get_or_compute, "ingest", (key, order) if key in removals else key,
+                    lambda key=key: read_partition(key),
+                ),
+                regions[key],
+            )
+            for key in unique
+        ]
+        agg = job.measure(
+            "combine_partitions", memo.get_or_compute, "combine_aggregates", agg_key,
+            lambda: combine_aggregates(tables),
+        )
+    ingest_seconds = time.perf_counter() - ingest_start
+
+    job.note(
+        "success",
+        f"已成功读取 {len(keys)} 份报表，合并后共有 {agg.total_rows} 行记录"
+        f"（复用汇总库 {len(keys) - len(new_files)} 份，新处理 {len(new_files)} 份）。",
+    )
+    if duplicates.has_findings:
+        found = []
+        if duplicates.removed_rows:
+            found.append(f"已删除 {duplicates.removed_rows} 行重复 / 重叠的记录")
+        if duplicates.unresolved_rows:
+            found.append(f"有 {duplicates.unresolved_rows} 行重叠未能去掉（原文件不在本次上传中）")
+        job.note("warning", f"检测到重复上传：{'；'.join(found)}。每份报表的情况见“重复上传检测”。")
+    if cache is not None:
+        cache_stats = cache.stats()
+        job.note(
+            "caption",
+            f"解析缓存：本次命中 {cache_stats['hits'] - hits_before} 个 / "
+            f"未命中 {cache_stats['misses'] - misses_before} 个；"
+            f"累计命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']}，"
+            f"缓存 {cache_stats['entries']} 个文件，共 {cache_stats['size_mb']} MB",
+        )
+
+    # 采购成本：使用成本库时先把上传的文件导入成本库（同一文件只导入一次），再按本周日期查询；
+    # 本次上传的成本文件优先（不论生效日期），成本库只补文件中没有的 SKU
+    cost_as_of = week_as_of(week_label)
+    if cost_catalog is not None:
+        imported = None
+        if importing_cost:
+            try:
+                imported = job.measure("import_cost", cost_catalog.import_file, cost_file, cost_effective)
+            except Exception as e:
+                job.note("error", f"读取采购成本文件时出错：{e}")
+                imported = None
+            if imported is not None and imported["imported"]:
+                job.note(
+                    "info",
+                    f"采购成本文件已导入成本库：{imported['skus']} 个 SKU，生效日期 {imported['effective_from']}。",
+                )
+        if len(cost_catalog) == 0:
+            job.note("warning", "采购成本库为空且未上传采购成本文件，本次利润计算中的采购成本将视为 0。")
+        # 导入失败（文件读不出来）时只用成本库
+        run_cost_file = cost_file if imported is not None else None
+        cost_key = None if run_cost_file is None else content_hash(file_bytes(run_cost_file))
+        catalog_key = cost_catalog.version()
+    else:
+        run_cost_file, catalog_key = cost_file, None
+        if cost_file is not None:
+            cost_key = content_hash(file_bytes(cost_file))
+        else:
+            job.note("warning", "未上传采购成本文件，本次利润计算中的采购成本将视为 0。")
+            cost_key = None
+
+    def stage_runner(name, fingerprint, fn, args):
+        # 成本表读取失败时按 0 成本继续
+        if name != "cost_df":
+            return memo.runner(name, fingerprint, fn, args)
+        try:
+            return memo.runner(name, fingerprint, fn, args)
+        except Exception as e:
+            job.note("error", f"读取采购成本文件时出错：{e}")
+            return empty_cost_table()
+
+    # 步骤1～8 + 导出：按阶段图执行，每个阶段只执行一次，下游共享同一份结果
+    results, stage_timings = run_pipeline(
+        inputs={
+            "agg": agg,
+            "cost_file": run_cost_file,
+            "cost_catalog": cost_catalog,
+            "cost_as_of": cost_as_of,
+            "week_label": week_label,
+            "bundle_format": bundle_format,
+        },
+        input_keys={
+            "agg": agg_key,
+            "cost_file": cost_key,
+            "cost_catalog": catalog_key,
+            "cost_as_of": cost_as_of,
+            "week_label": week_label,
+            "bundle_format": bundle_format,
+        },
+        runner=job.wrap_runner(profiler.wrap_runner(stage_runner)),
+    )
+    stage_timings.insert(0, {"stage": "ingest", "seconds": ingest_seconds, "runs": 1})
+
+    fallback = catalog_fallback_skus(results["cost_df"])
+    if fallback:
+        shown = "、".join(fallback[:FALLBACK_SKUS_SHOWN]) + (" 等" if len(fallback) > FALLBACK_SKUS_SHOWN else "")
+        job.note(
+            "warning",
+            f"{len(fallback)} 个 SKU 不在本次上传的成本文件中，采购成本取自成本库中已有的（较早的）记录：{shown}。",
+        )
+
+    if trend_label is not None:
+        # 周趋势只是附带记录，写入失败不影响本次分析结果
+        try:
+            job.measure(
+                "record_trends", trends.record, trend_label,
+                results["profit_by_sku"], results["cancellation_rate_by_sku"], results["fee_summary"],
+            )
+        except Exception as e:
+            job.note("warning", f"写入周趋势库时出错：{e}")
+        else:
+            job.note("caption", f"本周结果已存入周趋势库（{trend_label}），共 {len(trends.weeks())} 周。")
+    elif trends is not None:
+        job.note(
+            "caption",
+            "参与分析的报表不在同一周内（或文件名中没有 20251103-1109 这样的期间），本次结果不计入周趋势。",
+        )
+
+    return {
+        "results": {name: results[name] for name in [*SUMMARY_TABLES, "summary_excel", "data_bundle"]},
+        "stage_timings": stage_timings,
+        "duplicates": duplicates.frame(),
+        "profiler": profiler,
+        "week_label": week_label,
+        "bundle_format": bundle_format,
+    }
+
+
+def new_stage_memo() -> StageMemo:
+    """网页使用的阶段缓存：单份报表的聚合表条目上限单独设置。"""
+    return StageMemo(
+        limits={"ingest": STAGE_CACHE_MAX_FILE_ENTRIES, **{name: STAGE_CACHE_MAX_ENTRIES for name in PIPELINE_STAGES}},
+    )
@@ -1,566 +1,300 @@
-import io
-from pathlib import Path
+import os
+import time
+from functools import partial
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
+from backends import DEFAULT_BACKEND, available_backends
+from cost_catalog import CostCatalog
+from ingest import DEFAULT_WORKERS
+from pipeline import (
+    AGGREGATE_FORMAT,
+    PARSED_REPORT_FORMAT,
+    content_hash,
+    describe_report_file,
+    file_bytes,
+)
+# 以下名称原先定义在 online.py 中，已移到 pipeline.py；在这里重新导出（见 __all__），保留旧的 online.xxx 导入路径
+from pipeline import (
+    COLUMN_MAP,
+    FEE_TYPE_MAP,
+    REASON_RETURNS,
+    REASON_SALES,
+    build_summary_excel,
+    compute_cancel_logistics_by_sku,
+    compute_cancellation_rate,
+    compute_fee_summary,
+    compute_final_overview,
+    compute_net_sales_by_sku,
+    compute_profit_by_sku,
+    compute_returns_by_sku,
+    compute_sales_by_sku,
+    compute_sales_logistics_by_sku,
+    load_cost_table,
+    load_week_data_from_upload,
+)
+from profiling import PROFILE_ENABLED, StageProfiler
+from report_cache import ReportCache
+from rollup_store import RollupStore
+from jobs import (
+    STAGE_CACHE_MAX_ENTRIES,
+    STAGE_CACHE_TTL,
+    STATUS_DONE,
+    STATUS_FAILED,
+    STATUS_QUEUED,
+    STATUS_RUNNING,
+    JobQueue,
+    StageMemo,
+    analysis_request_key,
+    new_stage_memo,
+    run_analysis_job,
+    snapshot_file,
+)
+from scenarios import SCENARIO_PARAM_NAMES_ZH, SCENARIO_PARAMS, ScenarioModel, sample_scenarios
+from service_client import (
+    SERVICE_URL,
+    RemoteCostCatalog,
+    RemoteJobQueue,
+    RemoteResults,
+    RemoteRollupStore,
+    RemoteTable,
+    RemoteTrendStore,
+    ServiceClient,
+    ServiceError,
+)
+from table_pages import DEFAULT_PAGE_SIZE, PAGE_SIZES, page_table, sku_column
+from trends import (
+    DEFAULT_WINDOW,
+    DEFAULT_Z,
+    METRIC_NAMES_ZH,
+    TREND_METRICS,
+    TrendStore,
+    detect_anomalies,
+)
+
+# 有意保留的重新导出（见上面第二个 from pipeline import），本文件自己不使用
+__all__ = [
+    "COLUMN_MAP",
+    "FEE_TYPE_MAP",
+    "REASON_RETURNS",
+    "REASON_SALES",
+    "build_summary_excel",
+    "compute_cancel_logistics_by_sku",
+    "compute_cancellation_rate",
+    "compute_fee_summary",
+    "compute_final_overview",
+    "compute_net_sales_by_sku",
+    "compute_profit_by_sku",
+    "compute_returns_by_sku",
+    "compute_sales_by_sku",
+    "compute_sales_logistics_by_sku",
+    "load_cost_table",
+    "load_week_data_from_upload",
+]
+
 # ==============================
-# 1. 字段映射 & 枚举配置
+# 12. Streamlit 缓存层：进程内共用的缓存、成本库和后台任务队列
 # ==============================
 
-COLUMN_MAP = {
-    "Обоснование для оплаты": "reason_for_payment",
-    "Виды логистики, штрафов и корректировок ВВ": "logistics_fee_type",
-    "Баркод": "barcode",
-    "Артикул поставщика": "supplier_sku",
-    "К перечислению Продавцу за реализованный Товар": "amount_payable_goods",
-    "Вайлдберриз реализовал Товар (Пр)": "wb_gmv",
-    "Цена розничная": "retail_price_total",
-    "Услуги по доставке товара покупателю": "delivery_to_customer",
-    "Общая сумма штрафов": "fine_total",
-    "Компенсация скидки по программе лояльности": "loyalty_discount_comp",
-    "Стоимость участия в программе лояльности": "loyalty_service_fee",
-    "Сумма удержанная за начисленные баллы программы лояльности": "loyalty_points_deduction",
-    "Кол-во": "quantity",
-    "Склад": "warehouse",
-}
-
-REASON_SALES = ["Продажа"]
-REASON_RETURNS = ["Возврат"]
-
-FEE_TYPE_MAP = {
-    "sales_logistics": {
-        "ru_types": ["К клиенту при продаже"],
-        "desc": "销售成功对应的正向物流费用",
-    },
-    "cancel_logistics_forward": {
-        "ru_types": ["К клиенту при отмене"],
-        "desc": "已发货但订单被取消，正向物流费用",
-    },
-    "cancel_logistics_backward": {
-        "ru_types": ["От клиента при отмене"],
-        "desc": "订单取消后，商品退回仓库的逆向物流费用",
-    },
-    "loyalty_points_deduction": {
-        "ru_types": ["Сумма удержанная за начисленные баллы программы лояльности"],
-        "desc": "为买家积累积分而从卖家账户扣除的金额",
-    },
-    "loyalty_service_fee": {
-        "ru_types": ["Стоимость участия в программе лояльности"],
-        "desc": "参与忠诚计划本身的服务费用",
-    },
-    "size_penalty": {
-        "ru_types": ["Занижение фактических габаритов упаковки товара"],
-        "desc": "因低报包装尺寸导致的罚款",
-    },
-    "defect_compensation": {
-        "ru_types": ["Компенсация скидки по программе лояльности"],
-        "desc": "平台对折扣/品质问题的某种补偿（暂按费用处理）",
-    },
-    "loyalty_refund_from_customer": {
-        "ru_types": ["От клиента при возврате"],
-        "desc": "与忠诚计划相关的客户返还/补偿",
-    },
-}
-
-FORWARD_CANCEL_TYPES = FEE_TYPE_MAP["cancel_logistics_forward"]["ru_types"]
-BACKWARD_CANCEL_TYPES = FEE_TYPE_MAP["cancel_logistics_backward"]["ru_types"]
+@st.cache_resource
+def get_report_cache() -> ReportCache:
+    """整个 Streamlit 进程共用一个解析缓存（命中/未命中计数也在进程内累计）。"""
+    return ReportCache(namespace=PARSED_REPORT_FORMAT)
 
 
-# ==============================
-# 2. 读 & 合并当前周上传的所有报表（第0步）
-# ==============================
+@st.cache_resource
+def get_rollup_store() -> RollupStore:
+    """服务模式下为服务端汇总库的只读视图（任务在服务端读取分区）。"""
+    if SERVICE_URL:
+        return RemoteRollupStore(ServiceClient(SERVICE_URL))
+    return RollupStore()
 
-def load_week_data_from_upload(files) -> pd.DataFrame:
-    """从网页上传的多个 .xlsx 中读取并合并为一个 DataFrame。"""
-    dfs = []
-    for f in files:
-        df_raw = pd.read_excel(f)
-        df = df_raw.rename(columns=COLUMN_MAP)
-        dfs.append(df)
-
-    combined_df = pd.concat(dfs, ignore_index=True)
-
-    for col in [
-        "amount_payable_goods",
-        "wb_gmv",
-        "retail_price_total",
-        "delivery_to_customer",
-        "fine_total",
-        "loyalty_discount_comp",
-        "loyalty_service_fee",
-        "loyalty_points_deduction",
-        "quantity",
-    ]:
-        if col not in combined_df.columns:
-            combined_df[col] = 0
-
-    return combined_df
 
+@st.cache_resource
+def get_cost_catalog() -> CostCatalog:
+    """服务模式下为服务端的成本库（提交任务时只传“使用成本库”，查询在服务端完成）。"""
+    if SERVICE_URL:
+        return RemoteCostCatalog(ServiceClient(SERVICE_URL))
+    return CostCatalog()
 
-# ==============================
-# 3. 步骤1：销售统计（按SKU）
-# ==============================
 
-def load_cost_table(cost_file) -> pd.DataFrame:
+@st.cache_resource
+def get_stage_memo() -> StageMemo:
     """
-    从上传的采购成本文件中读取 SKU 对应的单件采购成本。
-    文件要求至少两列：
-      - SKU 或 sku 或 barcode（任意一个）
-      - 采购成本 / cost / purchase_cost（任意一个）
+    各阶段的结果按 (阶段名, 上游输入的内容标识) 记忆，整个进程共用（后台任务之间也共用）。
+    这样只改周标签、或者从选择中去掉一份报表时，只重算真正依赖它的阶段。
     """
-    df = pd.read_excel(cost_file)
-
-    # 列名统一成小写方便匹配
-    col_map = {c: str(c).strip().lower() for c in df.columns}
-    df = df.rename(columns=col_map)
-
-    # 找 SKU 列
-    sku_col = None
-    for cand in ["sku", "barcode", "条码"]:
-        if cand in df.columns:
-            sku_col = cand
-            break
-    if sku_col is None:
-        raise ValueError("采购成本文件中找不到 SKU 列，请确保包含 'SKU' 或 'sku' 或 'barcode' 字段。")
-
-    # 找成本列
-    cost_col = None
-    for cand in ["采购成本", "cost", "purchase_cost"]:
-        if cand in df.columns:
-            cost_col = cand
-            break
-    if cost_col is None:
-        raise ValueError("采购成本文件中找不到成本列，请确保包含 '采购成本' 或 'cost' 字段。")
-
-    cost_df = df[[sku_col, cost_col]].copy()
-    cost_df = cost_df.rename(columns={
-        sku_col: "SKU",
-        cost_col: "unit_cost",
-    })
-
-    # 同一个 SKU 如果出现多次，取平均或者最大值，这里先用平均
-    cost_df = (
-        cost_df
-        .groupby("SKU", as_index=False)["unit_cost"]
-        .mean()
-    )
+    return new_stage_memo()
 
-    return cost_df
-def compute_profit_by_sku(net_sales_df: pd.DataFrame,
-                          sales_logistics_by_sku: pd.DataFrame,
-                          cancel_logistics_by_sku: pd.DataFrame,
-                          cost_df: pd.DataFrame) -> pd.DataFrame:
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
     """
-    生成 6 列的利润表：
-    SKU / 销售件数 / 商品应付金额 / 物流费用 / 采购成本 / 利润
+    设置了 WB_SERVICE_URL 时任务交给本机的分析服务（service.py）执行，多个会话、多个网页进程共用服务端的缓存；
+    否则在本进程的后台线程中执行。
     """
+    if SERVICE_URL:
+        return RemoteJobQueue(ServiceClient(SERVICE_URL))
+    return JobQueue()
 
-    # 1) 先从净销售表中取出需要的字段
-    base = net_sales_df.copy()
-
-    # 当前 net_sales_df 的结构是：SKU / 件数 / 商品应付金额 / 前台销售额 / 后台定价
-    base = base.rename(columns={
-        "件数": "sales_qty",
-        "商品应付金额": "amount_payable",
-    })
-
-    # 2) 合并销售物流费用
-    sales_log = sales_logistics_by_sku.rename(
-        columns={"barcode": "SKU"}
-    )[["SKU", "sales_logistics_sum"]].copy()
-
-    # 3) 合并取消/退货相关的物流费用（这里用 total_cancel_logistics）
-    cancel_log = cancel_logistics_by_sku.rename(
-        columns={"barcode": "SKU"}
-    )[["SKU", "total_cancel_logistics"]].copy()
-    cancel_log = cancel_log.rename(columns={"total_cancel_logistics": "cancel_logistics_sum"})
-
-    merged = (
-        base
-        .merge(sales_log, on="SKU", how="left")
-        .merge(cancel_log, on="SKU", how="left")
-    )
-
-    merged["sales_logistics_sum"] = merged["sales_logistics_sum"].fillna(0)
-    merged["cancel_logistics_sum"] = merged["cancel_logistics_sum"].fillna(0)
-
-    # 总物流费用 = 销售物流 + 取消/退货物流
-    merged["logistics_total"] = merged["sales_logistics_sum"] + merged["cancel_logistics_sum"]
-
-    # 4) 合并采购成本（单件成本）
-    cost_df = cost_df.copy()
-    merged = merged.merge(cost_df, on="SKU", how="left")
-    merged["unit_cost"] = merged["unit_cost"].fillna(0)
-
-    # 采购成本总额 = 单件成本 * 销售件数
-    merged["purchase_total"] = merged["unit_cost"] * merged["sales_qty"]
-
-    # 5) 计算利润
-    merged["profit"] = merged["amount_payable"] - merged["logistics_total"] - merged["purchase_total"]
-
-    # 6) 按你要的 6 列输出，并使用中文表头
-    profit_df = pd.DataFrame({
-        "SKU": merged["SKU"],
-        "销售件数": merged["sales_qty"],
-        "商品应付金额": merged["amount_payable"],
-        "物流费用": merged["logistics_total"],
-        "采购成本": merged["purchase_total"],
-        "利润": merged["profit"],
-    })
-
-    # 可以按利润或 SKU 排序，这里先按 SKU
-    profit_df = profit_df.sort_values("SKU")
-
-    return profit_df
-
-def compute_sales_by_sku(df: pd.DataFrame) -> pd.DataFrame:
-    sales_df = df[df["reason_for_payment"].isin(REASON_SALES)].copy()
-
-    grouped = (
-        sales_df
-        .groupby("barcode", dropna=False)
-        .agg(
-            sales_qty=("barcode", "count"),
-            amount_payable_sum=("amount_payable_goods", "sum"),
-            wb_gmv_sum=("wb_gmv", "sum"),
-            retail_price_sum=("retail_price_total", "sum"),
-        )
-        .reset_index()
-        .sort_values("barcode")
-    )
-
-    grouped["discount_rate"] = 1 - grouped["wb_gmv_sum"] / grouped["retail_price_sum"]
-    grouped["discount_rate"] = grouped["discount_rate"].round(4)
 
-    return grouped
+@st.cache_resource
+def get_trend_store() -> TrendStore:
+    """服务模式下为服务端周趋势库的只读视图（周趋势由服务端的任务写入）。"""
+    if SERVICE_URL:
+        return RemoteTrendStore(ServiceClient(SERVICE_URL))
+    return TrendStore()
 
 
-# ==============================
-# 4. 步骤2：退货统计（按SKU）
-# ==============================
-
-def compute_returns_by_sku(df: pd.DataFrame) -> pd.DataFrame:
-    returns_df = df[df["reason_for_payment"].isin(REASON_RETURNS)].copy()
-
-    grouped = (
-        returns_df
-        .groupby("barcode", dropna=False)
-        .agg(
-            return_qty=("barcode", "count"),
-            amount_return_sum=("amount_payable_goods", "sum"),
-            wb_gmv_return_sum=("wb_gmv", "sum"),
-            retail_price_return_sum=("retail_price_total", "sum"),
-        )
-        .reset_index()
-        .sort_values("barcode")
-    )
-    return grouped
-
-
-# ==============================
-# 5. 步骤3：净销售（销售 − 退货）
-# ==============================
-
-def compute_net_sales_by_sku(sales_by_sku: pd.DataFrame,
-                             returns_by_sku: pd.DataFrame) -> pd.DataFrame:
-    """
-    计算每个 SKU 的净销售，只输出净销售相关字段，并用中文表头：
-    SKU、件数、商品应付金额、前台销售额、后台定价
-    """
-    merged = pd.merge(
-        sales_by_sku,
-        returns_by_sku,
-        on="barcode",
-        how="outer",
-    ).fillna(0)
-
-    # 计算净值
-    merged["net_qty"] = merged["sales_qty"] - merged["return_qty"]
-    merged["net_amount_payable"] = merged["amount_payable_sum"] - merged["amount_return_sum"]
-    merged["net_wb_gmv"] = merged["wb_gmv_sum"] - merged["wb_gmv_return_sum"]
-    merged["net_retail_price"] = merged["retail_price_sum"] - merged["retail_price_return_sum"]
-
-    # 只保留需要的列
-    net_df = merged[["barcode", "net_qty", "net_amount_payable", "net_wb_gmv", "net_retail_price"]].copy()
-
-    # 重命名为中文表头
-    net_df = net_df.rename(columns={
-        "barcode": "SKU",
-        "net_qty": "件数",
-        "net_amount_payable": "商品应付金额",
-        "net_wb_gmv": "前台销售额",
-        "net_retail_price": "后台定价",
-    })
-
-    # 按 SKU 排序
-    net_df = net_df.sort_values("SKU")
-
-    # 在表格首行添加总计
-    total_row = {
-        "SKU": "总计",
-        "件数": net_df["件数"].sum(),
-        "商品应付金额": net_df["商品应付金额"].sum(),
-        "前台销售额": net_df["前台销售额"].sum(),
-        "后台定价": net_df["后台定价"].sum(),
-    }
-    net_df = pd.concat(
-        [pd.DataFrame([total_row]), net_df],
-        ignore_index=True,
-    )
-
-    return net_df
+@st.cache_resource(max_entries=2)
+def load_trend_matrix(version: str):
+    """周趋势库的 SKU × 周 矩阵；version 变化（有新的一周写入）时重新读取。"""
+    return get_trend_store().matrix()
 
 
+@st.cache_data(max_entries=16)
+def trend_anomalies(version: str, week: str, window: int, z_threshold: float) -> pd.DataFrame:
+    return detect_anomalies(load_trend_matrix(version), week=week, window=window, z_threshold=z_threshold)
 
-# ==============================
-# 6. 步骤4：销售物流费用（按SKU）
-# ==============================
 
-def compute_sales_logistics_by_sku(df: pd.DataFrame) -> pd.DataFrame:
-    log_df = df[df["logistics_fee_type"].isin(FEE_TYPE_MAP["sales_logistics"]["ru_types"])].copy()
-    log_df = log_df[log_df["delivery_to_customer"] != 0]
+@st.cache_resource(max_entries=4)
+def load_scenario_model(job_id: str) -> ScenarioModel:
+    """情景模型按任务建立一次，直接使用任务结果中的利润表、取消物流表和费用汇总。"""
+    return ScenarioModel.from_results(get_job_queue().get(job_id).result["results"])
 
-    grouped = (
-        log_df
-        .groupby("barcode", dropna=False)
-        .agg(
-            sales_logistics_count=("barcode", "count"),
-            sales_logistics_sum=("delivery_to_customer", "sum"),
-        )
-        .reset_index()
-        .sort_values("barcode")
-    )
 
-    grouped["sales_logistics_per_unit"] = (
-        grouped["sales_logistics_sum"] / grouped["sales_logistics_count"]
-    ).round(4)
+@st.cache_data(max_entries=16)
+def run_scenarios(job_id: str, ranges: tuple, n: int, seed: int):
+    result = load_scenario_model(job_id).evaluate(sample_scenarios(n, dict(ranges), seed=seed))
+    return result.scenarios, result.summary, result.by_sku
 
-    return grouped
 
+def render_stage_cache_stats():
+    # 任务在分析服务中执行时，命中统计也在服务端
+    if SERVICE_URL:
+        stats, where = pd.DataFrame(get_job_queue().client.stats()["stage_cache"]), "分析服务"
+    else:
+        stats, where = get_stage_memo().stats_frame(), "本进程"
+    with st.expander(f"缓存命中统计（{where}）"):
+        if stats.empty:
+            st.caption("暂无记录。")
+            return
+        st.dataframe(stats, use_container_width=True, hide_index=True)
+        st.caption(f"各阶段结果缓存 {STAGE_CACHE_TTL} 秒，每个阶段最多保留 {STAGE_CACHE_MAX_ENTRIES} 份。")
+
+
+PROFILE_COLUMNS_ZH = {
+    "stage": "阶段",
+    "seconds": "耗时（秒）",
+    "runs": "执行次数",
+    "rows_in": "输入行数",
+    "rows_out": "输出行数",
+    "peak_rss_mb": "RSS 峰值（MB）",
+    "rss_delta_mb": "RSS 增量（MB）",
+    "output_mb": "结果表内存（MB）",
+}
 
-# ==============================
-# 7. 步骤5：取消订单物流费用（按SKU）
-# ==============================
 
-def compute_cancel_logistics_by_sku(df: pd.DataFrame) -> pd.DataFrame:
-    forward_df = df[df["logistics_fee_type"].isin(FORWARD_CANCEL_TYPES)].copy()
-    backward_df = df[df["logistics_fee_type"].isin(BACKWARD_CANCEL_TYPES)].copy()
+def render_performance_panel(timings, profiler: StageProfiler, week_label: str):
+    with st.expander("性能"):
+        if not profiler.enabled:
+            df = pd.DataFrame(timings).rename(columns=PROFILE_COLUMNS_ZH)
+            st.dataframe(df, use_container_width=True, hide_index=True)
+            st.caption("性能记录已关闭，只显示各阶段耗时。命中缓存的阶段耗时接近 0。")
+            return
 
-    forward_g = (
-        forward_df
-        .groupby("barcode", dropna=False)
-        .agg(
-            forward_count=("barcode", "count"),
-            forward_logistics_sum=("delivery_to_customer", "sum"),
+        st.dataframe(profiler.summary().rename(columns=PROFILE_COLUMNS_ZH), use_container_width=True, hide_index=True)
+        st.caption(
+            "命中缓存的阶段耗时接近 0；RSS 为整个 Streamlit 进程的常驻内存，"
+            "其它会话同时运行时会互相影响。结果表内存为 DataFrame.memory_usage(deep=True)。"
         )
-        .reset_index()
-    )
-
-    backward_g = (
-        backward_df
-        .groupby("barcode", dropna=False)
-        .agg(
-            backward_count=("barcode", "count"),
-            backward_logistics_sum=("delivery_to_customer", "sum"),
+        st.download_button(
+            label="📈 下载性能数据（JSON）",
+            data=profiler.to_json(week_label=week_label, created=time.strftime("%Y-%m-%d %H:%M:%S")),
+            file_name=f"{week_label}_profile.json",
+            mime="application/json",
         )
-        .reset_index()
-    )
-
-    merged = pd.merge(forward_g, backward_g, on="barcode", how="outer").fillna(0)
-
-    merged["total_cancel_records"] = merged["forward_count"] + merged["backward_count"]
-    merged["cancel_qty"] = merged["total_cancel_records"] / 2
-
-    merged["total_cancel_logistics"] = (
-        merged["forward_logistics_sum"] + merged["backward_logistics_sum"]
-    )
-
-    merged["cancel_logistics_per_unit"] = merged["total_cancel_logistics"] / merged["cancel_qty"]
-    merged.loc[merged["cancel_qty"] == 0, "cancel_logistics_per_unit"] = 0
-    merged["cancel_logistics_per_unit"] = merged["cancel_logistics_per_unit"].round(4)
-
-    return merged.sort_values("barcode")
-
-
-# ==============================
-# 8. 步骤6：每个 SKU 的取消率
-# ==============================
-
-def compute_cancellation_rate(sales_by_sku: pd.DataFrame,
-                              cancel_log_by_sku: pd.DataFrame) -> pd.DataFrame:
-    merged = pd.merge(
-        sales_by_sku[["barcode", "sales_qty"]],
-        cancel_log_by_sku[["barcode", "cancel_qty"]],
-        on="barcode",
-        how="outer",
-    ).fillna(0)
-
-    merged["total_orders"] = merged["sales_qty"] + merged["cancel_qty"]
-    merged["cancellation_rate"] = merged["cancel_qty"] / merged["total_orders"]
-    merged.loc[merged["total_orders"] == 0, "cancellation_rate"] = 0
-    merged["cancellation_rate"] = merged["cancellation_rate"].round(4)
-
-    return merged.sort_values("barcode")
 
 
 # ==============================
-# 9. 步骤7：费用分类汇总
+# 13. Streamlit 网页界面
 # ==============================
 
-def compute_fee_summary(df: pd.DataFrame,
-                        profit_by_sku: pd.DataFrame) -> pd.DataFrame:
+# 结果 tab：(标题, 流水线阶段名)
+RESULT_TABS = [
+    ("1️⃣ 销售按SKU", "sales_by_sku"),
+    ("2️⃣ 退货按SKU", "returns_by_sku"),
+    ("3️⃣ 净销售按SKU", "net_sales_by_sku"),
+    ("4️⃣ 销售物流费用", "sales_logistics_by_sku"),
+    ("5️⃣ 取消订单物流", "cancel_logistics_by_sku"),
+    ("6️⃣ SKU 取消率", "cancellation_rate_by_sku"),
+    ("7️⃣ 费用汇总", "fee_summary"),
+    ("8️⃣ Final Overview", "overview"),
+    ("9️⃣ 净利润按SKU", "profit_by_sku"),
+    ("🔟 未归类费用", "unmapped_fee_types"),
+    ("🏬 仓库×区域物流", "logistics_by_warehouse_region"),
+    ("🏬 单件物流（按仓库）", "logistics_per_unit_by_warehouse"),
+]
+DEFAULT_ORDER = "（默认顺序）"
+
+
+def upload_hashes(files) -> dict:
     """
-    费用汇总表：
-      只保留两列：description / total_fee
-      行包括：
-        - 各费用类别（物流、罚款、忠诚计划等）
-        - 采购成本（来自净利润表）
-        - 总费用（以上全部之和）
+    上传报表的内容哈希（file_id -> 哈希）。页面每次重跑都会用到，哈希按 file_id 记在 session_state 中，
+    每份上传只读取、计算一次；只保留仍在上传列表中的文件。
     """
-    rows = []
-
-    # 1) 各费用类别（不包含采购成本）
-    for cat, info in FEE_TYPE_MAP.items():
-        ru_types = info["ru_types"]
-        sub = df[df["logistics_fee_type"].isin(ru_types)].copy()
-        if sub.empty:
-            fine_sum = 0
-            loyalty_service_sum = 0
-            loyalty_points_sum = 0
-            logistics_sum = 0
-        else:
-            fine_sum = sub["fine_total"].sum()
-            loyalty_service_sum = sub["loyalty_service_fee"].sum()
-            loyalty_points_sum = sub["loyalty_points_deduction"].sum()
-            logistics_sum = sub["delivery_to_customer"].sum()
-
-        # total_fee = 真正的费用：罚款 + 忠诚服务费 + 积分扣费 + 物流费用
-        total_fee = (
-            fine_sum
-            + loyalty_service_sum
-            + loyalty_points_sum
-            + logistics_sum
-        )
-
-        rows.append({
-            "description": info["desc"],
-            "total_fee": total_fee,
-        })
-
-    # 2) 采购成本：来自净利润表中的“采购成本”列
-    if "采购成本" in profit_by_sku.columns:
-        purchase_total = float(profit_by_sku["采购成本"].sum())
-    else:
-        purchase_total = 0.0
-
-    rows.append({
-        "description": "采购成本",
-        "total_fee": purchase_total,
-    })
-
-    # 3) 总费用 = 上面所有 total_fee 之和
-    total_all = sum(r["total_fee"] for r in rows)
-
-    rows.append({
-        "description": "总费用",
-        "total_fee": total_all,
-    })
+    known = st.session_state.get("upload_hashes", {})
+    hashes = {f.file_id: known.get(f.file_id) or content_hash(file_bytes(f)) for f in files}
+    st.session_state["upload_hashes"] = hashes
+    return hashes
 
-    fee_df = pd.DataFrame(rows, columns=["description", "total_fee"])
 
-    return fee_df
+def _reset_page(page_key: str):
+    st.session_state[page_key] = 1
 
 
-
-# ==============================
-# 10. 步骤8：总览 & 平台应付金额
-# ==============================
-
-def compute_final_overview(df: pd.DataFrame,
-                           fee_summary: pd.DataFrame) -> pd.DataFrame:
-    sales_df = df[df["reason_for_payment"].isin(REASON_SALES)]
-    returns_df = df[df["reason_for_payment"].isin(REASON_RETURNS)]
-
-    total_sales_qty = len(sales_df)
-    total_return_qty = len(returns_df)
-
-    total_sales_amount = sales_df["amount_payable_goods"].sum()
-    total_return_amount = returns_df["amount_payable_goods"].sum()
-
-    net_sales_amount = total_sales_amount - total_return_amount
-
-    total_fee_amount = float(
-          fee_summary.loc[fee_summary["description"] == "总费用", "total_fee"].iloc[0]
+def render_table_page(df, key: str):
+    """
+    按 SKU 的结果表在服务端搜索、排序、分页，浏览器只收到当前页；其它小表直接显示。
+    df 为 RemoteTable（分析服务上的结果表）时由分析服务分页，本进程也只收到当前页。
+    """
+    remote = isinstance(df, RemoteTable)
+    if sku_column(df) is None:
+        st.dataframe(df.frame() if remote else df, use_container_width=True)
+        return
+
+    page_key = f"{key}_page"
+    col_search, col_sort, col_desc, col_size = st.columns([3, 3, 1, 2])
+    search = col_search.text_input(
+        "搜索 SKU", key=f"{key}_search", on_change=_reset_page, args=(page_key,),
     )
-    final_payable_amount = net_sales_amount - total_fee_amount
-
-    overview = pd.DataFrame(
-        [
-            {"metric": "total_sales_qty", "value": total_sales_qty},
-            {"metric": "total_return_qty", "value": total_return_qty},
-            {"metric": "total_sales_amount", "value": total_sales_amount},
-            {"metric": "total_return_amount", "value": total_return_amount},
-            {"metric": "net_sales_amount", "value": net_sales_amount},
-            {"metric": "total_fee_amount", "value": total_fee_amount},
-            {"metric": "final_payable_amount", "value": final_payable_amount},
-        ]
+    sort_by = col_sort.selectbox(
+        "排序", [DEFAULT_ORDER, *df.columns], key=f"{key}_sort", on_change=_reset_page, args=(page_key,),
+    )
+    descending = col_desc.checkbox("降序", key=f"{key}_desc", on_change=_reset_page, args=(page_key,))
+    page_size = col_size.selectbox(
+        "每页行数", PAGE_SIZES, index=PAGE_SIZES.index(DEFAULT_PAGE_SIZE),
+        key=f"{key}_size", on_change=_reset_page, args=(page_key,),
     )
 
-    # 英文指标 -> 中文名称
-    metric_zh_map = {
-        "total_sales_qty": "销售件数",
-        "total_return_qty": "退货件数",
-        "total_sales_amount": "销售结算金额（含退货前）",
-        "total_return_amount": "退货结算金额",
-        "net_sales_amount": "净销售结算金额",
-        "total_fee_amount": "费用总额",
-        "final_payable_amount": "平台最终应付金额",
-    }
-
-    overview["metric_zh"] = overview["metric"].map(metric_zh_map)
-
-    # 调整列顺序：中文放前面
-    overview = overview[["metric_zh", "metric", "value"]]
-
-    return overview
-
-
-
-# ==============================
-# 11. 生成 summary.xlsx 供下载
-# ==============================
-
-def build_summary_excel(week_label: str,
-                        sales_by_sku: pd.DataFrame,
-                        returns_by_sku: pd.DataFrame,
-                        net_sales_by_sku: pd.DataFrame,
-                        sales_logistics_by_sku: pd.DataFrame,
-                        cancel_logistics_by_sku: pd.DataFrame,
-                        cancellation_rate_by_sku: pd.DataFrame,
-                        fee_summary: pd.DataFrame,
-                        overview: pd.DataFrame,
-                        profit_by_sku: pd.DataFrame) -> bytes:
-
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        sales_by_sku.to_excel(writer, sheet_name="Sales_by_SKU", index=False)
-        returns_by_sku.to_excel(writer, sheet_name="Returns_by_SKU", index=False)
-        net_sales_by_sku.to_excel(writer, sheet_name="Net_Sales_by_SKU", index=False)
-        sales_logistics_by_sku.to_excel(writer, sheet_name="Logistics_Sales", index=False)
-        cancel_logistics_by_sku.to_excel(writer, sheet_name="Logistics_Cancellations", index=False)
-        cancellation_rate_by_sku.to_excel(writer, sheet_name="Cancellation_Rate", index=False)
-        fee_summary.to_excel(writer, sheet_name="Fee_Summary", index=False)
-        overview.to_excel(writer, sheet_name="Final_Overview", index=False)
-        profit_by_sku.to_excel(writer, sheet_name="Profit_by_SKU", index=False)
-
-    output.seek(0)
-    return output.getvalue()
+    page_df, matched, pages = (df.page if remote else partial(page_table, df))(
+        search=search,
+        sort_by=None if sort_by == DEFAULT_ORDER else sort_by,
+        descending=descending,
+        page=st.session_state.get(page_key, 1),
+        page_size=page_size,
+    )
+    st.dataframe(page_df, use_container_width=True)
 
+    # 搜索结果变少时，先把页码收回到有效范围，再创建页码控件
+    if st.session_state.get(page_key, 1) > pages:
+        st.session_state[page_key] = pages
+    col_page, col_info = st.columns([1, 3])
+    col_page.number_input("页码", min_value=1, max_value=pages, step=1, key=page_key)
+    col_info.caption(f"共 {matched} 行，{pages} 页，每页 {page_size} 行。")
 
-# ==============================
-# 12. Streamlit 网页界面
-# ==============================
 
 def main():
     st.set_page_config(page_title="WB 每周财务报表分析", layout="wide")
@@ -572,10 +306,43 @@ def main():
         使用说明：
         1. 在下方上传本周的 **2 份 WB 财务报表**（境内 + 境外），均为 `.xlsx` 格式；
         2. 输入对应的周标签（例如：`0311-0911`）；
-        3. 点击“开始分析”，稍等即可查看各个结果表；
+        3. 点击“开始分析”，分析在后台进行，页面显示进度，完成后即可查看各个结果表；
         4. 可以在页面底部 **下载 summary.xlsx** 保存。
         """
     )
+    ingest_workers = st.sidebar.number_input(
+        "解析进程数（多份报表并行解析）",
+        min_value=1,
+        max_value=max(os.cpu_count() or 1, 1),
+        value=min(DEFAULT_WORKERS, max(os.cpu_count() or 1, 1)),
+        step=1,
+    )
+
+    profile_enabled = st.sidebar.checkbox("记录各阶段性能数据（“性能”面板）", value=PROFILE_ENABLED)
+    bundle_choice = st.sidebar.selectbox(
+        "额外导出数据包（每张表一个文件，打包为 zip）",
+        ["不导出", "Parquet", "CSV"],
+    )
+    bundle_format = None if bundle_choice == "不导出" else bundle_choice.lower()
+
+    backends = available_backends()
+    compute_backend = st.sidebar.selectbox(
+        "计算后端（多周合并、按 SKU 分组求和）",
+        backends,
+        index=backends.index(DEFAULT_BACKEND) if DEFAULT_BACKEND in backends else 0,
+    )
+
+    out_of_core = st.sidebar.checkbox(
+        "大数据量模式（全年报表：逐份累加、必要时写入临时文件，内存占用有上限）", value=False,
+    )
+
+    use_cost_catalog = st.sidebar.checkbox(
+        "使用本地采购成本库（上传的成本文件导入后长期保存，之后无需重复上传）", value=False,
+    )
+    cost_effective = st.sidebar.date_input(
+        "成本文件生效日期（留空表示一直有效）", value=None, disabled=not use_cost_catalog,
+    )
+
     week_label = st.text_input("本次分析的名称/标签（例如：20251103-1109 或 Q4汇总）", value="20251103-1109")
 
     uploaded_files = st.file_uploader(
@@ -591,19 +358,8 @@ def main():
         st.markdown("### 已上传的文件")
         file_info_rows = []
         for f in uploaded_files:
-            name = f.name
-            stem = Path(name).stem
-            # 简单从文件名里识别“境内/境外”和时间段（可根据你的命名规则调整）
-            if "境内" in stem:
-                region = "境内"
-                period = stem.replace("境内", "")
-            elif "境外" in stem:
-                region = "境外"
-                period = stem.replace("境外", "")
-            else:
-                region = "未知"
-                period = stem
-            file_info_rows.append({"文件名": name, "期间": period, "区域": region})
+            info = describe_report_file(f.name)
+            file_info_rows.append({"文件名": f.name, "期间": info["period"], "区域": info["region"]})
 
         st.dataframe(pd.DataFrame(file_info_rows), use_container_width=True)
 
@@ -616,152 +372,344 @@ def main():
         )
         selected_files = [f for f in uploaded_files if f.name in selected_labels]
 
+    # 汇总库中已存的历史周：无需重新上传，直接参与本次汇总
+    rollup_store = get_rollup_store()
+    hashes = upload_hashes(uploaded_files or [])
+    uploaded_keys = {f"{AGGREGATE_FORMAT}-{digest}" for digest in hashes.values()}
+    stored = rollup_store.partitions()
+    stored = stored[
+        stored["key"].str.startswith(f"{AGGREGATE_FORMAT}-") & ~stored["key"].isin(uploaded_keys)
+    ]
+    stored_keys = []
+    if not stored.empty:
+        stored_labels = {
+            f"{row.period}（{row.region}，{row.file_name}）": row.key
+            for row in stored.itertuples()
+        }
+        picked_labels = st.multiselect(
+            "从汇总库中加入历史周（之前分析过的报表，无需重新上传）",
+            list(stored_labels),
+        )
+        stored_keys = [stored_labels[label] for label in picked_labels]
+
     cost_file = st.file_uploader(
     "上传采购成本文件（两列：SKU / 采购成本）",
     type=["xlsx"],
     accept_multiple_files=False,
     )
-
+    cost_catalog = get_cost_catalog() if use_cost_catalog else None
+    if cost_catalog is not None:
+        catalog_skus = len(cost_catalog)
+        if catalog_skus:
+            where = "分析服务的采购成本库" if SERVICE_URL else "本地采购成本库"
+            st.caption(f"{where}中已有 {catalog_skus} 个 SKU 的成本，上传的成本文件中没有的 SKU 使用成本库。")
+
+    job_queue = get_job_queue()
     if st.button("开始分析"):
 
-        if not selected_files:
+        if not selected_files and not stored_keys:
             st.error("请先上传文件并在列表中选择至少 1 份要分析的报表。")
             return
 
-        # 第0步：只合并“被你选中”的文件
-        df = load_week_data_from_upload(selected_files)
-
-        st.success(f"已成功读取 {len(selected_files)} 个文件，合并后共有 {len(df)} 行记录。")
-
-        # 步骤1～5计算
-        sales_by_sku = compute_sales_by_sku(df)
-        returns_by_sku = compute_returns_by_sku(df)
-        net_sales_by_sku = compute_net_sales_by_sku(sales_by_sku, returns_by_sku)
-        sales_logistics_by_sku = compute_sales_logistics_by_sku(df)
-        cancel_logistics_by_sku = compute_cancel_logistics_by_sku(df)
-        cancellation_rate_by_sku = compute_cancellation_rate(sales_by_sku, cancel_logistics_by_sku)
-        # 2) 处理采购成本表
-        if cost_file is not None:
-            try:
-                cost_df = load_cost_table(cost_file)
-            except Exception as e:
-                st.error(f"读取采购成本文件时出错：{e}")
-                cost_df = pd.DataFrame(columns=["SKU", "unit_cost"])
-        else:
-            st.warning("未上传采购成本文件，本次利润计算中的采购成本将视为 0。")
-            cost_df = pd.DataFrame(columns=["SKU", "unit_cost"])
-
-        # 3) 计算利润表（这里的 net_sales_by_sku 已经是中文表头版本）
-        profit_by_sku = compute_profit_by_sku(
-            net_sales_by_sku,
-            sales_logistics_by_sku,
-            cancel_logistics_by_sku,
-            cost_df,
+        # 解析、聚合、步骤1～8 和导出都在后台任务中执行，页面只轮询进度；
+        # 上传的文件先复制一份，任务执行期间在页面上增删文件不受影响。
+        # 副本带上已算好的内容哈希，请求标识和任务中的分区键都不再重新计算
+        reports = [snapshot_file(f, hashes[f.file_id]) for f in selected_files]
+        cost_copy = snapshot_file(cost_file)
+        # 服务模式下相同请求的合并由服务端完成，这里不必再为请求计算内容标识
+        coalesce_key = None if SERVICE_URL else analysis_request_key(
+            reports, stored_keys, cost_copy, week_label, bundle_format,
+            cost_catalog=cost_catalog, cost_effective=cost_effective, out_of_core=out_of_core,
+            backend=compute_backend, profile=profile_enabled,
         )
+        try:
+            st.session_state["job_id"] = job_queue.submit(
+                run_analysis_job,
+                reports,
+                stored_keys,
+                cost_copy,
+                week_label,
+                bundle_format,
+                store=rollup_store,
+                memo=get_stage_memo(),
+                cache=get_report_cache(),
+                workers=int(ingest_workers),
+                cost_catalog=cost_catalog,
+                cost_effective=cost_effective,
+                profile=profile_enabled,
+                out_of_core=out_of_core,
+                backend=compute_backend,
+                trends=get_trend_store(),
+                label=week_label,
+                meta={"bundle_choice": bundle_choice},
+                # 同样的请求（其它会话刚提交过、或已经算完）直接复用已有任务
+                coalesce_key=coalesce_key,
+            )
+        except ServiceError as e:
+            st.error(f"提交分析任务失败：{e.detail}")
+            return
 
-        # 4) 费用汇总（把采购成本也算进去）
-        fee_summary = compute_fee_summary(df, profit_by_sku)
-
-        # 5) 总览（使用新的 fee_summary）
-        overview = compute_final_overview(df, fee_summary)
-
-        # 顶部总览指标
-        st.subheader("本周关键指标总览")
-        col1, col2, col3, col4 = st.columns(4)
-        total_sales_qty = int(overview.loc[overview["metric"] == "total_sales_qty", "value"].iloc[0])
-        total_return_qty = int(overview.loc[overview["metric"] == "total_return_qty", "value"].iloc[0])
-        net_sales_amount = float(overview.loc[overview["metric"] == "net_sales_amount", "value"].iloc[0])
-        final_payable_amount = float(overview.loc[overview["metric"] == "final_payable_amount", "value"].iloc[0])
-
-        col1.metric("销售件数", total_sales_qty)
-        col2.metric("退货件数", total_return_qty)
-        col3.metric("净销售结算金额", f"{net_sales_amount:,.2f} ₽")
-        col4.metric("平台最终应付金额", f"{final_payable_amount:,.2f} ₽")
-
-        # 处理采购成本表（如果没上传，则成本视为 0）
-        if cost_file is not None:
-            try:
-                cost_df = load_cost_table(cost_file)
-            except Exception as e:
-                st.error(f"读取采购成本文件时出错：{e}")
-                cost_df = pd.DataFrame(columns=["SKU", "unit_cost"])
-        else:
-            st.warning("未上传采购成本文件，本次利润计算中的采购成本将视为 0。")
-            cost_df = pd.DataFrame(columns=["SKU", "unit_cost"])
-
-        # 计算利润表
-        profit_by_sku = compute_profit_by_sku(
-            net_sales_by_sku,
-            sales_logistics_by_sku,
-            cancel_logistics_by_sku,
-            cost_df,
-        )
+    job = pick_job(job_queue)
+    if job is None:
+        return
+    if job.status in (STATUS_QUEUED, STATUS_RUNNING):
+        render_job_progress(job.id)
+    elif job.status == STATUS_FAILED:
+        st.error(f"分析任务 {job.id} 失败：{job.error}")
+        render_job_steps(job)
+    else:
+        for level, text in job.notes:
+            getattr(st, level)(text)
+        render_analysis({**job.result, "bundle_choice": job.meta.get("bundle_choice"), "job_id": job.id})
 
-        
-        # 多个 tab 显示明细
-        st.subheader("明细表")
-        tabs = st.tabs([
-            "1️⃣ 销售按SKU",
-            "2️⃣ 退货按SKU",
-            "3️⃣ 净销售按SKU",
-            "4️⃣ 销售物流费用",
-            "5️⃣ 取消订单物流",
-            "6️⃣ SKU 取消率",
-            "7️⃣ 费用汇总",
-            "8️⃣ Final Overview",
-            "9️⃣ 净利润按SKU",
-        ])
-
-        with tabs[0]:
-            st.dataframe(sales_by_sku, use_container_width=True)
-
-        with tabs[1]:
-            st.dataframe(returns_by_sku, use_container_width=True)
-
-        with tabs[2]:
-            st.dataframe(net_sales_by_sku, use_container_width=True)
-
-        with tabs[3]:
-            st.dataframe(sales_logistics_by_sku, use_container_width=True)
-
-        with tabs[4]:
-            st.dataframe(cancel_logistics_by_sku, use_container_width=True)
-
-        with tabs[5]:
-            st.dataframe(cancellation_rate_by_sku, use_container_width=True)
-
-        with tabs[6]:
-            st.dataframe(fee_summary, use_container_width=True)
-
-        with tabs[7]:
-            st.dataframe(overview, use_container_width=True)
-        with tabs[8]:
-            st.dataframe(profit_by_sku, use_container_width=True)
-
-
-        # 下载 summary.xlsx
-        st.subheader("下载周报 Excel 总结")
-
-        excel_bytes = build_summary_excel(
-            week_label,
-            sales_by_sku,
-            returns_by_sku,
-            net_sales_by_sku,
-            sales_logistics_by_sku,
-            cancel_logistics_by_sku,
-            cancellation_rate_by_sku,
-            fee_summary,
-            overview,
-            profit_by_sku,
+
+JOB_STATUS_ZH = {
+    STATUS_QUEUED: "排队中",
+    STATUS_RUNNING: "运行中",
+    STATUS_DONE: "已完成",
+    STATUS_FAILED: "失败",
+}
+
+
+def _job_title(job) -> str:
+    created = time.strftime("%m-%d %H:%M:%S", time.localtime(job.created))
+    return f"#{job.id.rsplit('-', 1)[-1]} {job.label}（{created}，{JOB_STATUS_ZH[job.status]}）"
+
+
+def pick_job(job_queue: JobQueue):
+    """本次要展示的任务：默认是刚提交的任务，也可以切换到之前的任务直接查看结果。"""
+    jobs = job_queue.jobs()
+    if not jobs:
+        return None
+    ids = [job.id for job in jobs]
+    current = st.session_state.get("job_id")
+    if current not in ids:
+        current = None
+    if len(jobs) > 1:
+        titles = [_job_title(job) for job in jobs]
+        title = st.selectbox(
+            "分析任务（之前的任务结果已保存，切换后无需重新计算）",
+            titles,
+            index=ids.index(current) if current is not None else 0,
         )
+        current = ids[titles.index(title)]
+        st.session_state["job_id"] = current
+    if current is None:
+        return None
+    return job_queue.get(current)
+
+
+def render_job_steps(job):
+    steps = job.steps_frame()
+    if not steps.empty:
+        steps = steps.rename(columns={"stage": "阶段", "runs": "已开始", "done": "已完成", "seconds": "耗时（秒）"})
+        st.dataframe(steps, use_container_width=True, hide_index=True)
+
+
+@st.fragment(run_every=1.0)
+def render_job_progress(job_id: str):
+    """每秒刷新一次进度；任务结束后整页重跑一次，显示结果。"""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return
+    if job.status not in (STATUS_QUEUED, STATUS_RUNNING):
+        st.rerun()
+    progress = job.progress()
+    if job.status == STATUS_QUEUED:
+        text = "排队中，等待前面的分析任务完成……"
+    else:
+        text = f"正在执行：{progress['current'] or '准备中'}（{progress['done']}/{progress['total']} 步，已用 {job.elapsed():.1f} 秒）"
+    st.progress(progress["fraction"], text=text)
+    render_job_steps(job)
+
+
+def render_analysis(analysis: dict):
+    results = analysis["results"]
+    week_label = analysis["week_label"]
+    overview = results["overview"]
+
+    # 顶部总览指标
+    st.subheader("本周关键指标总览")
+    col1, col2, col3, col4 = st.columns(4)
+    total_sales_qty = int(overview.loc[overview["metric"] == "total_sales_qty", "value"].iloc[0])
+    total_return_qty = int(overview.loc[overview["metric"] == "total_return_qty", "value"].iloc[0])
+    net_sales_amount = float(overview.loc[overview["metric"] == "net_sales_amount", "value"].iloc[0])
+    final_payable_amount = float(overview.loc[overview["metric"] == "final_payable_amount", "value"].iloc[0])
+
+    col1.metric("销售件数", total_sales_qty)
+    col2.metric("退货件数", total_return_qty)
+    col3.metric("净销售结算金额", f"{net_sales_amount:,.2f} ₽")
+    col4.metric("平台最终应付金额", f"{final_payable_amount:,.2f} ₽")
+
+    unmapped = results["unmapped_fee_types"]
+    if len(unmapped):
+        st.warning(
+            f"报表中有 {len(unmapped)} 种费用类型不在 FEE_TYPE_MAP 中"
+            f"（共 {int(unmapped['rows'].sum())} 行，合计 {unmapped['total_fee'].sum():,.2f} ₽），"
+            "未计入费用汇总，明细见“🔟 未归类费用”。"
+        )
+
+    # 每份报表的去重结果：重复上传的文件、与前面的报表重叠而删除的行
+    duplicates = analysis.get("duplicates")
+    if duplicates is not None and len(duplicates):
+        removed = int(duplicates["删除行数"].sum())
+        with st.expander(f"重复上传检测（共删除 {removed} 行）", expanded=removed > 0):
+            st.dataframe(duplicates, use_container_width=True, hide_index=True)
+
+    # 多个 tab 显示明细：只渲染当前选中的 tab，按 SKU 的表只发送当前页
+    st.subheader("明细表")
+    tabs = st.tabs([label for label, _ in RESULT_TABS], on_change="rerun", key="result_tab")
+    for tab, (_, name) in zip(tabs, RESULT_TABS):
+        if tab.open:
+            with tab:
+                table = results.table(name) if isinstance(results, RemoteResults) else results[name]
+                render_table_page(table, key=name)
+
+    # 下载 summary.xlsx（服务模式下点击时才向服务下载）
+    st.subheader("下载周报 Excel 总结")
+
+    st.download_button(
+        label="📥 下载 summary.xlsx",
+        data=lambda: results["summary_excel"],
+        file_name=f"{week_label}_summary.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
 
+    if analysis["bundle_format"] is not None:
         st.download_button(
-            label="📥 下载 summary.xlsx",
-            data=excel_bytes,
-            file_name=f"{week_label}_summary.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            label=f"📦 下载数据包（{analysis['bundle_choice']}，zip）",
+            data=lambda: results["data_bundle"],
+            file_name=f"{week_label}_{analysis['bundle_format']}.zip",
+            mime="application/zip",
         )
 
+    render_trends(week_label)
+    render_scenarios(analysis["job_id"])
+    render_stage_cache_stats()
+    render_performance_panel(analysis["stage_timings"], analysis["profiler"], week_label)
+
+
+ANOMALY_COLUMNS_ZH = {
+    "metric": "指标",
+    "value": "本周",
+    "baseline": "此前均值",
+    "delta": "变化",
+    "z": "z 值",
+    "history_weeks": "历史周数",
+}
+
+
+def render_trends(week_label: str):
+    """周趋势：本周与此前几周相比利润率 / 取消率变化剧烈的 SKU，以及各周费用汇总。"""
+    store = get_trend_store()
+    version = store.version()
+    trend = load_trend_matrix(version)
+    st.subheader(f"周趋势（已存档 {len(trend.weeks)} 周）")
+    if len(trend.weeks) < 2:
+        st.caption(
+            "周趋势库中不足 2 周。参与分析的报表都在同一周内（按文件名中的期间，例如 20251103-1109）时，"
+            "分析完成后自动存档。"
+        )
+        return
+
+    week = week_label if week_label in trend.weeks else trend.weeks[-1]
+    col_window, col_z = st.columns(2)
+    window = col_window.slider("对比此前的周数", min_value=2, max_value=26, value=DEFAULT_WINDOW)
+    z_threshold = col_z.number_input("异常阈值（z 值）", min_value=1.0, max_value=10.0, value=DEFAULT_Z, step=0.5)
+
+    anomalies = trend_anomalies(version, week, window, z_threshold)
+    st.markdown(f"**{week}：利润率 / 取消率变化剧烈的 SKU（{len(anomalies)} 个）**")
+    render_table_page(
+        anomalies.assign(metric=anomalies["metric"].map(METRIC_NAMES_ZH)).rename(columns=ANOMALY_COLUMNS_ZH),
+        key="trend_anomalies",
+    )
+
+    metric_names = [METRIC_NAMES_ZH[m] for m in TREND_METRICS]
+    metric_name = st.selectbox("趋势图指标", metric_names, index=TREND_METRICS.index("margin"))
+    metric = TREND_METRICS[metric_names.index(metric_name)]
+    skus = st.multiselect(
+        "趋势图中的 SKU（默认为异常最明显的 5 个）",
+        list(trend.skus) if len(trend.skus) <= 5000 else list(anomalies["SKU"].unique()),
+        default=list(anomalies["SKU"].unique()[:5]),
+    )
+    if skus:
+        st.line_chart(trend.frame(metric).loc[skus].T)
+
+    fees = store.fee_totals()
+    with st.expander("各周费用汇总"):
+        st.dataframe(fees, use_container_width=True)
+        st.caption("环比变化")
+        st.dataframe(fees.diff().iloc[1:], use_container_width=True)
+
+
+# 情景模拟表单的默认参数范围（下限, 上限）
+SCENARIO_DEFAULT_RANGES = {
+    "price_pct": (0.0, 0.0),
+    "volume_pct": (0.0, 0.0),
+    "cost_pct": (0.0, 0.08),
+    "logistics_pct": (0.0, 0.0),
+    "logistics_per_unit": (0.0, 15.0),
+    "cancel_factor": (0.5, 1.0),
+}
+SCENARIO_METRICS_ZH = {"total_profit": "利润总额", "final_payable": "平台最终应付金额", "loss_skus": "亏损 SKU 数"}
+SCENARIO_SKU_COLUMNS_ZH = {
+    "base_profit": "当前利润",
+    "expected_profit": "期望利润",
+    "profit_std": "利润标准差",
+    "loss_probability": "亏损概率",
+    "worst_profit": "最差情况利润",
+}
+
+
+def _histogram(values: pd.Series, bins: int = 30) -> pd.DataFrame:
+    counts, edges = np.histogram(values, bins=bins)
+    return pd.DataFrame({"情景数": counts}, index=pd.Index(np.round((edges[:-1] + edges[1:]) / 2), name="₽"))
+
+
+def render_scenarios(job_id: str):
+    """情景模拟：在本次结果上按参数范围抽取多组情景，显示利润总额 / 平台应付金额的分布和各 SKU 的亏损风险。"""
+    st.subheader("情景模拟（what-if）")
+    st.caption("各参数在下限和上限之间均匀抽样（上下限相同时固定），直接在本次结果上计算，不重新读取报表。")
+    with st.form("scenario_form"):
+        ranges = {}
+        for name in SCENARIO_PARAMS:
+            low, high = SCENARIO_DEFAULT_RANGES[name]
+            col_low, col_high = st.columns(2)
+            ranges[name] = (
+                col_low.number_input(f"{SCENARIO_PARAM_NAMES_ZH[name]}：下限", value=low, key=f"scenario_{name}_low"),
+                col_high.number_input(f"{SCENARIO_PARAM_NAMES_ZH[name]}：上限", value=high, key=f"scenario_{name}_high"),
+            )
+        col_n, col_seed = st.columns(2)
+        n = col_n.number_input("情景数", min_value=1, max_value=20000, value=1000, step=100)
+        seed = col_seed.number_input("随机种子", min_value=0, value=0, step=1)
+        if st.form_submit_button("运行情景模拟"):
+            st.session_state["scenario_params"] = (job_id, tuple(ranges.items()), int(n), int(seed))
+
+    params = st.session_state.get("scenario_params")
+    if params is None or params[0] != job_id:
+        return
+    if any(low > high for _, (low, high) in params[1]):
+        st.error("参数的下限不能大于上限。")
+        return
+    scenarios, summary, by_sku = run_scenarios(*params)
+
+    st.dataframe(
+        summary.assign(metric=summary["metric"].map(SCENARIO_METRICS_ZH)).rename(columns={"metric": "指标"}),
+        use_container_width=True, hide_index=True,
+    )
+    col_profit, col_payable = st.columns(2)
+    col_profit.caption("利润总额的分布")
+    col_profit.bar_chart(_histogram(scenarios["total_profit"]))
+    col_payable.caption("平台最终应付金额的分布")
+    col_payable.bar_chart(_histogram(scenarios["final_payable"]))
+
+    st.markdown("**各 SKU 的亏损风险**")
+    render_table_page(
+        by_sku.sort_values(["loss_probability", "worst_profit"], ascending=[False, True], kind="stable")
+        .rename(columns=SCENARIO_SKU_COLUMNS_ZH),
+        key="scenario_by_sku",
+    )
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from backends import get_backend
+
+# ==============================
+# 大数据量模式：按块累加部分和，超过上限时按分区溢出到磁盘
+# ==============================
+#
+# 一整年的周报表逐份聚合后，每份聚合表（按 barcode / reason_code / fee_code 的计数和金额）
+# 都是可加的部分和。RunningSums 逐份接收这些表：
+#   1. 先放进待合并列表，累计超过 fold_rows 行时与当前部分和一起重新分组求和（fold）；
+#   2. 部分和本身超过 spill_rows 行时，按 barcode 的哈希分成 partitions 个分区写成 Parquet，
+#      内存中的部分和清空，之后继续累加；
+#   3. result() 时如果溢出过，把剩余部分也写出，再逐个分区读回、分组求和后拼接。
+#      同一个 barcode 总是落在同一个分区，分区之间没有重复的键，拼接即为最终结果。
+# 内存中最多同时存在：待合并的块 + 部分和（不超过 spill_rows 行）+ 一个分区，与周数无关。
+# 金额是 int64 戈比，求和与合并的顺序、分区方式无关，结果与一次性合并完全相同（行的顺序可能不同）。
+# 本模块不依赖 streamlit。
+
+FOLD_ROWS = int(os.environ.get("WB_FOLD_ROWS", "2000000"))
+SPILL_ROWS = int(os.environ.get("WB_SPILL_ROWS", "5000000"))
+SPILL_PARTITIONS = int(os.environ.get("WB_SPILL_PARTITIONS", "16"))
+SPILL_DIR = os.environ.get("WB_SPILL_DIR") or None
+
+
+class RunningSums:
+    def __init__(self,
+                 keys,
+                 spill_dir=SPILL_DIR,
+                 fold_rows: int = FOLD_ROWS,
+                 spill_rows: int = SPILL_ROWS,
+                 partitions: int = SPILL_PARTITIONS):
+        self.keys = list(keys)
+        self.spill_dir = spill_dir
+        self.fold_rows = fold_rows
+        self.spill_rows = spill_rows
+        self.partitions = partitions
+        self.columns = None
+        self.dtypes = None
+        self.tables_added = 0
+        self.spills = 0
+        self.spilled_rows = 0
+        self.peak_rows = 0
+        self._running = None
+        self._pending = []
+        self._pending_rows = 0
+        self._tmp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, table: pd.DataFrame):
+        """并入一份部分和（列为 keys + 计数 / 金额列）。"""
+        if table is None:
+            return
+        if self.columns is None:
+            self.columns = [c for c in table.columns if c not in self.keys]
+            self.dtypes = table.dtypes[[*self.keys, *self.columns]].to_dict()
+        self.tables_added += 1
+        self._pending.append(table)
+        self._pending_rows += len(table)
+        if self._pending_rows >= self.fold_rows:
+            self._fold()
+
+    def _fold(self):
+        tables = ([self._running] if self._running is not None else []) + self._pending
+        if not tables:
+            return
+        self._running = get_backend().group_sum(tables, self.keys, self.columns)
+        self._pending = []
+        self._pending_rows = 0
+        self.peak_rows = max(self.peak_rows, len(self._running))
+        if len(self._running) > self.spill_rows:
+            self._spill()
+
+    def _partition_of(self, table: pd.DataFrame) -> np.ndarray:
+        # 只按第一个键（barcode）分区：同一 SKU 的所有行落在同一分区
+        hashes = pd.util.hash_pandas_object(table[self.keys[0]], index=False).to_numpy()
+        return (hashes % np.uint64(self.partitions)).astype("int64")
+
+    def _spill(self):
+        if self._tmp is None:
+            if self.spill_dir is not None:
+                Path(self.spill_dir).mkdir(parents=True, exist_ok=True)
+            self._tmp = Path(tempfile.mkdtemp(prefix="wb-spill-", dir=self.spill_dir))
+        table = self._running
+        part = self._partition_of(table)
+        for p in range(self.partitions):
+            rows = table[part == p]
+            if len(rows):
+                rows.to_parquet(self._tmp / f"part-{p:03d}-{self.spills:05d}.parquet", index=False)
+        self.spills += 1
+        self.spilled_rows += len(table)
+        self._running = None
+
+    def result(self):
+        """最终的合并结果（keys + 各列之和）；一份表都没有加入时返回 None。溢出文件随后删除。"""
+        if self.columns is None:
+            return None
+        self._fold()
+        if not self.spills:
+            return self._running
+
+        if self._running is not None:
+            self._spill()
+        parts = []
+        for p in range(self.partitions):
+            files = sorted(self._tmp.glob(f"part-{p:03d}-*.parquet"))
+            if not files:
+                continue
+            tables = [pd.read_parquet(f).astype(self.dtypes) for f in files]
+            parts.append(get_backend().group_sum(tables, self.keys, self.columns))
+        self.close()
+        return pd.concat(parts, ignore_index=True)
+
+    def close(self):
+        if self._tmp is not None:
+            shutil.rmtree(self._tmp, ignore_errors=True)
+            self._tmp = None
+
+    def stats(self) -> dict:
+        return {
+            "tables": self.tables_added,
+            "peak_rows": self.peak_rows,
+            "spills": self.spills,
+            "spilled_rows": self.spilled_rows,
+        }
@@ -0,0 +1,1601 @@
+import io
+import time
+import zipfile
+from contextlib import nullcontext
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from backends import get_backend
+from dedup import (
+    NOTE_DUPLICATE_FILE,
+    NOTE_NO_ROW_ID,
+    NOTE_OVERLAP,
+    ROW_FINGERPRINT_FORMAT,
+    DuplicateLog,
+    overlap_masks,
+    row_fingerprints,
+)
+from ingest import concat_reports, parse_reports_parallel, read_report_xlsx, to_text
+from out_of_core import RunningSums
+from report_cache import content_hash
+from sku_dictionary import MISSING_CODE, SkuDictionary
+
+# ==============================
+# 1. 字段映射 & 枚举配置
+# ==============================
+
+COLUMN_MAP = {
+    "Обоснование для оплаты": "reason_for_payment",
+    "Виды логистики, штрафов и корректировок ВВ": "logistics_fee_type",
+    "Баркод": "barcode",
+    "Артикул поставщика": "supplier_sku",
+    "К перечислению Продавцу за реализованный Товар": "amount_payable_goods",
+    "Вайлдберриз реализовал Товар (Пр)": "wb_gmv",
+    "Цена розничная": "retail_price_total",
+    "Услуги по доставке товара покупателю": "delivery_to_customer",
+    "Общая сумма штрафов": "fine_total",
+    "Компенсация скидки по программе лояльности": "loyalty_discount_comp",
+    "Стоимость участия в программе лояльности": "loyalty_service_fee",
+    "Сумма удержанная за начисленные баллы программы лояльности": "loyalty_points_deduction",
+    "Кол-во": "quantity",
+    "Склад": "warehouse",
+}
+
+# 行标识列：不参与计算，只在解析时和映射列一起算出每行的哈希 row_hash，用于识别重复上传的行（见 dedup.py）。
+# 只用真正唯一的行标识 Srid：日期不能区分行（同一 SKU、同一仓库、同一天的物流行本来就完全相同），
+# 没有 Srid 的报表不算行哈希，只检查整份文件是否重复；Srid 为空的行（仓储费、罚款等）不参与行级比对。
+ROW_ID_COLUMN_MAP = {
+    "Srid": "srid",
+}
+
+REASON_SALES = ["Продажа"]
+REASON_RETURNS = ["Возврат"]
+
+FEE_TYPE_MAP = {
+    "sales_logistics": {
+        "ru_types": ["К клиенту при продаже"],
+        "desc": "销售成功对应的正向物流费用",
+    },
+    "cancel_logistics_forward": {
+        "ru_types": ["К клиенту при отмене"],
+        "desc": "已发货但订单被取消，正向物流费用",
+    },
+    "cancel_logistics_backward": {
+        "ru_types": ["От клиента при отмене"],
+        "desc": "订单取消后，商品退回仓库的逆向物流费用",
+    },
+    "loyalty_points_deduction": {
+        "ru_types": ["Сумма удержанная за начисленные баллы программы лояльности"],
+        "desc": "为买家积累积分而从卖家账户扣除的金额",
+    },
+    "loyalty_service_fee": {
+        "ru_types": ["Стоимость участия в программе лояльности"],
+        "desc": "参与忠诚计划本身的服务费用",
+    },
+    "size_penalty": {
+        "ru_types": ["Занижение фактических габаритов упаковки товара"],
+        "desc": "因低报包装尺寸导致的罚款",
+    },
+    "defect_compensation": {
+        "ru_types": ["Компенсация скидки по программе лояльности"],
+        "desc": "平台对折扣/品质问题的某种补偿（暂按费用处理）",
+    },
+    "loyalty_refund_from_customer": {
+        "ru_types": ["От клиента при возврате"],
+        "desc": "与忠诚计划相关的客户返还/补偿",
+    },
+}
+
+FORWARD_CANCEL_TYPES = FEE_TYPE_MAP["cancel_logistics_forward"]["ru_types"]
+BACKWARD_CANCEL_TYPES = FEE_TYPE_MAP["cancel_logistics_backward"]["ru_types"]
+
+# 读取时直接转成 float64 的数值列（报表中缺失的列在合并后补 0）
+NUMERIC_COLUMNS = [
+    "amount_payable_goods",
+    "wb_gmv",
+    "retail_price_total",
+    "delivery_to_customer",
+    "fine_total",
+    "loyalty_discount_comp",
+    "loyalty_service_fee",
+    "loyalty_points_deduction",
+    "quantity",
+]
+
+# 标识类列，读取时统一转成文本（数字条码和文本条码视为同一个 SKU）
+TEXT_COLUMNS = [
+    "barcode",
+    "supplier_sku",
+]
+
+# 取值种类很少的文本列，读取时存成 categorical
+CATEGORICAL_COLUMNS = [
+    "reason_for_payment",
+    "logistics_fee_type",
+    "warehouse",
+]
+
+# 维度列：仓库（报表中的 Склад）和区域（境内 / 境外，读取时按文件名给每一行打上，见 load_reports）。
+# 两者都是 categorical，作为聚合表的分组键保留下来，物流和取消率可以按 SKU × 仓库 × 区域分组
+DIMENSION_COLUMNS = ["warehouse", "region"]
+
+# 金额列（卢布，两位小数）。紧凑化之后以整数戈比存储，求和没有浮点误差
+MONEY_COLUMNS = [c for c in NUMERIC_COLUMNS if c != "quantity"]
+KOPECKS_PER_RUBLE = 100
+
+
+# ==============================
+# 2. 读 & 合并当前周上传的所有报表（第0步）
+# ==============================
+
+# 解析结果的格式标识，拼进缓存键；改动列裁剪/类型规则时递增
+PARSED_REPORT_FORMAT = "columns-v4"
+
+
+def parse_report_bytes(data: bytes) -> pd.DataFrame:
+    """流式解析单份 WB 报表（.xlsx 原始字节），只保留 COLUMN_MAP 中的列（报表有行标识列时另带 row_hash）。"""
+    return read_report_xlsx(
+        data, COLUMN_MAP, NUMERIC_COLUMNS, CATEGORICAL_COLUMNS, TEXT_COLUMNS, row_id_columns=ROW_ID_COLUMN_MAP,
+    )
+
+
+def file_bytes(f) -> bytes:
+    """网页上传的文件对象（UploadedFile / BytesIO）或本地路径，统一取出原始字节。"""
+    if hasattr(f, "getvalue"):
+        return f.getvalue()
+    return Path(f).read_bytes()
+
+
+def file_name(f) -> str:
+    if hasattr(f, "getvalue"):
+        return getattr(f, "name", "")
+    return Path(f).name
+
+
+def describe_report_file(name: str) -> dict:
+    """简单从文件名里识别“境内/境外”和时间段（可根据你的命名规则调整）。"""
+    stem = Path(name).stem
+    if "境内" in stem:
+        region = "境内"
+        period = stem.replace("境内", "")
+    elif "境外" in stem:
+        region = "境外"
+        period = stem.replace("境外", "")
+    else:
+        region = "未知"
+        period = stem
+    return {"period": period, "region": region}
+
+
+def tag_region(df: pd.DataFrame, region: str) -> pd.DataFrame:
+    """给一份报表的每一行打上区域（只有一个类别的 categorical，几乎不占内存）。"""
+    return df.assign(region=pd.Categorical.from_codes(np.zeros(len(df), dtype="int8"), categories=[region]))
+
+
+def _fill_missing_numeric(df: pd.DataFrame) -> pd.DataFrame:
+    for col in NUMERIC_COLUMNS:
+        if col not in df.columns:
+            df[col] = 0
+    return df
+
+
+def load_reports(files, cache=None, workers: int = 1, on_parsed=None) -> list:
+    """
+    逐份解析上传的 .xlsx，返回与 files 顺序一致的 DataFrame 列表。
+    传入 cache（report_cache.ReportCache）时，按文件内容哈希复用已解析的结果；
+    workers > 1 时，未命中缓存的文件交给多个子进程并行解析。
+    传入 on_parsed 时，每份文件读取完成（命中缓存或解析完）调用一次 on_parsed(文件名)。
+    每份报表按文件名识别的区域（describe_report_file）作为 region 列打在每一行上，缓存中存的是不带区域的解析结果。
+    """
+    blobs = [file_bytes(f) for f in files]
+    dfs = [None] * len(blobs)
+    keys = [None] * len(blobs)
+
+    if cache is not None:
+        for i, data in enumerate(blobs):
+            keys[i], dfs[i] = cache.fetch(data)
+            if dfs[i] is not None and on_parsed is not None:
+                on_parsed(file_name(files[i]))
+
+    missing = [i for i, df in enumerate(dfs) if df is None]
+    parsed = parse_reports_parallel(
+        [blobs[i] for i in missing],
+        COLUMN_MAP,
+        workers=workers,
+        numeric_columns=NUMERIC_COLUMNS,
+        categorical_columns=CATEGORICAL_COLUMNS,
+        text_columns=TEXT_COLUMNS,
+        on_parsed=None if on_parsed is None else lambda j: on_parsed(file_name(files[missing[j]])),
+        row_id_columns=ROW_ID_COLUMN_MAP,
+    )
+    for i, df in zip(missing, parsed):
+        dfs[i] = df
+        if cache is not None:
+            cache.put(keys[i], df)
+
+    return [tag_region(df, describe_report_file(file_name(f))["region"]) for f, df in zip(files, dfs)]
+
+
+def load_week_data_from_upload(files, dictionary: SkuDictionary, cache=None, workers: int = 1) -> pd.DataFrame:
+    """
+    从网页上传的多个 .xlsx（或本地路径）中读取并合并为一个紧凑格式的 DataFrame（见 compact_report），
+    条码编进调用方给的 SKU 字典 dictionary（之后 aggregate_report 也要传同一本字典）。
+    所有明细会同时留在内存中；多周 / 全年的报表请用 load_week_aggregates（可加 out_of_core=True）。
+    内容完全相同的文件只读一次，与前面的文件重叠的行（按行指纹，见 dedup.py）在合并前去掉。
+    """
+    unique = {}
+    for f in files:
+        unique.setdefault(content_hash(file_bytes(f)), f)
+    dfs = load_reports(list(unique.values()), cache=cache, workers=workers)
+    fingerprints = [row_fingerprints(df["row_hash"]) if "row_hash" in df.columns else None for df in dfs]
+    dfs = [
+        (df if mask is None else df[~mask]).drop(columns="row_hash", errors="ignore")
+        for df, mask in zip(dfs, overlap_masks(fingerprints))
+    ]
+    return compact_report(_fill_missing_numeric(concat_reports(dfs)), dictionary)
+
+
+# ==============================
+# 2.0 紧凑列类型：条码整数编码 + categorical + 整数戈比
+# ==============================
+
+def to_kopecks(values) -> np.ndarray:
+    """卢布金额 -> int64 戈比（四舍五入到戈比，缺失值按 0）。"""
+    arr = np.asarray(values, dtype="float64")
+    return np.nan_to_num(np.round(arr * KOPECKS_PER_RUBLE)).astype("int64")
+
+
+def to_rubles(kopecks):
+    """戈比 -> 卢布（float64）。每个结果都是离该戈比数最近的浮点数，不随求和顺序变化。"""
+    return kopecks / KOPECKS_PER_RUBLE
+
+
+def _smallest_int(arr: np.ndarray) -> np.ndarray:
+    """能放进 int32 就用 int32（单行金额远小于 2^31 戈比），否则保留 int64。"""
+    if len(arr) == 0 or (arr.min() >= np.iinfo("int32").min and arr.max() <= np.iinfo("int32").max):
+        return arr.astype("int32")
+    return arr
+
+
+def is_compact(df: pd.DataFrame) -> bool:
+    return "sku_code" in df.columns
+
+
+def compact_report(df: pd.DataFrame, dictionary: SkuDictionary) -> pd.DataFrame:
+    """
+    解析后的明细 -> 紧凑格式：
+      - barcode 换成 SKU 字典 dictionary 里的 int32 编码 sku_code（字典由调用方创建，编码只在这本字典内有效）；
+      - supplier_sku 和 CATEGORICAL_COLUMNS 存成 categorical；
+      - 金额列转成整数戈比，数量转成整数。
+    已经是紧凑格式时原样返回。
+    """
+    if is_compact(df):
+        return df
+
+    out = {"sku_code": dictionary.encode(df["barcode"])}
+    for col in df.columns:
+        if col == "barcode":
+            continue
+        s = df[col]
+        if col in MONEY_COLUMNS:
+            out[col] = _smallest_int(to_kopecks(s))
+        elif col == "quantity":
+            out[col] = _smallest_int(np.nan_to_num(np.round(s.to_numpy(dtype="float64"))).astype("int64"))
+        elif col == "supplier_sku" or col in CATEGORICAL_COLUMNS:
+            out[col] = s if isinstance(s.dtype, pd.CategoricalDtype) else pd.Categorical(s)
+        else:
+            out[col] = s
+    return pd.DataFrame(out, index=df.index)
+
+
+# ==============================
+# 2.1 单次扫描聚合（步骤1～8 共用）
+# ==============================
+
+# 每一行先归到 (付款原因代码, 费用类别代码)，再按 barcode 做一次 groupby，
+# 后面的 compute_* 都只在这个小得多的聚合表上取数，不再反复扫描原始明细。
+REASON_CODE_OTHER = 0
+REASON_CODE_SALES = 1
+REASON_CODE_RETURNS = 2
+
+REASON_CODE_MAP = {
+    **{ru: REASON_CODE_SALES for ru in REASON_SALES},
+    **{ru: REASON_CODE_RETURNS for ru in REASON_RETURNS},
+}
+
+# 费用类别代码：0 = 不属于 FEE_TYPE_MAP 中任何类别，其余按 FEE_TYPE_MAP 的顺序从 1 开始
+FEE_CODE_NONE = 0
+FEE_CATEGORY_CODES = {cat: i for i, cat in enumerate(FEE_TYPE_MAP, start=1)}
+FEE_CODE_MAP = {
+    ru: FEE_CATEGORY_CODES[cat]
+    for cat, info in FEE_TYPE_MAP.items()
+    for ru in info["ru_types"]
+}
+
+# unmapped_fee_type：不在 FEE_TYPE_MAP 中的物流费用类型原文（fee_code 为 FEE_CODE_NONE），其它行为缺失值；
+# warehouse / region：DIMENSION_COLUMNS 的原文，缺失时为缺失值
+AGG_KEYS = ["barcode", "reason_code", "fee_code", "unmapped_fee_type", *DIMENSION_COLUMNS]
+
+# compute_* 的分组键：默认按 SKU；按仓库 / 区域细分时用 BY_WAREHOUSE_REGION，一次分组得到所有切片
+BY_SKU = ("barcode",)
+BY_WAREHOUSE_REGION = ("barcode", *DIMENSION_COLUMNS)
+
+AGG_SUM_COLUMNS = [
+    "amount_payable_goods",
+    "wb_gmv",
+    "retail_price_total",
+    "delivery_to_customer",
+    "fine_total",
+    "loyalty_service_fee",
+    "loyalty_points_deduction",
+]
+
+
+class ReportAggregates:
+    """
+    合并报表按 (barcode, reason_code, fee_code, unmapped_fee_type, warehouse, region) 汇总后的结果。
+    table 中除分组键外包含：
+      - row_count：原始行数（总览用）
+      - record_count：barcode 非空的行数（与按 SKU 的 count 口径一致）
+      - delivery_row_count：物流费用 != 0 的行数（决定销售物流表中是否出现该 SKU）
+      - delivery_record_count：barcode 非空且物流费用 != 0 的行数
+      - AGG_SUM_COLUMNS 中各金额列之和（int64 戈比）
+    """
+
+    def __init__(self, table: pd.DataFrame):
+        self.table = table
+
+    @property
+    def total_rows(self) -> int:
+        return int(self.table["row_count"].sum())
+
+    def rows(self, reason_code=None, fee_codes=None) -> pd.DataFrame:
+        t = self.table
+        mask = pd.Series(True, index=t.index)
+        if reason_code is not None:
+            mask &= t["reason_code"] == reason_code
+        if fee_codes is not None:
+            mask &= t["fee_code"].isin(fee_codes)
+        return t[mask]
+
+
+def _map_codes(s: pd.Series, mapping: dict, default: int) -> np.ndarray:
+    """把文本列映射成 int8 代码；categorical 列只需映射类别本身，再按 codes 取值。"""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        cat_codes = pd.Series(s.cat.categories).map(mapping).fillna(default).to_numpy(dtype="int8")
+        # codes 为 -1（缺失值）时落到末尾追加的 default
+        return np.append(cat_codes, np.int8(default))[s.cat.codes.to_numpy()]
+    return s.map(mapping).fillna(default).to_numpy(dtype="int8")
+
+
+def _unmapped_fee_codes(s: pd.Series):
+    """
+    不在 FEE_CODE_MAP 中（且非空）的费用类型：返回 (每行的编码，0 表示已归类或为空, 编码 -> 类型原文)。
+    只对去重后的类型判断一次，categorical 列即只看类别本身。
+    """
+    codes, uniques = pd.factorize(s, use_na_sentinel=True)
+    labels = [None]
+    lookup = np.zeros(len(uniques) + 1, dtype="int64")  # 末尾一项对应缺失值（codes 为 -1）
+    for i, value in enumerate(np.asarray(uniques, dtype=object)):
+        if value not in FEE_CODE_MAP and str(value).strip():
+            lookup[i] = len(labels)
+            labels.append(value)
+    return lookup[codes], np.array(labels, dtype=object)
+
+
+def _label_codes(df: pd.DataFrame, col: str):
+    """列的 (每行的编码, 编码 -> 原文)：编码 0 对应缺失值（报表中没有这一列时全部为 0）。"""
+    if col not in df.columns:
+        return np.zeros(len(df), dtype="int64"), np.array([None], dtype=object)
+    codes, uniques = pd.factorize(df[col], use_na_sentinel=True)
+    return codes.astype("int64") + 1, np.array([None, *np.asarray(uniques, dtype=object)], dtype=object)
+
+
+def _decode_labels(labels: np.ndarray, codes: np.ndarray):
+    """编码 -> 文本列（str 类型）：只把很少的几个原文转成 str，再按编码 take，比逐行构造快得多。"""
+    return pd.array(labels, dtype="str").take(codes)
+
+
+# aggregate_report 需要从明细中读取的列
+AGG_SOURCE_COLUMNS = ["barcode", "reason_for_payment", "logistics_fee_type", *DIMENSION_COLUMNS, *AGG_SUM_COLUMNS]
+
+_N_REASON_CODES = 3
+_N_FEE_CODES = len(FEE_CATEGORY_CODES) + 1
+
+
+def aggregate_report(df: pd.DataFrame, dictionary: SkuDictionary = None) -> ReportAggregates:
+    """
+    对合并后的明细只扫描一次：行分类 + 一次分组求和，得到所有步骤需要的计数与金额。
+    (sku_code, reason_code, fee_code, 未归类费用类型, 仓库, 区域) 合成一个 int64 键，factorize 后用 np.bincount 求和，
+    比多列 groupby 快得多。金额是整数戈比（经 float64 累加，2^53 戈比以内精确），与行的顺序无关。
+    紧凑格式的明细要传入编码它的 SKU 字典 dictionary；原始明细不用传。
+    """
+    df = _fill_missing_numeric(df)
+    if is_compact(df):
+        if dictionary is None:
+            raise ValueError("紧凑格式的明细需要传入编码它的 SKU 字典（dictionary）")
+    else:
+        # 本次单独建一本字典，编码不出本函数，用完即释放
+        dictionary = SkuDictionary()
+        df = compact_report(df[[c for c in AGG_SOURCE_COLUMNS if c in df.columns]], dictionary)
+
+    sku_code = df["sku_code"].to_numpy()
+    reason_code = _map_codes(df["reason_for_payment"], REASON_CODE_MAP, REASON_CODE_OTHER)
+    fee_code = _map_codes(df["logistics_fee_type"], FEE_CODE_MAP, FEE_CODE_NONE)
+    unmapped_code, unmapped_labels = _unmapped_fee_codes(df["logistics_fee_type"])
+    n_unmapped = len(unmapped_labels)
+    warehouse_code, warehouse_labels = _label_codes(df, "warehouse")
+    region_code, region_labels = _label_codes(df, "region")
+    n_warehouses, n_regions = len(warehouse_labels), len(region_labels)
+    has_barcode = sku_code != MISSING_CODE
+    has_delivery = df["delivery_to_customer"].to_numpy() != 0
+
+    key = (
+        (((sku_code.astype("int64") + 1) * _N_REASON_CODES + reason_code) * _N_FEE_CODES + fee_code) * n_unmapped
+        + unmapped_code
+    ) * (n_warehouses * n_regions) + warehouse_code * n_regions + region_code
+    group, keys = pd.factorize(key)
+    n = len(keys)
+
+    def group_sum(weights=None) -> np.ndarray:
+        return np.bincount(group, weights=weights, minlength=n).astype("int64")
+
+    dims = keys % (n_warehouses * n_regions)
+    fee_key = keys // (n_warehouses * n_regions)
+    base = fee_key // n_unmapped
+    table = pd.DataFrame({
+        # 聚合表（会写进汇总库）里用条码文本，编码只在进程内有效
+        "barcode": dictionary.decode(base // (_N_REASON_CODES * _N_FEE_CODES) - 1),
+        "reason_code": ((base // _N_FEE_CODES) % _N_REASON_CODES).astype("int8"),
+        "fee_code": (base % _N_FEE_CODES).astype("int8"),
+        "unmapped_fee_type": _decode_labels(unmapped_labels, fee_key % n_unmapped),
+        "warehouse": _decode_labels(warehouse_labels, dims // n_regions),
+        "region": _decode_labels(region_labels, dims % n_regions),
+        "row_count": group_sum(),
+        "record_count": group_sum(has_barcode),
+        "delivery_row_count": group_sum(has_delivery),
+        "delivery_record_count": group_sum(has_barcode & has_delivery),
+        **{col: group_sum(df[col].to_numpy()) for col in AGG_SUM_COLUMNS},
+    })
+    return ReportAggregates(table)
+
+
+def _rubles_columns(df: pd.DataFrame, columns) -> pd.DataFrame:
+    """聚合表里的戈比列换算成卢布，作为对外展示/导出的结果。"""
+    df = df.copy()
+    for col in columns:
+        df[col] = to_rubles(df[col])
+    return df
+
+
+def _as_aggregates(df) -> ReportAggregates:
+    """compute_* 既可以直接接收原始明细，也可以接收 aggregate_report 的结果。"""
+    if isinstance(df, ReportAggregates):
+        return df
+    return aggregate_report(df)
+
+
+def combine_aggregates(aggs) -> ReportAggregates:
+    """多份聚合结果（例如多周）相加：计数和金额都是可加的，重新按分组键求和即可。"""
+    tables = [a.table if isinstance(a, ReportAggregates) else a for a in aggs]
+    tables = [t for t in tables if t is not None]
+    if not tables:
+        return aggregate_report(_fill_missing_numeric(pd.DataFrame(columns=list(COLUMN_MAP.values()))))
+    if len(tables) == 1:
+        return ReportAggregates(tables[0])
+
+    # 季度合并有几百万行，分组求和交给当前的计算后端（backends.py）
+    columns = [c for c in tables[0].columns if c not in AGG_KEYS]
+    return ReportAggregates(get_backend().group_sum(tables, AGG_KEYS, columns))
+
+
+def _sum_by_keys(rows: pd.DataFrame, columns: dict, by=BY_SKU) -> pd.DataFrame:
+    """
+    聚合表的行按 by（默认 barcode）分组求和（经当前的计算后端），按 by 排序（缺失值在最后）。
+    columns 为 {结果列名: 聚合表中的来源列}。
+    """
+    grouped = get_backend().group_sum([rows], list(by), list(columns.values()))
+    grouped = grouped.rename(columns={src: out for out, src in columns.items()})
+    return grouped.sort_values(list(by)).reset_index(drop=True)
+
+
+# 聚合表结构的格式标识，拼进汇总库的键；改动 AGG_KEYS / 计数口径时递增
+AGGREGATE_FORMAT = "agg-v7"
+
+
+def _direct_measure(name, fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+def partition_key(f) -> str:
+    """
+    一份报表在汇总库中的键：聚合格式 + 文件内容哈希。
+    文件对象带有 content_hash 属性时直接使用（例如监视目录中已算过哈希、内容未变的文件），不再读取文件。
+    """
+    digest = getattr(f, "content_hash", None) or content_hash(file_bytes(f))
+    return f"{AGGREGATE_FORMAT}-{digest}"
+
+
+def fingerprint_key(key: str) -> str:
+    """聚合分区对应的行指纹分区的键。"""
+    return ROW_FINGERPRINT_FORMAT + key[len(AGGREGATE_FORMAT):]
+
+
+def partition_name(store, key: str) -> str:
+    """汇总库中分区的显示名（原文件名）。"""
+    return store.describe(key).get("file_name") or key
+
+
+# 区域来自文件名，而分区只按内容哈希存储：同一内容换个文件名再上传时，汇总库中的聚合表仍是第一次入库时的区域。
+# 因此读取分区时总是按本次的文件名重新打上区域（一份报表只有一个区域，region 整列相同，分组键不会重复）；
+# 汇总库中直接选中的历史分区没有本次的文件，用入库时记录的文件名。
+
+def partition_region(store, key: str, f=None) -> str:
+    """分区本次使用的区域：f 为本次上传的文件时按它的文件名识别，否则按汇总库中记录的文件名。"""
+    name = file_name(f) if f is not None else partition_name(store, key)
+    return describe_report_file(name)["region"]
+
+
+def with_region(table: pd.DataFrame, region: str) -> pd.DataFrame:
+    """一份报表的聚合表换上给定的区域。"""
+    return table.assign(region=pd.array(np.full(len(table), region, dtype=object), dtype="str"))
+
+
+def ingest_reports(files,
+                   store,
+                   cache=None,
+                   workers: int = 1,
+                   measure=_direct_measure,
+                   on_parsed=None,
+                   keep: bool = True) -> dict:
+    """
+    汇总库中还没有的报表：每次解析 workers 份（并行），单次扫描聚合后立即丢弃明细，
+    聚合表和行指纹（报表有行标识列时）写入汇总库。内容相同的文件只处理一次。
+    返回 {键: 聚合表}，只包含本次新处理的报表；keep=False 时不在内存中保留聚合表（值为 None）。
+    """
+    pending = {}
+    for f in files:
+        key = partition_key(f)
+        if key not in pending and not store.has(key):
+            pending[key] = f
+
+    tables = {}
+    items = list(pending.items())
+    chunk = max(1, workers)
+    for start in range(0, len(items), chunk):
+        batch = items[start:start + chunk]
+        dfs = measure(
+            "parse_reports", load_reports, [f for _, f in batch],
+            cache=cache, workers=workers, on_parsed=on_parsed,
+        )
+        for key, f in batch:
+            df = dfs.pop(0)
+            table = measure("aggregate_report", aggregate_report, _fill_missing_numeric(df)).table
+            name = file_name(f)
+            store.put(key, table, file_name=name, **describe_report_file(name))
+            if "row_hash" in df.columns:
+                store.put(fingerprint_key(key), pd.DataFrame({"fingerprint": row_fingerprints(df["row_hash"])}),
+                          file_name=name)
+            tables[key] = table if keep else None
+    return tables
+
+
+def plan_deduplication(store, keys, names, trimmable, log: DuplicateLog = None):
+    """
+    keys：参与汇总的分区（按优先顺序，重叠的行保留先出现的那份），names 为显示名，
+    trimmable[i] 表示第 i 份的原文件在手边、可以重新读取明细去掉重叠行。
+    内容相同的分区只保留第一份；其余分区读取汇总库中的行指纹，一次 duplicated 标出与前面分区重叠的行。
+    返回 (去重后的分区键, {键: 要去掉的行的掩码})，每份报表的结果记入 log（DuplicateLog）。
+    """
+    log = log if log is not None else DuplicateLog()
+    first = {}
+    for i, key in enumerate(keys):
+        first.setdefault(key, i)
+    unique = list(first)
+
+    fingerprints = {}
+    for key in unique:
+        fp = store.get(fingerprint_key(key))
+        fingerprints[key] = None if fp is None else fp["fingerprint"].to_numpy()
+
+    removals = {}
+    masks = dict(zip(unique, overlap_masks([fingerprints[k] for k in unique])))
+    for i, key in enumerate(keys):
+        fp, mask = fingerprints[key], masks[key]
+        rows = None if fp is None else len(fp)
+        if first[key] != i:
+            log.add(names[i], rows, rows or 0, NOTE_DUPLICATE_FILE.format(names[first[key]]))
+        elif fp is None:
+            log.add(names[i], None, 0, NOTE_NO_ROW_ID)
+        elif not mask.any():
+            log.add(names[i], rows, 0)
+        elif trimmable[i]:
+            removals[key] = mask
+            log.add(names[i], rows, int(mask.sum()), NOTE_OVERLAP)
+        else:
+            log.add_unresolved(names[i], rows, int(mask.sum()))
+    return unique, removals
+
+
+def trimmed_aggregate(f, removed: np.ndarray, cache=None) -> pd.DataFrame:
+    """重新读取一份报表的明细（通常命中解析缓存），去掉 removed 标出的行后再聚合。"""
+    df = load_reports([f], cache=cache)[0]
+    return aggregate_report(_fill_missing_numeric(df[~removed])).table
+
+
+def load_week_aggregates(files,
+                         store,
+                         cache=None,
+                         workers: int = 1,
+                         stored_keys=(),
+                         profiler=None,
+                         on_parsed=None,
+                         out_of_core: bool = False,
+                         spill_dir=None,
+                         duplicates: DuplicateLog = None):
+    """
+    多周汇总的增量版本：每份报表的聚合结果存进 store（rollup_store.RollupStore），
+    已存过的报表直接读取聚合表，只有新报表才解析和聚合（见 ingest_reports）。
+    stored_keys 是直接从汇总库里选中的历史分区（无需重新上传）。
+    传入 profiler（profiling.StageProfiler）时分别记录解析和聚合的耗时与内存。
+    on_parsed 见 load_reports。
+
+    重复上传：内容相同的文件只计一次；与前面的报表重叠的行（历史分区在前，上传的文件按顺序在后）
+    按行指纹找出，重新读取该文件的明细去掉这些行后再聚合（汇总库中存的仍是整份文件的聚合表）。
+    每份报表的行数和删除行数记入 duplicates（dedup.DuplicateLog）。
+
+    新报表每次只解析 workers 份（并行），聚合后立即丢弃明细，内存中不会同时存在所有报表的明细。
+    out_of_core=True 时各报表的聚合表也不全部留在内存中，而是逐份并入 out_of_core.RunningSums 的部分和，
+    超过上限时溢出到磁盘（spill_dir，默认系统临时目录），内存占用与报表份数无关；结果与一次性合并完全相同。
+    返回 (合并后的 ReportAggregates, 复用的分区数, 新处理的文件数)。
+    """
+    measure = profiler.measure if profiler is not None else _direct_measure
+    keys = [partition_key(f) for f in files]
+    extra_keys = [k for k in dict.fromkeys(stored_keys) if k not in keys]
+    tables = ingest_reports(
+        files, store, cache=cache, workers=workers, measure=measure, on_parsed=on_parsed, keep=not out_of_core,
+    )
+
+    files_by_key = {}
+    for k, f in zip(keys, files):
+        files_by_key.setdefault(k, f)
+    unique, removals = measure(
+        "deduplicate", plan_deduplication, store, extra_keys + keys,
+        [partition_name(store, k) for k in extra_keys] + [file_name(f) for f in files],
+        [False] * len(extra_keys) + [True] * len(keys), log=duplicates,
+    )
+
+    processed = len(tables)
+    with RunningSums(AGG_KEYS, spill_dir=spill_dir) if out_of_core else nullcontext() as running:
+        parts = []
+        for k in unique:
+            if k in removals:
+                table = measure("aggregate_report", trimmed_aggregate, files_by_key[k], removals[k], cache=cache)
+            else:
+                table = tables.pop(k, None)
+                if table is None:
+                    table = store.get(k)
+            table = with_region(table, partition_region(store, k, files_by_key.get(k)))
+            if out_of_core:
+                running.add(table)
+            else:
+                parts.append(table)
+
+        if out_of_core:
+            agg = measure("combine_aggregates", lambda: combine_aggregates([running.result()]))
+        else:
+            agg = measure("combine_aggregates", combine_aggregates, parts)
+
+    return agg, len(unique) - processed, processed
+
+
+# ==============================
+# 2.2 SKU 维度：按 SKU 的指标对齐成稠密数组
+# ==============================
+
+# 净销售、取消率、利润几张表都要把多张按 SKU 的表拼在一起。这里不再一次次按文本键 merge + fillna，
+# 而是先建一个排好序的 SKU 索引（聚合表中的全部条码 + 采购成本表中的 SKU），
+# 每个指标按位置对齐成与索引等长的数组，结果表只是按掩码选出行、拼上列。
+# “总计”行在结果表拼好之后单独求和加上，不参与任何对齐。
+
+TOTAL_LABEL = "总计"
+
+
+def _sku_keys(keys):
+    """SKU 键统一成 str 类型（缺失条码为 NaN），与索引中的键类型一致。"""
+    if isinstance(keys, (pd.Series, pd.Index)) and keys.dtype == "str":
+        return keys.array
+    return pd.array(np.asarray(keys, dtype=object), dtype="str")
+
+
+class SkuIndex:
+    """
+    排好序的 SKU 列表（与 sort_values("barcode") 顺序一致，缺失条码排在最后）。
+    一张按 SKU 的表（键不重复）先用 positions() 查出每行在索引中的位置（每张表只查一次），
+    再用 align() 把其中的列对齐成与索引等长的数组，没有出现的 SKU 取 fill；
+    present() 给出哪些 SKU 在这张表中出现过。
+    """
+
+    def __init__(self, keys=()):
+        self.keys = pd.Index(pd.unique(_sku_keys(keys))).sort_values(na_position="last")
+
+    @classmethod
+    def from_keys(cls, *key_arrays) -> "SkuIndex":
+        uniques = [pd.Series(pd.unique(_sku_keys(k))) for k in key_arrays]
+        return cls(pd.concat(uniques, ignore_index=True) if uniques else ())
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def positions(self, keys) -> np.ndarray:
+        pos = self.keys.get_indexer(_sku_keys(keys))
+        if (pos < 0).any():
+            raise KeyError("部分 SKU 不在 SKU 索引中，索引需要由同一份聚合结果和采购成本表生成。")
+        return pos
+
+    def present(self, positions: np.ndarray) -> np.ndarray:
+        mask = np.zeros(len(self), dtype=bool)
+        mask[positions] = True
+        return mask
+
+    def align(self, positions: np.ndarray, values, fill=0) -> np.ndarray:
+        values = np.asarray(values)
+        out = np.full(len(self), fill, dtype=values.dtype)
+        out[positions] = values
+        return out
+
+    def select(self, mask: np.ndarray, columns: dict) -> pd.DataFrame:
+        """按掩码选出 SKU，columns 中各个与索引等长的数组作为结果列（第一列为 SKU）。"""
+        return pd.DataFrame({
+            "SKU": self.keys[mask],
+            **{name: values[mask] for name, values in columns.items()},
+        })
+
+
+def _group_rows(group: np.ndarray) -> np.ndarray:
+    """每个组号（0..n-1）任取一行的行号：直接按组号写入行号，不需要排序。"""
+    rows = np.empty(group.max() + 1 if len(group) else 0, dtype="int64")
+    rows[group] = np.arange(len(group))
+    return rows
+
+
+class GroupIndex(SkuIndex):
+    """
+    多列分组键（例如 barcode × warehouse × region）的索引，present / align 与 SkuIndex 相同。
+    索引由若干张表中出现过的键组合排序得到（缺失值在最后），table_positions[i] 是第 i 张表每行的位置。
+    """
+
+    def __init__(self, by, *frames):
+        self.by = list(by)
+        keys = pd.concat([f[self.by] for f in frames], ignore_index=True)
+        group = keys.groupby(self.by, dropna=False, sort=True).ngroup().to_numpy()
+        bounds = np.cumsum([0, *(len(f) for f in frames)])
+        self.table_positions = [group[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        self.keys = keys.iloc[_group_rows(group)].reset_index(drop=True)
+
+    def select(self, mask: np.ndarray, columns: dict) -> pd.DataFrame:
+        """按掩码选出键组合，前几列为 by 中的各列，后面是 columns 中的数组。"""
+        out = self.keys[mask].reset_index(drop=True)
+        for name, values in columns.items():
+            out[name] = values[mask]
+        return out
+
+
+def _key_index(by, frames, sku_index: SkuIndex = None):
+    """
+    把几张按 by 分组的表对齐到同一个索引，返回 (索引, 每张表的 positions)。
+    只按 barcode 时用 SkuIndex（可以直接用流水线建好的 sku_index），多列键时用 GroupIndex。
+    """
+    if tuple(by) == BY_SKU:
+        if sku_index is None:
+            sku_index = SkuIndex.from_keys(*[f["barcode"] for f in frames])
+        return sku_index, [sku_index.positions(f["barcode"]) for f in frames]
+    index = GroupIndex(by, *frames)
+    return index, index.table_positions
+
+
+def build_sku_index(df, cost_df: pd.DataFrame = None) -> SkuIndex:
+    """由聚合结果（或原始明细）中的全部条码和采购成本表中的 SKU 建立 SKU 索引，整条流水线只建一次。"""
+    barcodes = _as_aggregates(df).table["barcode"]
+    if cost_df is None:
+        return SkuIndex.from_keys(barcodes)
+    return SkuIndex.from_keys(barcodes, cost_df["SKU"])
+
+
+def with_total_row(body: pd.DataFrame, money_columns=()) -> pd.DataFrame:
+    """
+    在按 SKU 的结果表首行加上“总计”：各列单独求和，金额列（整戈比）先在戈比上求和再换算。
+    只用于展示/导出的结果表，下游计算一律使用不带总计行的表。
+    """
+    total = {"SKU": TOTAL_LABEL}
+    for col in body.columns.drop("SKU"):
+        if col in money_columns:
+            total[col] = to_rubles(int(to_kopecks(body[col]).sum()))
+        else:
+            total[col] = body[col].sum()
+    return pd.concat([pd.DataFrame([total]), body], ignore_index=True)
+
+
+def sku_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """去掉结果表中的“总计”行，只保留按 SKU 的行。"""
+    if "SKU" not in df.columns:
+        return df
+    return df[df["SKU"] != TOTAL_LABEL]
+
+
+# ==============================
+# 3. 步骤1：销售统计（按SKU）
+# ==============================
+
+def load_cost_table(cost_file) -> pd.DataFrame:
+    """
+    从上传的采购成本文件中读取 SKU 对应的单件采购成本。
+    文件要求至少两列：
+      - SKU 或 sku 或 barcode（任意一个）
+      - 采购成本 / cost / purchase_cost（任意一个）
+    """
+    df = pd.read_excel(cost_file)
+
+    # 列名统一成小写方便匹配
+    col_map = {c: str(c).strip().lower() for c in df.columns}
+    df = df.rename(columns=col_map)
+
+    # 找 SKU 列
+    sku_col = None
+    for cand in ["sku", "barcode", "条码"]:
+        if cand in df.columns:
+            sku_col = cand
+            break
+    if sku_col is None:
+        raise ValueError("采购成本文件中找不到 SKU 列，请确保包含 'SKU' 或 'sku' 或 'barcode' 字段。")
+
+    # 找成本列
+    cost_col = None
+    for cand in ["采购成本", "cost", "purchase_cost"]:
+        if cand in df.columns:
+            cost_col = cand
+            break
+    if cost_col is None:
+        raise ValueError("采购成本文件中找不到成本列，请确保包含 '采购成本' 或 'cost' 字段。")
+
+    cost_df = df[[sku_col, cost_col]].copy()
+    cost_df = cost_df.rename(columns={
+        sku_col: "SKU",
+        cost_col: "unit_cost",
+    })
+    # 与报表中的 barcode 一样统一成文本，否则数字条码和文本条码对不上
+    cost_df["SKU"] = cost_df["SKU"].map(to_text).astype("str")
+
+    # 同一个 SKU 如果出现多次，取平均或者最大值，这里先用平均
+    cost_df = (
+        cost_df
+        .groupby("SKU", as_index=False)["unit_cost"]
+        .mean()
+    )
+
+    return cost_df
+PROFIT_MONEY_COLUMNS = ["商品应付金额", "物流费用"]
+
+
+def compute_profit_by_sku(net_sales_df: pd.DataFrame,
+                          sales_logistics_by_sku: pd.DataFrame,
+                          cancel_logistics_by_sku: pd.DataFrame,
+                          cost_df: pd.DataFrame,
+                          sku_index: SkuIndex = None) -> pd.DataFrame:
+    """
+    生成 6 列的利润表（首行为总计）：
+    SKU / 销售件数 / 商品应付金额 / 物流费用 / 采购成本 / 利润
+    各输入表按 SKU 索引对齐成数组后逐列计算，SKU 范围与净销售表一致。
+    """
+    # 1) 净销售：流水线传入的是不带总计行的表，直接调用时也可能带着总计行
+    net = sku_rows(net_sales_df)
+    sales_log = sales_logistics_by_sku
+    cancel_log = cancel_logistics_by_sku
+    if sku_index is None:
+        sku_index = SkuIndex.from_keys(net["SKU"], sales_log["barcode"], cancel_log["barcode"], cost_df["SKU"])
+
+    net_pos = sku_index.positions(net["SKU"])
+    present = sku_index.present(net_pos)
+    sales_qty = sku_index.align(net_pos, net["件数"].to_numpy())
+    amount_payable = sku_index.align(net_pos, to_kopecks(net["商品应付金额"]))
+
+    # 2) 总物流费用 = 销售物流 + 取消/退货物流（total_cancel_logistics），在戈比上相加
+    sales_log_pos = sku_index.positions(sales_log["barcode"])
+    cancel_log_pos = sku_index.positions(cancel_log["barcode"])
+    logistics_total = (
+        sku_index.align(sales_log_pos, to_kopecks(sales_log["sales_logistics_sum"]))
+        + sku_index.align(cancel_log_pos, to_kopecks(cancel_log["total_cancel_logistics"]))
+    )
+
+    # 3) 采购成本总额 = 单件成本 * 销售件数；没有成本的 SKU 按 0
+    cost_pos = sku_index.positions(cost_df["SKU"])
+    unit_cost = sku_index.align(cost_pos, cost_df["unit_cost"].to_numpy(dtype="float64"))
+    purchase_total = unit_cost * sales_qty
+
+    # 4) 利润（应付金额与物流费用都是整戈比，先在戈比上相减；采购成本可能不是整戈比）
+    profit = to_rubles(amount_payable - logistics_total) - purchase_total
+
+    profit_df = sku_index.select(present, {
+        "销售件数": sales_qty,
+        "商品应付金额": to_rubles(amount_payable),
+        "物流费用": to_rubles(logistics_total),
+        "采购成本": purchase_total,
+        "利润": profit,
+    })
+    # 5) 总计行在各 SKU 行算好之后单独求和
+    return with_total_row(profit_df, PROFIT_MONEY_COLUMNS)
+
+def compute_sales_by_sku(df, by=BY_SKU) -> pd.DataFrame:
+    sales_rows = _as_aggregates(df).rows(reason_code=REASON_CODE_SALES)
+
+    grouped = _sum_by_keys(sales_rows, {
+        "sales_qty": "record_count",
+        "amount_payable_sum": "amount_payable_goods",
+        "wb_gmv_sum": "wb_gmv",
+        "retail_price_sum": "retail_price_total",
+    }, by=by)
+
+    grouped["discount_rate"] = 1 - grouped["wb_gmv_sum"] / grouped["retail_price_sum"]
+    grouped["discount_rate"] = grouped["discount_rate"].round(4)
+
+    return _rubles_columns(grouped, ["amount_payable_sum", "wb_gmv_sum", "retail_price_sum"])
+
+
+# ==============================
+# 4. 步骤2：退货统计（按SKU）
+# ==============================
+
+def compute_returns_by_sku(df) -> pd.DataFrame:
+    returns_rows = _as_aggregates(df).rows(reason_code=REASON_CODE_RETURNS)
+
+    grouped = _sum_by_keys(returns_rows, {
+        "return_qty": "record_count",
+        "amount_return_sum": "amount_payable_goods",
+        "wb_gmv_return_sum": "wb_gmv",
+        "retail_price_return_sum": "retail_price_total",
+    })
+    return _rubles_columns(grouped, ["amount_return_sum", "wb_gmv_return_sum", "retail_price_return_sum"])
+
+
+# ==============================
+# 5. 步骤3：净销售（销售 − 退货）
+# ==============================
+
+NET_SALES_MONEY_COLUMNS = ["商品应付金额", "前台销售额", "后台定价"]
+
+
+def compute_net_sales_body(sales_by_sku: pd.DataFrame,
+                           returns_by_sku: pd.DataFrame,
+                           sku_index: SkuIndex = None) -> pd.DataFrame:
+    """
+    每个 SKU 的净销售（不含总计行），中文表头：
+    SKU、件数、商品应付金额、前台销售额、后台定价
+    销售表和退货表各自对齐到 SKU 索引，没有销售或退货的一侧按 0 计。
+    """
+    if sku_index is None:
+        sku_index = SkuIndex.from_keys(sales_by_sku["barcode"], returns_by_sku["barcode"])
+    sales_pos = sku_index.positions(sales_by_sku["barcode"])
+    return_pos = sku_index.positions(returns_by_sku["barcode"])
+
+    def net_kopecks(sales_col, return_col):
+        # 金额在戈比上相减，避免 0.1 + 0.2 式的浮点尾差
+        return (
+            sku_index.align(sales_pos, to_kopecks(sales_by_sku[sales_col]))
+            - sku_index.align(return_pos, to_kopecks(returns_by_sku[return_col]))
+        )
+
+    net_qty = (
+        sku_index.align(sales_pos, sales_by_sku["sales_qty"].to_numpy())
+        - sku_index.align(return_pos, returns_by_sku["return_qty"].to_numpy())
+    )
+    present = sku_index.present(sales_pos) | sku_index.present(return_pos)
+
+    return sku_index.select(present, {
+        "件数": net_qty,
+        "商品应付金额": to_rubles(net_kopecks("amount_payable_sum", "amount_return_sum")),
+        "前台销售额": to_rubles(net_kopecks("wb_gmv_sum", "wb_gmv_return_sum")),
+        "后台定价": to_rubles(net_kopecks("retail_price_sum", "retail_price_return_sum")),
+    })
+
+
+def add_net_sales_total(net_sales_body: pd.DataFrame) -> pd.DataFrame:
+    """净销售表首行加上总计（戈比求和，再换算成卢布）。"""
+    return with_total_row(net_sales_body, NET_SALES_MONEY_COLUMNS)
+
+
+def compute_net_sales_by_sku(sales_by_sku: pd.DataFrame,
+                             returns_by_sku: pd.DataFrame,
+                             sku_index: SkuIndex = None) -> pd.DataFrame:
+    """净销售表（含首行总计），供展示和导出。"""
+    return add_net_sales_total(compute_net_sales_body(sales_by_sku, returns_by_sku, sku_index))
+
+
+
+# ==============================
+# 6. 步骤4：销售物流费用（按SKU）
+# ==============================
+
+def compute_sales_logistics_by_sku(df, by=BY_SKU) -> pd.DataFrame:
+    """by 为分组键：默认按 SKU，BY_WAREHOUSE_REGION 时一次分组得到 SKU × 仓库 × 区域的所有切片。"""
+    log_rows = _as_aggregates(df).rows(fee_codes=[FEE_CATEGORY_CODES["sales_logistics"]])
+    # 只统计物流费用 != 0 的记录
+    log_rows = log_rows[log_rows["delivery_row_count"] > 0]
+
+    grouped = _sum_by_keys(log_rows, {
+        "sales_logistics_count": "delivery_record_count",
+        "sales_logistics_sum": "delivery_to_customer",
+    }, by=by)
+    grouped = _rubles_columns(grouped, ["sales_logistics_sum"])
+
+    grouped["sales_logistics_per_unit"] = (
+        grouped["sales_logistics_sum"] / grouped["sales_logistics_count"]
+    ).round(4)
+
+    return grouped
+
+
+# ==============================
+# 7. 步骤5：取消订单物流费用（按SKU）
+# ==============================
+
+def compute_cancel_logistics_by_sku(df, by=BY_SKU) -> pd.DataFrame:
+    """by 为分组键：默认按 SKU，BY_WAREHOUSE_REGION 时一次分组得到 SKU × 仓库 × 区域的所有切片。"""
+    agg = _as_aggregates(df)
+    forward_rows = agg.rows(fee_codes=[FEE_CATEGORY_CODES["cancel_logistics_forward"]])
+    backward_rows = agg.rows(fee_codes=[FEE_CATEGORY_CODES["cancel_logistics_backward"]])
+
+    forward_g = _sum_by_keys(forward_rows, {
+        "forward_count": "record_count",
+        "forward_logistics_sum": "delivery_to_customer",
+    }, by=by)
+    backward_g = _sum_by_keys(backward_rows, {
+        "backward_count": "record_count",
+        "backward_logistics_sum": "delivery_to_customer",
+    }, by=by)
+
+    index, (forward_pos, backward_pos) = _key_index(by, [forward_g, backward_g])
+    forward_count = index.align(forward_pos, forward_g["forward_count"].to_numpy())
+    backward_count = index.align(backward_pos, backward_g["backward_count"].to_numpy())
+    forward_sum = index.align(forward_pos, forward_g["forward_logistics_sum"].to_numpy())
+    backward_sum = index.align(backward_pos, backward_g["backward_logistics_sum"].to_numpy())
+
+    total_cancel_records = forward_count + backward_count
+    cancel_qty = total_cancel_records / 2
+    total_cancel_logistics = to_rubles(forward_sum + backward_sum)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        per_unit = np.where(cancel_qty == 0, 0.0, total_cancel_logistics / cancel_qty)
+
+    result = index.select(np.ones(len(index), dtype=bool), {
+        "forward_count": forward_count,
+        "forward_logistics_sum": to_rubles(forward_sum),
+        "backward_count": backward_count,
+        "backward_logistics_sum": to_rubles(backward_sum),
+        "total_cancel_records": total_cancel_records,
+        "cancel_qty": cancel_qty,
+        "total_cancel_logistics": total_cancel_logistics,
+        "cancel_logistics_per_unit": np.round(per_unit, 4),
+    })
+    return result.rename(columns={"SKU": "barcode"})
+
+
+# ==============================
+# 8. 步骤6：每个 SKU 的取消率
+# ==============================
+
+def compute_cancellation_rate(sales_by_sku: pd.DataFrame,
+                              cancel_log_by_sku: pd.DataFrame,
+                              sku_index: SkuIndex = None,
+                              by=BY_SKU) -> pd.DataFrame:
+    """by 与两张输入表的分组键一致（默认按 SKU）；多列键时 sku_index 不使用。"""
+    sku_index, (sales_pos, cancel_pos) = _key_index(by, [sales_by_sku, cancel_log_by_sku], sku_index)
+
+    sales_qty = sku_index.align(sales_pos, sales_by_sku["sales_qty"].to_numpy())
+    cancel_qty = sku_index.align(cancel_pos, cancel_log_by_sku["cancel_qty"].to_numpy(dtype="float64"))
+    total_orders = sales_qty + cancel_qty
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(total_orders == 0, 0.0, cancel_qty / total_orders)
+
+    present = sku_index.present(sales_pos) | sku_index.present(cancel_pos)
+    result = sku_index.select(present, {
+        "sales_qty": sales_qty,
+        "cancel_qty": cancel_qty,
+        "total_orders": total_orders,
+        "cancellation_rate": np.round(rate, 4),
+    })
+    return result.rename(columns={"SKU": "barcode"})
+
+
+# ==============================
+# 8.1 仓库 × 区域：物流费用与取消率
+# ==============================
+
+UNKNOWN_WAREHOUSE = "未知仓库"
+ALL_WAREHOUSES = "全部仓库"
+
+
+def compute_logistics_by_warehouse_region(df) -> pd.DataFrame:
+    """
+    按 SKU × 仓库 × 区域的销售物流、取消物流和取消率。
+    聚合表本身带着仓库和区域键：先把三列键的组合一次编码成整数（按键排序，缺失值在最后），
+    销售件数、销售物流、取消物流再各按这个整数键分组一次，得到全部切片
+    （不是每个仓库 / 区域各跑一遍，也不反复对三列文本分组、排序），最后换回三列原文。
+    """
+    table = _as_aggregates(df).table
+    by = list(BY_WAREHOUSE_REGION)
+    slice_code = table.groupby(by, dropna=False, sort=True).ngroup().to_numpy()
+    # 后面只用整数键，文本键列不再随着每次筛选复制
+    agg = ReportAggregates(table.drop(columns=[*by, "unmapped_fee_type"]).assign(slice=slice_code))
+
+    key = ("slice",)
+    sales_log = compute_sales_logistics_by_sku(agg, by=key)
+    cancel_log = compute_cancel_logistics_by_sku(agg, by=key)
+    rate = compute_cancellation_rate(compute_sales_by_sku(agg, by=key), cancel_log, by=key)
+
+    index, (log_pos, cancel_pos, rate_pos) = _key_index(key, [sales_log, cancel_log, rate])
+    present = index.present(log_pos) | index.present(cancel_pos) | index.present(rate_pos)
+    result = index.select(present, {
+        "sales_qty": index.align(rate_pos, rate["sales_qty"].to_numpy()),
+        "sales_logistics_count": index.align(log_pos, sales_log["sales_logistics_count"].to_numpy()),
+        "sales_logistics_sum": index.align(log_pos, sales_log["sales_logistics_sum"].to_numpy()),
+        "sales_logistics_per_unit": index.align(log_pos, sales_log["sales_logistics_per_unit"].to_numpy()),
+        "cancel_qty": index.align(cancel_pos, cancel_log["cancel_qty"].to_numpy()),
+        "total_cancel_logistics": index.align(cancel_pos, cancel_log["total_cancel_logistics"].to_numpy()),
+        "cancel_logistics_per_unit": index.align(cancel_pos, cancel_log["cancel_logistics_per_unit"].to_numpy()),
+        "cancellation_rate": index.align(rate_pos, rate["cancellation_rate"].to_numpy()),
+    })
+    slices = table[by].iloc[_group_rows(slice_code)[result["slice"].to_numpy()]].reset_index(drop=True)
+    return pd.concat([slices, result.drop(columns="slice")], axis=1)
+
+
+def compute_logistics_per_unit_by_warehouse(logistics_by_warehouse_region: pd.DataFrame) -> pd.DataFrame:
+    """
+    单件销售物流费用的透视表：行为 SKU，列为“全部仓库”和各个仓库（各区域合并）。
+    每格 = 该仓库的销售物流费用之和 / 物流记录数（先在戈比上求和再相除，不是对单件费用取平均），
+    该 SKU 在这个仓库没有物流记录时为空。
+    """
+    rows = logistics_by_warehouse_region[logistics_by_warehouse_region["sales_logistics_count"] > 0]
+    skus = SkuIndex(rows["barcode"])
+    sku_pos = skus.positions(rows["barcode"])
+    warehouses = pd.Index(pd.unique(rows["warehouse"].fillna(UNKNOWN_WAREHOUSE))).sort_values()
+    warehouse_pos = warehouses.get_indexer(rows["warehouse"].fillna(UNKNOWN_WAREHOUSE))
+
+    # SKU × 仓库 的格子编号，一次 bincount 得到所有格子的记录数和金额
+    cell = sku_pos * len(warehouses) + warehouse_pos
+    n_cells = len(skus) * len(warehouses)
+    counts = np.bincount(cell, weights=rows["sales_logistics_count"].to_numpy(), minlength=n_cells)
+    kopecks = np.bincount(cell, weights=to_kopecks(rows["sales_logistics_sum"]), minlength=n_cells)
+    counts = counts.reshape(len(skus), len(warehouses))
+    kopecks = kopecks.reshape(len(skus), len(warehouses))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        per_unit = np.where(counts > 0, to_rubles(kopecks) / counts, np.nan).round(4)
+        overall = (to_rubles(kopecks.sum(axis=1)) / counts.sum(axis=1)).round(4)
+
+    return pd.DataFrame({
+        "SKU": skus.keys,
+        ALL_WAREHOUSES: overall,
+        **{name: per_unit[:, j] for j, name in enumerate(warehouses)},
+    })
+
+
+# ==============================
+# 9. 步骤7：费用分类汇总
+# ==============================
+
+# 费用汇总计入的四项金额
+FEE_COLUMNS = ["fine_total", "loyalty_service_fee", "loyalty_points_deduction", "delivery_to_customer"]
+
+
+def compute_fee_summary(df,
+                        profit_by_sku: pd.DataFrame) -> pd.DataFrame:
+    """
+    费用汇总表：
+      只保留两列：description / total_fee
+      行包括：
+        - 各费用类别（物流、罚款、忠诚计划等）
+        - 采购成本（来自净利润表）
+        - 总费用（以上全部之和）
+    """
+    # 1) 各费用类别（不包含采购成本）：一次分组求和得到所有类别的四项金额（戈比），
+    #    total_fee = 真正的费用：罚款 + 忠诚服务费 + 积分扣费 + 物流费用
+    fee_sums = get_backend().group_sum([_as_aggregates(df).table], ["fee_code"], FEE_COLUMNS).set_index("fee_code")
+    category_kopecks = (
+        fee_sums[FEE_COLUMNS].sum(axis=1)
+        .reindex([FEE_CATEGORY_CODES[cat] for cat in FEE_TYPE_MAP], fill_value=0)
+        .to_numpy(dtype="int64")
+    )
+    fee_kopecks_total = int(category_kopecks.sum())
+
+    rows = [
+        {"description": info["desc"], "total_fee": to_rubles(int(kopecks))}
+        for info, kopecks in zip(FEE_TYPE_MAP.values(), category_kopecks)
+    ]
+
+    # 2) 采购成本：来自净利润表中各 SKU 的“采购成本”（不含总计行）
+    if "采购成本" in profit_by_sku.columns:
+        purchase_total = float(sku_rows(profit_by_sku)["采购成本"].sum())
+    else:
+        purchase_total = 0.0
+
+    rows.append({
+        "description": "采购成本",
+        "total_fee": purchase_total,
+    })
+
+    # 3) 总费用 = 上面所有 total_fee 之和（各类费用在戈比上相加，再加采购成本）
+    total_all = to_rubles(fee_kopecks_total) + purchase_total
+
+    rows.append({
+        "description": "总费用",
+        "total_fee": total_all,
+    })
+
+    fee_df = pd.DataFrame(rows, columns=["description", "total_fee"])
+
+    return fee_df
+
+
+def compute_unmapped_fee_types(df) -> pd.DataFrame:
+    """
+    报表中出现、但不在 FEE_TYPE_MAP 中的费用类型（Виды логистики…）及其金额。
+    这些金额不计入费用汇总，单独列出来，方便补充 FEE_TYPE_MAP。
+    列：logistics_fee_type / rows / 四项费用金额 / total_fee（卢布），按类型排序；没有时为空表。
+    """
+    table = _as_aggregates(df).table
+    rows = table[table["unmapped_fee_type"].notna()]
+    sums = get_backend().group_sum([rows], ["unmapped_fee_type"], ["row_count", *FEE_COLUMNS])
+    sums["total_fee"] = sums[FEE_COLUMNS].sum(axis=1)
+    sums = (
+        sums.rename(columns={"unmapped_fee_type": "logistics_fee_type", "row_count": "rows"})
+        .sort_values("logistics_fee_type")
+        .reset_index(drop=True)
+    )
+    return _rubles_columns(sums, [*FEE_COLUMNS, "total_fee"])
+
+
+
+# ==============================
+# 10. 步骤8：总览 & 平台应付金额
+# ==============================
+
+def compute_final_overview(df,
+                           fee_summary: pd.DataFrame) -> pd.DataFrame:
+    agg = _as_aggregates(df)
+    sales_rows = agg.rows(reason_code=REASON_CODE_SALES)
+    returns_rows = agg.rows(reason_code=REASON_CODE_RETURNS)
+
+    total_sales_qty = int(sales_rows["row_count"].sum())
+    total_return_qty = int(returns_rows["row_count"].sum())
+
+    total_sales_kopecks = int(sales_rows["amount_payable_goods"].sum())
+    total_return_kopecks = int(returns_rows["amount_payable_goods"].sum())
+
+    total_sales_amount = to_rubles(total_sales_kopecks)
+    total_return_amount = to_rubles(total_return_kopecks)
+    net_sales_amount = to_rubles(total_sales_kopecks - total_return_kopecks)
+
+    total_fee_amount = float(
+          fee_summary.loc[fee_summary["description"] == "总费用", "total_fee"].iloc[0]
+    )
+    final_payable_amount = net_sales_amount - total_fee_amount
+
+    overview = pd.DataFrame(
+        [
+            {"metric": "total_sales_qty", "value": total_sales_qty},
+            {"metric": "total_return_qty", "value": total_return_qty},
+            {"metric": "total_sales_amount", "value": total_sales_amount},
+            {"metric": "total_return_amount", "value": total_return_amount},
+            {"metric": "net_sales_amount", "value": net_sales_amount},
+            {"metric": "total_fee_amount", "value": total_fee_amount},
+            {"metric": "final_payable_amount", "value": final_payable_amount},
+        ]
+    )
+
+    # 英文指标 -> 中文名称
+    metric_zh_map = {
+        "total_sales_qty": "销售件数",
+        "total_return_qty": "退货件数",
+        "total_sales_amount": "销售结算金额（含退货前）",
+        "total_return_amount": "退货结算金额",
+        "net_sales_amount": "净销售结算金额",
+        "total_fee_amount": "费用总额",
+        "final_payable_amount": "平台最终应付金额",
+    }
+
+    overview["metric_zh"] = overview["metric"].map(metric_zh_map)
+
+    # 调整列顺序：中文放前面
+    overview = overview[["metric_zh", "metric", "value"]]
+
+    return overview
+
+
+
+# ==============================
+# 11. 生成 summary.xlsx 供下载
+# ==============================
+
+try:
+    import xlsxwriter
+except ImportError:  # 没装 xlsxwriter 时用 openpyxl 的 write-only 模式
+    xlsxwriter = None
+
+# 导出时每次转换成 Python 对象的行数：整张表不会一次性全部变成对象
+EXPORT_CHUNK_ROWS = 20_000
+
+# summary.xlsx 的工作表名（顺序即工作表顺序），数据包中的文件名与之相同
+SUMMARY_SHEETS = {
+    "sales_by_sku": "Sales_by_SKU",
+    "returns_by_sku": "Returns_by_SKU",
+    "net_sales_by_sku": "Net_Sales_by_SKU",
+    "sales_logistics_by_sku": "Logistics_Sales",
+    "cancel_logistics_by_sku": "Logistics_Cancellations",
+    "cancellation_rate_by_sku": "Cancellation_Rate",
+    "fee_summary": "Fee_Summary",
+    "overview": "Final_Overview",
+    "profit_by_sku": "Profit_by_SKU",
+    "unmapped_fee_types": "Unmapped_Fee_Types",
+    "logistics_by_warehouse_region": "Logistics_Warehouse_Region",
+    "logistics_per_unit_by_warehouse": "Logistics_Per_Unit_Warehouse",
+}
+
+BUNDLE_FORMATS = ["parquet", "csv"]
+
+
+def _iter_sheet_rows(df: pd.DataFrame):
+    """表头 + 逐行数据（Python 标量，缺失值为 None），分块转换。"""
+    yield [str(c) for c in df.columns]
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        block = df.iloc[start:start + EXPORT_CHUNK_ROWS].astype(object)
+        block = block.where(block.notna(), None)
+        yield from block.itertuples(index=False, name=None)
+
+
+def write_summary_xlsx(sheets: dict, output):
+    """
+    流式写出多个工作表（sheets: 工作表名 -> DataFrame），output 为路径或文件对象。
+    优先用 xlsxwriter 的 constant_memory 模式（逐行落盘，内存只保留当前行）；
+    没有 xlsxwriter 时用 openpyxl write-only 模式，同样不在内存中构建整个单元格对象图。
+    """
+    if xlsxwriter is not None:
+        wb = xlsxwriter.Workbook(output, {"constant_memory": True})
+        for sheet_name, df in sheets.items():
+            ws = wb.add_worksheet(sheet_name)
+            for i, row in enumerate(_iter_sheet_rows(df)):
+                ws.write_row(i, 0, row)
+        wb.close()
+        return
+
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    for sheet_name, df in sheets.items():
+        ws = wb.create_sheet(sheet_name)
+        for row in _iter_sheet_rows(df):
+            ws.append(row)
+    wb.save(output)
+
+
+def build_summary_excel(week_label: str,
+                        sales_by_sku: pd.DataFrame,
+                        returns_by_sku: pd.DataFrame,
+                        net_sales_by_sku: pd.DataFrame,
+                        sales_logistics_by_sku: pd.DataFrame,
+                        cancel_logistics_by_sku: pd.DataFrame,
+                        cancellation_rate_by_sku: pd.DataFrame,
+                        fee_summary: pd.DataFrame,
+                        overview: pd.DataFrame,
+                        profit_by_sku: pd.DataFrame,
+                        unmapped_fee_types: pd.DataFrame,
+                        logistics_by_warehouse_region: pd.DataFrame,
+                        logistics_per_unit_by_warehouse: pd.DataFrame) -> bytes:
+
+    sheets = dict(zip(SUMMARY_SHEETS.values(), [
+        sales_by_sku, returns_by_sku, net_sales_by_sku,
+        sales_logistics_by_sku, cancel_logistics_by_sku, cancellation_rate_by_sku,
+        fee_summary, overview, profit_by_sku, unmapped_fee_types,
+        logistics_by_warehouse_region, logistics_per_unit_by_warehouse,
+    ]))
+
+    output = io.BytesIO()
+    write_summary_xlsx(sheets, output)
+    return output.getvalue()
+
+
+def build_data_bundle(bundle_format,
+                      week_label: str,
+                      sales_by_sku: pd.DataFrame,
+                      returns_by_sku: pd.DataFrame,
+                      net_sales_by_sku: pd.DataFrame,
+                      sales_logistics_by_sku: pd.DataFrame,
+                      cancel_logistics_by_sku: pd.DataFrame,
+                      cancellation_rate_by_sku: pd.DataFrame,
+                      fee_summary: pd.DataFrame,
+                      overview: pd.DataFrame,
+                      profit_by_sku: pd.DataFrame,
+                      unmapped_fee_types: pd.DataFrame,
+                      logistics_by_warehouse_region: pd.DataFrame,
+                      logistics_per_unit_by_warehouse: pd.DataFrame):
+    """
+    数据包：每张结果表一个 Parquet / CSV 文件，打成一个 zip，适合导入其它工具。
+    bundle_format 为 None 时不生成，返回 None。
+    CSV 用 utf-8-sig 编码，Excel 直接打开时中文、俄文不会乱码。
+    """
+    if bundle_format is None:
+        return None
+    if bundle_format not in BUNDLE_FORMATS:
+        raise ValueError(f"不支持的数据包格式：{bundle_format}")
+
+    tables = dict(zip(SUMMARY_SHEETS.values(), [
+        sales_by_sku, returns_by_sku, net_sales_by_sku,
+        sales_logistics_by_sku, cancel_logistics_by_sku, cancellation_rate_by_sku,
+        fee_summary, overview, profit_by_sku, unmapped_fee_types,
+        logistics_by_warehouse_region, logistics_per_unit_by_warehouse,
+    ]))
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for sheet_name, df in tables.items():
+            # 逐个文件直接写进 zip 条目，不在内存里另存一份完整文件
+            with zf.open(f"{week_label}/{sheet_name}.{bundle_format}", "w") as fh:
+                if bundle_format == "parquet":
+                    df.to_parquet(fh, index=False)
+                else:
+                    with io.TextIOWrapper(fh, encoding="utf-8-sig", newline="") as text:
+                        df.to_csv(text, index=False)
+    return output.getvalue()
+
+
+# ==============================
+# 12. 流水线阶段图（DAG）：每个阶段只执行一次，下游共享同一份结果
+# ==============================
+
+def empty_cost_table() -> pd.DataFrame:
+    return pd.DataFrame(columns=["SKU", "unit_cost"])
+
+
+def load_cost_table_or_empty(cost_file) -> pd.DataFrame:
+    """没有上传采购成本文件时，采购成本按 0 计算。"""
+    if cost_file is None:
+        return empty_cost_table()
+    return load_cost_table(cost_file)
+
+
+# 同时使用成本文件和成本库时，cost_df 的 cost_source 列标出每个 SKU 的成本来源
+COST_SOURCE_FILE = "file"
+COST_SOURCE_CATALOG = "catalog"
+
+
+def load_costs(cost_file, cost_catalog, cost_as_of, agg) -> pd.DataFrame:
+    """
+    本次分析使用的采购成本（SKU / unit_cost）。
+    传入成本库（cost_catalog.CostCatalog）时，按聚合结果中出现的 SKU 集合和 cost_as_of 日期一次查询取出；
+    本次还上传了成本文件时，文件中的 SKU 一律用文件里的成本（不论生效日期），成本库只补文件中没有的 SKU，
+    并多一列 cost_source 标出来源（见 catalog_fallback_skus）。不使用成本库时直接读取 cost_file。
+    """
+    if cost_catalog is None:
+        return load_cost_table_or_empty(cost_file)
+    skus = _as_aggregates(agg).table["barcode"].dropna().unique()
+    catalog = cost_catalog.lookup(skus, as_of=cost_as_of)
+    if cost_file is None:
+        return catalog
+    uploaded = load_cost_table(cost_file)
+    return (
+        pd.concat([
+            uploaded.assign(cost_source=COST_SOURCE_FILE),
+            catalog[~catalog["SKU"].isin(uploaded["SKU"])].assign(cost_source=COST_SOURCE_CATALOG),
+        ], ignore_index=True)
+        .sort_values("SKU", kind="stable")
+        .reset_index(drop=True)
+    )
+
+
+def catalog_fallback_skus(cost_df: pd.DataFrame) -> list:
+    """上传了成本文件、但文件中没有的 SKU：它们的成本取自成本库中已有的（较早的）记录。"""
+    if "cost_source" not in cost_df.columns:
+        return []
+    return cost_df.loc[cost_df["cost_source"] == COST_SOURCE_CATALOG, "SKU"].tolist()
+
+
+# 外部输入：合并后的聚合结果、采购成本文件、采购成本库及查询日期（None 表示不使用成本库 / 取最新版本）、
+# 周标签、数据包格式（None 表示不生成）
+PIPELINE_INPUTS = ["agg", "cost_file", "cost_catalog", "cost_as_of", "week_label", "bundle_format"]
+
+# 阶段名 -> (函数, 依赖)。依赖按函数参数顺序排列，可以是外部输入，也可以是其它阶段
+SUMMARY_TABLES = list(SUMMARY_SHEETS)
+
+PIPELINE_STAGES = {
+    "cost_df": (load_costs, ["cost_file", "cost_catalog", "cost_as_of", "agg"]),
+    "sku_index": (build_sku_index, ["agg", "cost_df"]),
+    "sales_by_sku": (compute_sales_by_sku, ["agg"]),
+    "returns_by_sku": (compute_returns_by_sku, ["agg"]),
+    "net_sales_body": (compute_net_sales_body, ["sales_by_sku", "returns_by_sku", "sku_index"]),
+    "net_sales_by_sku": (add_net_sales_total, ["net_sales_body"]),
+    "sales_logistics_by_sku": (compute_sales_logistics_by_sku, ["agg"]),
+    "cancel_logistics_by_sku": (compute_cancel_logistics_by_sku, ["agg"]),
+    "cancellation_rate_by_sku": (
+        compute_cancellation_rate,
+        ["sales_by_sku", "cancel_logistics_by_sku", "sku_index"],
+    ),
+    "logistics_by_warehouse_region": (compute_logistics_by_warehouse_region, ["agg"]),
+    "logistics_per_unit_by_warehouse": (
+        compute_logistics_per_unit_by_warehouse,
+        ["logistics_by_warehouse_region"],
+    ),
+    "profit_by_sku": (
+        compute_profit_by_sku,
+        ["net_sales_body", "sales_logistics_by_sku", "cancel_logistics_by_sku", "cost_df", "sku_index"],
+    ),
+    "fee_summary": (compute_fee_summary, ["agg", "profit_by_sku"]),
+    "unmapped_fee_types": (compute_unmapped_fee_types, ["agg"]),
+    "overview": (compute_final_overview, ["agg", "fee_summary"]),
+    "summary_excel": (build_summary_excel, ["week_label", *SUMMARY_TABLES]),
+    "data_bundle": (build_data_bundle, ["bundle_format", "week_label", *SUMMARY_TABLES]),
+}
+
+
+def stage_order(targets=None, stages=None) -> list:
+    """按依赖关系排好的阶段执行顺序（只包含 targets 需要的阶段，默认全部）。"""
+    stages = PIPELINE_STAGES if stages is None else stages
+    targets = list(stages) if targets is None else list(targets)
+    order, visiting = [], set()
+
+    def visit(name):
+        if name in order or name not in stages:
+            return
+        if name in visiting:
+            raise ValueError(f"流水线阶段存在循环依赖：{name}")
+        visiting.add(name)
+        for dep in stages[name][1]:
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in targets:
+        if name not in stages:
+            raise KeyError(f"未知的流水线阶段：{name}")
+        visit(name)
+    return order
+
+
+def stage_input_names(name: str, stages=None) -> list:
+    """某个阶段（直接或间接）依赖的外部输入。"""
+    stages = PIPELINE_STAGES if stages is None else stages
+    found = []
+    for dep in stages[name][1]:
+        names = stage_input_names(dep, stages) if dep in stages else [dep]
+        found.extend(n for n in names if n not in found)
+    return sorted(found)
+
+
+def _direct_call(name, fingerprint, fn, args):
+    return fn(*args)
+
+
+def run_pipeline(inputs: dict, input_keys=None, targets=None, runner=None, stages=None):
+    """
+    按阶段图执行流水线，每个阶段只执行一次，下游阶段直接共享上游的结果对象。
+    inputs：外部输入的值；input_keys：外部输入的内容标识（例如文件哈希），
+    用来给每个阶段生成 fingerprint，供 runner 做缓存。
+    runner(name, fingerprint, fn, args) 负责真正调用阶段函数，默认直接调用。
+    返回 (各阶段结果 dict, 各阶段耗时列表)。
+    """
+    stages = PIPELINE_STAGES if stages is None else stages
+    input_keys = input_keys or {}
+    runner = runner or _direct_call
+
+    results = {}
+    timings = []
+    for name in stage_order(targets, stages):
+        fn, deps = stages[name]
+        args = [results[d] if d in stages else inputs[d] for d in deps]
+        fingerprint = tuple(
+            (n, input_keys.get(n)) for n in stage_input_names(name, stages)
+        )
+        start = time.perf_counter()
+        results[name] = runner(name, fingerprint, fn, args)
+        timings.append({"stage": name, "seconds": time.perf_counter() - start, "runs": 1})
+
+    return results, timings
@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+# ==============================
+# 各阶段的轻量性能记录：耗时、输入/输出行数、RSS 峰值增量、结果表内存
+# ==============================
+#
+# StageProfiler.measure(name, fn, *args) 调用 fn 并记录一条数据；
+# wrap_runner(runner) 给 run_pipeline 的 runner 套上同样的记录。
+# 关闭时（enabled=False）measure 直接调用函数、wrap_runner 原样返回，没有额外开销。
+# RSS 由后台线程读取 /proc/self/statm 采样，非 Linux 系统上内存相关字段为空。
+# 本模块不依赖 streamlit，网页、批处理和基准测试共用。
+
+PROFILE_ENABLED = os.environ.get("WB_PROFILE", "1") != "0"
+SAMPLE_INTERVAL = 0.005
+
+
+def rss_bytes():
+    """当前进程的常驻内存（字节）；读不到时返回 None。"""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class PeakMemory:
+    """with 块内后台采样 RSS，记录开始值和峰值（MB）。"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start_mb = None
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = rss_bytes()
+            if rss is not None:
+                self.peak_mb = max(self.peak_mb, rss / 1024 / 1024)
+
+    def __enter__(self):
+        rss = rss_bytes()
+        if rss is not None:
+            self.start_mb = self.peak_mb = rss / 1024 / 1024
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            rss = rss_bytes()
+            if rss is not None:
+                self.peak_mb = max(self.peak_mb, rss / 1024 / 1024)
+
+    def as_dict(self) -> dict:
+        if self.start_mb is None:
+            return {"peak_rss_mb": None, "rss_delta_mb": None}
+        return {
+            "peak_rss_mb": round(self.peak_mb, 1),
+            "rss_delta_mb": round(self.peak_mb - self.start_mb, 1),
+        }
+
+
+def _frames(obj) -> list:
+    """obj 中的表：DataFrame、ReportAggregates 里的聚合表，或它们组成的列表。"""
+    if isinstance(obj, pd.DataFrame):
+        return [obj]
+    if isinstance(obj, (list, tuple)):
+        return [df for item in obj for df in _frames(item)]
+    table = getattr(obj, "table", None)
+    return [table] if isinstance(table, pd.DataFrame) else []
+
+
+def row_count(obj):
+    """obj 中所有表的总行数；不含表时返回 None。"""
+    frames = _frames(obj)
+    return sum(len(df) for df in frames) if frames else None
+
+
+def frame_memory_mb(obj):
+    frames = _frames(obj)
+    if not frames:
+        return None
+    return round(sum(df.memory_usage(deep=True).sum() for df in frames) / 1024 / 1024, 3)
+
+
+def _total(s: pd.Series):
+    """求和，全部缺失（没有表）时仍为缺失而不是 0。"""
+    return s.sum(min_count=1)
+
+
+class StageProfiler:
+    COLUMNS = ["stage", "seconds", "rows_in", "rows_out", "peak_rss_mb", "rss_delta_mb", "output_mb"]
+
+    def __init__(self, enabled: bool = PROFILE_ENABLED):
+        self.enabled = enabled
+        self.records = []
+
+    def _record(self, name: str, call, inputs):
+        with PeakMemory() as mem:
+            start = time.perf_counter()
+            result = call()
+            seconds = time.perf_counter() - start
+        self.records.append({
+            "stage": name,
+            "seconds": round(seconds, 4),
+            "rows_in": row_count(list(inputs)),
+            "rows_out": row_count(result),
+            **mem.as_dict(),
+            "output_mb": frame_memory_mb(result),
+        })
+        return result
+
+    def measure(self, name: str, fn, *args, **kwargs):
+        """调用 fn(*args, **kwargs)，记录耗时、行数和内存；关闭时直接调用。"""
+        if not self.enabled:
+            return fn(*args, **kwargs)
+        return self._record(name, lambda: fn(*args, **kwargs), list(args) + list(kwargs.values()))
+
+    def wrap_runner(self, runner=None):
+        """给 run_pipeline 的 runner（None 表示直接调用阶段函数）加上记录；关闭时原样返回。"""
+        if not self.enabled:
+            return runner
+
+        def profiled(name, fingerprint, fn, args):
+            if runner is None:
+                return self._record(name, lambda: fn(*args), args)
+            return self._record(name, lambda: runner(name, fingerprint, fn, args), args)
+
+        return profiled
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.records, columns=self.COLUMNS)
+
+    def summary(self) -> pd.DataFrame:
+        """同名阶段（例如逐份报表的解析）合并成一行：耗时和行数相加，内存取最大。"""
+        df = self.to_frame()
+        if df.empty:
+            return df
+        out = (
+            df.groupby("stage", sort=False)
+            .agg(
+                seconds=("seconds", "sum"),
+                runs=("stage", "size"),
+                rows_in=("rows_in", _total),
+                rows_out=("rows_out", _total),
+                peak_rss_mb=("peak_rss_mb", "max"),
+                rss_delta_mb=("rss_delta_mb", "max"),
+                output_mb=("output_mb", _total),
+            )
+            .reset_index()
+        )
+        out["seconds"] = out["seconds"].round(4)
+        out[["rows_in", "rows_out"]] = out[["rows_in", "rows_out"]].astype("Int64")
+        return out
+
+    def to_json(self, **meta) -> str:
+        return json.dumps({**meta, "stages": self.records}, ensure_ascii=False, indent=2)
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+# ==============================
+# 已解析报表的本地 Parquet 缓存
+# ==============================
+#
+# 以文件内容的哈希作为键，保存 COLUMN_MAP 重命名之后的 DataFrame。
+# 同一份 .xlsx 再次上传（哪怕文件名不同）时直接读 Parquet，跳过 openpyxl 解析。
+# 缓存目录总大小超过上限时，按最近使用时间（文件 mtime）淘汰最旧的条目。
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("WB_CACHE_DIR", Path.home() / ".cache" / "wb-finance-analyzer" / "reports")
+)
+DEFAULT_MAX_BYTES = int(os.environ.get("WB_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+
+def content_hash(data: bytes) -> str:
+    """文件内容的哈希，作为缓存键。"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ReportCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES, namespace: str = ""):
+        # namespace 会拼进缓存键：解析结果的格式变了，换一个 namespace 即可让旧条目自然失效
+        self.namespace = namespace
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.parquet"
+
+    def get(self, key: str):
+        """命中时返回 DataFrame 并刷新其最近使用时间，未命中返回 None。"""
+        path = self._path(key)
+        try:
+            df = pd.read_parquet(path)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return df
+
+    def put(self, key: str, df: pd.DataFrame) -> bool:
+        """写入缓存；列里混有无法写成 Parquet 的类型时放弃缓存，返回 False。"""
+        path = self._path(key)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            return False
+        self._evict()
+        return True
+
+    def fetch(self, data: bytes):
+        """按内容哈希查缓存并计入命中/未命中，返回 (key, DataFrame 或 None)。"""
+        key = content_hash(data)
+        if self.namespace:
+            key = f"{self.namespace}-{key}"
+        df = self.get(key)
+        with self._lock:
+            if df is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return key, df
+
+    def get_or_parse(self, data: bytes, parse):
+        """按内容哈希取缓存；未命中时调用 parse(data) 解析并写入缓存。"""
+        key, df = self.fetch(data)
+        if df is None:
+            df = parse(data)
+            self.put(key, df)
+        return df
+
+    def _evict(self):
+        """总大小超过 max_bytes 时，从最久未使用的条目开始删除。"""
+        with self._lock:
+            entries = []
+            for p in self.cache_dir.glob("*.parquet"):
+                try:
+                    info = p.stat()
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, p))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, p in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                p.unlink(missing_ok=True)
+                total -= size
+
+    def stats(self) -> dict:
+        entries = list(self.cache_dir.glob("*.parquet"))
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "size_mb": round(sum(p.stat().st_size for p in entries if p.exists()) / 1024 / 1024, 2),
+        }
@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows：只做进程内加锁
+    fcntl = None
+
+import pandas as pd
+
+# ==============================
+# 按周（按报表文件）持久化的聚合结果
+# ==============================
+#
+# 每份报表经 aggregate_report 得到的 (barcode, reason_code, fee_code) 聚合表
+# 都只是计数和求和，可以直接相加。这里把每份报表的聚合表存成一个 Parquet 分区，
+# 以文件内容哈希为键，manifest.json 记录文件名、期间等信息。
+# 多周汇总时直接读取已存的分区再合并，只有新上传的报表才需要解析和聚合；
+# 折扣率、单件物流费、取消率等比率由合并后的总和重新计算，而不是对各周求平均。
+
+DEFAULT_ROLLUP_DIR = Path(
+    os.environ.get("WB_ROLLUP_DIR", Path.home() / ".local" / "share" / "wb-finance-analyzer" / "rollups")
+)
+
+
+@contextmanager
+def _file_lock(path: Path):
+    """跨进程互斥（批处理会有多个进程同时写 manifest）。"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+# partitions() 返回的列（服务端通过 HTTP 返回同样的列）
+PARTITION_COLUMNS = ["key", "file_name", "period", "region", "rows", "stored_at"]
+
+
+class RollupStore:
+    def __init__(self, root=DEFAULT_ROLLUP_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._manifest_path = self.root / "manifest.json"
+        self._lock_path = self.root / "manifest.lock"
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.parquet"
+
+    def _read_manifest(self) -> dict:
+        try:
+            return json.loads(self._manifest_path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_manifest(self, manifest: dict):
+        tmp_path = self._manifest_path.with_name(f"manifest.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp_path, self._manifest_path)
+
+    def has(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str):
+        """读取一个分区的聚合表，不存在时返回 None。"""
+        try:
+            return pd.read_parquet(self._path(key))
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+
+    def put(self, key: str, table: pd.DataFrame, **meta):
+        """保存一个分区的聚合表；meta 中的信息（文件名、期间等）写入 manifest。"""
+        path = self._path(key)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        table.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+        with self._lock, _file_lock(self._lock_path):
+            manifest = self._read_manifest()
+            manifest[key] = {
+                **meta,
+                "rows": int(table["row_count"].sum()) if "row_count" in table.columns else None,
+                "stored_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            self._write_manifest(manifest)
+
+    def describe(self, key: str) -> dict:
+        """manifest 中记录的分区信息（文件名、期间等），没有记录时为空 dict。"""
+        return self._read_manifest().get(key, {})
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+        with self._lock, _file_lock(self._lock_path):
+            manifest = self._read_manifest()
+            manifest.pop(key, None)
+            self._write_manifest(manifest)
+
+    def partitions(self) -> pd.DataFrame:
+        """已存的所有分区（按期间排序），只列出 Parquet 文件仍然存在的条目。"""
+        manifest = self._read_manifest()
+        rows = [
+            {"key": key, **meta}
+            for key, meta in manifest.items()
+            if self.has(key)
+        ]
+        df = pd.DataFrame(rows, columns=PARTITION_COLUMNS)
+        return df.sort_values(["period", "file_name"], ignore_index=True)
@@ -0,0 +1,191 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from pipeline import SkuIndex, sku_rows
+
+# ==============================
+# 情景模拟（what-if）：多组参数 × SKU 的矩阵一次算出利润与平台应付金额的分布
+# ==============================
+#
+# “采购成本上涨 8%”“单件物流多 15 ₽”“取消量减半”这类问题不需要改成本表、重跑整条流水线：
+# 在已经算好的利润表、取消物流表和费用汇总上，每个 SKU 的利润可以拆成几项基数
+#   商品应付金额 A、销售物流 S、销售件数 q、取消 / 退货物流 C、采购成本 P
+# 每组情景参数只是这几项基数前面的系数：
+#   利润 = A·(1+价格)(1+销量) − S·(1+销量)(1+物流费率) − q·单件物流增量·(1+销量) − C·取消倍数·(1+物流费率)
+#          − P·(1+成本)(1+销量)
+# 于是 情景 × SKU 的利润矩阵 = 系数矩阵（情景 × 5）@ 基数矩阵（5 × SKU），按 SKU 分块做矩阵乘法，
+# 每块顺便统计亏损的 SKU 数、亏损概率、最差情况，不保留整张矩阵。
+# 各情景的利润总额只是 系数矩阵 @ 各项基数之和；平台应付金额 = 基准应付金额 + 利润总额的变化
+# （价格、物流、采购成本的变化同样体现在净销售额和费用总额中，罚款、忠诚计划等其它费用不变）。
+# 按 SKU 的期望和标准差直接由参数的均值和协方差算出。1000 组情景 × 5 万 SKU 约 0.3 秒。本模块不依赖 streamlit。
+
+SCENARIO_PARAMS = ["price_pct", "volume_pct", "cost_pct", "logistics_pct", "logistics_per_unit", "cancel_factor"]
+SCENARIO_PARAM_NAMES_ZH = {
+    "price_pct": "商品应付金额变化（比例）",
+    "volume_pct": "销量变化（比例）",
+    "cost_pct": "采购成本变化（比例）",
+    "logistics_pct": "物流费率变化（比例）",
+    "logistics_per_unit": "单件销售物流增加（₽）",
+    "cancel_factor": "取消量倍数",
+}
+# 不指定的参数取“不变”
+SCENARIO_DEFAULTS = {**{name: 0.0 for name in SCENARIO_PARAMS}, "cancel_factor": 1.0}
+
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+# 每次矩阵乘法处理的 SKU 数：1000 组情景时一块约 32 MB
+SKU_BLOCK = 4096
+
+
+def _complete(scenarios: pd.DataFrame) -> pd.DataFrame:
+    unknown = [c for c in scenarios.columns if c not in SCENARIO_PARAMS]
+    if unknown:
+        raise ValueError(f"未知的情景参数：{unknown}，可用的参数为 {SCENARIO_PARAMS}")
+    return pd.DataFrame({
+        name: scenarios[name].to_numpy(dtype="float64") if name in scenarios.columns
+        else np.full(len(scenarios), SCENARIO_DEFAULTS[name])
+        for name in SCENARIO_PARAMS
+    })
+
+
+def scenario_grid(**values) -> pd.DataFrame:
+    """各参数取值的全部组合，例如 scenario_grid(cost_pct=[0, 0.08], cancel_factor=[0.5, 1])。"""
+    names = list(values)
+    combos = list(itertools.product(*(np.atleast_1d(values[n]) for n in names)))
+    return _complete(pd.DataFrame(combos, columns=names))
+
+
+def sample_scenarios(n: int, ranges: dict, seed: int = 0) -> pd.DataFrame:
+    """n 组随机情景：ranges 为 {参数: (下限, 上限)}，在区间内均匀抽样；下限等于上限时为固定值。"""
+    rng = np.random.default_rng(seed)
+    return _complete(pd.DataFrame({
+        name: rng.uniform(low, high, n) if high > low else np.full(n, float(low))
+        for name, (low, high) in ranges.items()
+    }))
+
+
+def coefficients(scenarios: pd.DataFrame) -> np.ndarray:
+    """情景参数 -> 系数矩阵（情景 × 5），列依次对应基数 A、S、q、C、P。"""
+    p = _complete(scenarios)
+    volume = 1 + p["volume_pct"].to_numpy()
+    logistics = 1 + p["logistics_pct"].to_numpy()
+    return np.column_stack([
+        (1 + p["price_pct"].to_numpy()) * volume,
+        -volume * logistics,
+        -volume * p["logistics_per_unit"].to_numpy(),
+        -p["cancel_factor"].to_numpy() * logistics,
+        -(1 + p["cost_pct"].to_numpy()) * volume,
+    ])
+
+
+class ScenarioResult:
+    """
+    scenarios：每组情景的参数、利润总额、平台应付金额、亏损 SKU 数；
+    summary：三项指标在所有情景中的分布（均值、标准差、分位数、最小、最大）；
+    by_sku：每个 SKU 的基准利润、期望利润、标准差、亏损概率、最差情况的利润。
+    """
+
+    def __init__(self, scenarios: pd.DataFrame, summary: pd.DataFrame, by_sku: pd.DataFrame):
+        self.scenarios = scenarios
+        self.summary = summary
+        self.by_sku = by_sku
+
+
+class ScenarioModel:
+    """由一次分析的结果表建立的情景模型：按利润表中的 SKU 对齐各项基数（5 × SKU）。"""
+
+    def __init__(self,
+                 profit_by_sku: pd.DataFrame,
+                 cancel_logistics_by_sku: pd.DataFrame,
+                 fee_summary: pd.DataFrame,
+                 final_payable: float = None):
+        profit = sku_rows(profit_by_sku)
+        index = SkuIndex(profit["SKU"])
+        profit_pos = index.positions(profit["SKU"])
+        # 取消物流表中没有净销售的 SKU 不在利润表里，也不参与情景
+        cancel_pos = index.keys.get_indexer(cancel_logistics_by_sku["barcode"])
+        kept = cancel_pos >= 0
+        cancel_logistics = index.align(
+            cancel_pos[kept], cancel_logistics_by_sku["total_cancel_logistics"].to_numpy(dtype="float64")[kept],
+        )
+        payable = index.align(profit_pos, profit["商品应付金额"].to_numpy(dtype="float64"))
+        logistics = index.align(profit_pos, profit["物流费用"].to_numpy(dtype="float64"))
+
+        self.skus = index.keys
+        self.base_profit = index.align(profit_pos, profit["利润"].to_numpy(dtype="float64"))
+        self.basis = np.vstack([
+            payable,
+            logistics - cancel_logistics,
+            index.align(profit_pos, profit["销售件数"].to_numpy(dtype="float64")),
+            cancel_logistics,
+            index.align(profit_pos, profit["采购成本"].to_numpy(dtype="float64")),
+        ])
+        # 没有总览时，基准应付金额 = 各 SKU 的应付金额之和 − 费用总额
+        if final_payable is None:
+            total_fee = float(fee_summary.loc[fee_summary["description"] == "总费用", "total_fee"].iloc[0])
+            final_payable = float(payable.sum()) - total_fee
+        self.base_final_payable = final_payable
+        self.base_total_profit = float(self.base_profit.sum())
+
+    @classmethod
+    def from_results(cls, results: dict) -> "ScenarioModel":
+        overview = results["overview"]
+        final_payable = float(overview.loc[overview["metric"] == "final_payable_amount", "value"].iloc[0])
+        return cls(results["profit_by_sku"], results["cancel_logistics_by_sku"], results["fee_summary"], final_payable)
+
+    def __len__(self) -> int:
+        return len(self.skus)
+
+    def profit_matrix(self, scenarios: pd.DataFrame) -> np.ndarray:
+        """完整的 情景 × SKU 利润矩阵（只适合少量情景；大量情景请用 evaluate）。"""
+        return coefficients(scenarios) @ self.basis
+
+    def evaluate(self, scenarios: pd.DataFrame, quantiles=DEFAULT_QUANTILES, block: int = SKU_BLOCK) -> ScenarioResult:
+        params = _complete(scenarios)
+        if params.empty:
+            raise ValueError("至少需要一组情景参数。")
+        coef = coefficients(params)
+
+        total_profit = coef @ self.basis.sum(axis=1)
+        loss_skus = np.zeros(len(coef), dtype="int64")
+        loss_share = np.zeros(len(self))
+        worst = np.zeros(len(self))
+        # 转置后每块是 SKU × 情景，按行统计时内存连续
+        coef_t = np.ascontiguousarray(coef.T)
+        for start in range(0, len(self), block):
+            profit = self.basis[:, start:start + block].T @ coef_t
+            losing = profit < 0
+            loss_skus += losing.sum(axis=0)
+            loss_share[start:start + block] = losing.mean(axis=1)
+            worst[start:start + block] = profit.min(axis=1)
+
+        # 利润对系数是线性的：期望 = 系数均值 · 基数，方差 = 基数ᵀ · 系数协方差 · 基数
+        cov = np.atleast_2d(np.cov(coef, rowvar=False, bias=True))
+        expected = coef.mean(axis=0) @ self.basis
+        std = np.sqrt(np.maximum(np.einsum("ij,ik,kj->j", self.basis, cov, self.basis), 0.0))
+
+        scenario_table = params.assign(
+            total_profit=total_profit,
+            final_payable=self.base_final_payable + (total_profit - self.base_total_profit),
+            loss_skus=loss_skus,
+        )
+        by_sku = pd.DataFrame({
+            "SKU": self.skus,
+            "base_profit": self.base_profit,
+            "expected_profit": expected,
+            "profit_std": std,
+            "loss_probability": loss_share,
+            "worst_profit": worst,
+        })
+        return ScenarioResult(scenario_table, _distribution(scenario_table, quantiles), by_sku)
+
+
+def _distribution(scenario_table: pd.DataFrame, quantiles) -> pd.DataFrame:
+    metrics = ["total_profit", "final_payable", "loss_skus"]
+    values = scenario_table[metrics].to_numpy(dtype="float64")
+    rows = {"mean": values.mean(axis=0), "std": values.std(axis=0), "min": values.min(axis=0)}
+    for q in quantiles:
+        rows[f"p{round(q * 100):g}"] = np.quantile(values, q, axis=0)
+    rows["max"] = values.max(axis=0)
+    return pd.DataFrame(rows, index=metrics).rename_axis("metric").reset_index()
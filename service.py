@@ -0,0 +1,372 @@
+import argparse
+import io
+import json
+import os
+import sys
+
+import pandas as pd
+
+try:
+    from fastapi import FastAPI, File, Form, Request, UploadFile
+    from fastapi.responses import JSONResponse, Response
+except ImportError:  # 没装 fastapi 时不提供 HTTP 服务，AnalysisService 仍可直接使用
+    FastAPI = None
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+from cost_catalog import CostCatalog
+from ingest import DEFAULT_WORKERS
+from jobs import (
+    STATUS_DONE,
+    JobQueue,
+    analysis_request_key,
+    new_stage_memo,
+    run_analysis_job,
+)
+from pipeline import AGGREGATE_FORMAT, PARSED_REPORT_FORMAT, SUMMARY_TABLES
+from report_cache import ReportCache
+from rollup_store import RollupStore
+from table_pages import DEFAULT_PAGE_SIZE, page_table
+from trends import TrendStore
+
+# ==============================
+# 本机多人共用的分析服务（可选，需要 fastapi + uvicorn + python-multipart）
+# ==============================
+#
+# 几个人各开一个 Streamlit 会话分析同一批周报时，每个进程各自解析、聚合，CPU 和内存随人数增长。
+# 这里把后台任务队列、阶段缓存（StageMemo）、解析缓存、汇总库、成本库和周趋势库放进一个常驻进程，
+# 通过 localhost 上的 HTTP 接口提供给所有人：
+#   - 报表按内容哈希只解析、聚合一次（内存中的 StageMemo + 磁盘上的 ReportCache / RollupStore）；
+#   - 同时到达的相同请求（报表、成本、周标签和选项都相同）合并成一个任务（JobQueue 的 coalesce_key），
+#     已经算完的相同请求直接返回已有任务；
+#   - 网页设置 WB_SERVICE_URL 后只作为客户端（service_client.py），提交任务、轮询进度；
+#     结果表在服务端搜索、排序、分页，网页只取当前页，summary.xlsx 和数据包在点击下载时才传输。
+# AnalysisService 与 HTTP 框架无关；create_app 用 FastAPI 包一层。
+#
+#   python service.py --host 127.0.0.1 --port 8765
+#   WB_SERVICE_URL=http://127.0.0.1:8765 streamlit run online.py
+
+SERVICE_HOST = os.environ.get("WB_SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.environ.get("WB_SERVICE_PORT", "8765"))
+
+
+class JobNotReady(Exception):
+    """任务还没有完成（或已失败），没有结果可取。"""
+
+
+class UnknownPartitions(Exception):
+    """请求中的历史分区不在服务端的汇总库中（已删除，或是旧版本格式的分区）。"""
+
+
+def _named_bytes(name: str, data: bytes) -> io.BytesIO:
+    buf = io.BytesIO(data)
+    buf.name = name
+    return buf
+
+
+def _parquet_bytes(df: pd.DataFrame) -> bytes:
+    buf = io.BytesIO()
+    df.to_parquet(buf, index=False)
+    return buf.getvalue()
+
+
+class AnalysisService:
+    """服务进程内所有请求共用的状态。各参数为 None 时使用默认位置（与网页、批处理相同的环境变量）。"""
+
+    def __init__(self,
+                 queue: JobQueue = None,
+                 store: RollupStore = None,
+                 memo=None,
+                 cache: ReportCache = None,
+                 catalog: CostCatalog = None,
+                 trends: TrendStore = None,
+                 workers: int = DEFAULT_WORKERS):
+        self.queue = queue or JobQueue()
+        self.store = store or RollupStore()
+        self.memo = memo or new_stage_memo()
+        self.cache = cache or ReportCache(namespace=PARSED_REPORT_FORMAT)
+        self.catalog = catalog
+        self.trends = trends
+        self.workers = workers
+
+    def submit(self,
+               reports,
+               week_label: str,
+               cost=None,
+               stored_keys=(),
+               bundle_format=None,
+               use_cost_catalog: bool = False,
+               cost_effective=None,
+               out_of_core: bool = False,
+               backend: str = None,
+               profile: bool = False) -> dict:
+        """
+        reports 为 [(文件名, 字节)]，cost 为 (文件名, 字节) 或 None。
+        返回 {"job_id": 任务 ID, "coalesced": 是否并入了已有的相同任务}。
+        """
+        # 历史分区在提交时检查，不让任务在后台读取分区时才失败
+        unknown = [
+            k for k in dict.fromkeys(stored_keys)
+            if not k.startswith(f"{AGGREGATE_FORMAT}-") or not self.store.has(k)
+        ]
+        if unknown:
+            raise UnknownPartitions(f"汇总库中没有这些历史分区（可能已删除或格式已过期）：{', '.join(unknown)}")
+        files = [_named_bytes(name, data) for name, data in reports]
+        cost_file = None if cost is None else _named_bytes(*cost)
+        catalog = self._catalog() if use_cost_catalog else None
+        key = analysis_request_key(
+            files, stored_keys, cost_file, week_label, bundle_format,
+            cost_catalog=catalog, cost_effective=cost_effective, out_of_core=out_of_core,
+            backend=backend, profile=profile,
+        )
+        existing = self.queue.find(key)
+        job_id = self.queue.submit(
+            run_analysis_job, files, list(stored_keys), cost_file, week_label, bundle_format,
+            store=self.store, memo=self.memo, cache=self.cache, workers=self.workers,
+            cost_catalog=catalog, cost_effective=cost_effective, profile=profile,
+            out_of_core=out_of_core, backend=backend, trends=self.trends,
+            label=week_label, coalesce_key=key,
+        )
+        return {"job_id": job_id, "coalesced": existing is not None and existing.id == job_id}
+
+    def _catalog(self) -> CostCatalog:
+        if self.catalog is None:
+            self.catalog = CostCatalog()
+        return self.catalog
+
+    def _job(self, job_id: str):
+        job = self.queue.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job
+
+    @staticmethod
+    def _summary(job) -> dict:
+        return {"id": job.id, "label": job.label, "status": job.status, "created": job.created}
+
+    def jobs(self) -> list:
+        return [self._summary(job) for job in self.queue.jobs()]
+
+    def status(self, job_id: str) -> dict:
+        job = self._job(job_id)
+        progress = job.progress()
+        return {
+            **self._summary(job),
+            "error": job.error,
+            "elapsed": job.elapsed(),
+            "notes": job.notes,
+            "progress": {k: progress[k] for k in ("done", "total", "fraction", "current")},
+            "steps": progress["steps"],
+        }
+
+    def _done(self, job_id: str):
+        job = self._job(job_id)
+        if job.status != STATUS_DONE:
+            raise JobNotReady(f"任务 {job_id} 当前状态为 {job.status}，没有结果。")
+        return job
+
+    def result_meta(self, job_id: str) -> dict:
+        """
+        任务结果的概况：周标签、各阶段耗时、性能记录、去重结果，以及每张结果表的列名和行数。
+        结果表本身按页（table_page）或整张（table_parquet）另外取。
+        """
+        result = self._done(job_id).result
+        results = result["results"]
+        profiler = result["profiler"]
+        return json.loads(json.dumps({
+            "week_label": result["week_label"],
+            "bundle_format": result["bundle_format"],
+            "has_bundle": results["data_bundle"] is not None,
+            "stage_timings": result["stage_timings"],
+            "profiler": {"enabled": profiler.enabled, "records": profiler.records},
+            "duplicates": json.loads(result["duplicates"].to_json(orient="split", index=False, force_ascii=False)),
+            "tables": {name: {"columns": list(results[name].columns), "rows": len(results[name])}
+                       for name in SUMMARY_TABLES},
+        }, ensure_ascii=False, default=str))
+
+    def table_parquet(self, job_id: str, name: str) -> bytes:
+        """一张完整的结果表（Parquet），客户端需要整张表计算时使用（例如情景模拟）。"""
+        if name not in SUMMARY_TABLES:
+            raise KeyError(name)
+        return _parquet_bytes(self._done(job_id).result["results"][name])
+
+    def summary_excel(self, job_id: str) -> bytes:
+        return self._done(job_id).result["results"]["summary_excel"]
+
+    def data_bundle(self, job_id: str) -> bytes:
+        bundle = self._done(job_id).result["results"]["data_bundle"]
+        if bundle is None:
+            raise KeyError(f"{job_id} 的数据包")
+        return bundle
+
+    def table_page(self, job_id: str, name: str, search: str = "", sort_by: str = None,
+                   descending: bool = False, page: int = 1, page_size: int = DEFAULT_PAGE_SIZE) -> dict:
+        """一张结果表的一页（搜索、排序、分页规则与网页相同）。"""
+        results = self._done(job_id).result["results"]
+        if name not in SUMMARY_TABLES:
+            raise KeyError(name)
+        page_df, matched, pages = page_table(
+            results[name], search=search, sort_by=sort_by, descending=descending, page=page, page_size=page_size,
+        )
+        return {
+            "columns": list(page_df.columns),
+            "rows": json.loads(page_df.to_json(orient="values", force_ascii=False)),
+            "matched": matched,
+            "pages": pages,
+        }
+
+    def partitions(self) -> list:
+        return json.loads(self.store.partitions().to_json(orient="records", force_ascii=False))
+
+    def cost_catalog(self) -> dict:
+        return {"skus": len(self._catalog())}
+
+    def trend_summary(self) -> dict:
+        """周趋势库的概况：版本、已存档的周（按日期排列）和各周的费用汇总。没有周趋势库时为空。"""
+        if self.trends is None:
+            return {"version": "none", "weeks": [], "fees": {}}
+        weeks = self.trends.weeks()
+        return {
+            "version": self.trends.version(),
+            "weeks": weeks,
+            "fees": self.trends.fee_totals(weeks).to_dict(orient="index"),
+        }
+
+    def trend_week(self, week_label: str) -> bytes:
+        """一周存档的按 SKU 指标（Parquet）。"""
+        if self.trends is None:
+            raise KeyError(week_label)
+        return _parquet_bytes(self.trends.read_week(week_label))
+
+    def stats(self) -> dict:
+        return {
+            "jobs": len(self.queue.jobs()),
+            "stage_cache": json.loads(self.memo.stats_frame().to_json(orient="records", force_ascii=False)),
+            "parse_cache": self.cache.stats(),
+        }
+
+
+def create_app(service: AnalysisService = None):
+    """FastAPI 应用：/jobs 提交与查询任务，/jobs/{id}/result 为结果概况，结果表按页取。"""
+    if FastAPI is None:
+        raise RuntimeError("分析服务需要 fastapi、uvicorn 和 python-multipart：pip install fastapi uvicorn python-multipart")
+    service = service or AnalysisService()
+    app = FastAPI(title="WB 财务报表分析服务")
+    app.state.service = service
+
+    @app.exception_handler(KeyError)
+    def not_found(request: Request, exc: KeyError):
+        return JSONResponse(status_code=404, content={"detail": f"不存在：{exc.args[0]}"})
+
+    @app.exception_handler(JobNotReady)
+    def not_ready(request: Request, exc: JobNotReady):
+        return JSONResponse(status_code=409, content={"detail": str(exc)})
+
+    @app.exception_handler(UnknownPartitions)
+    def unknown_partitions(request: Request, exc: UnknownPartitions):
+        return JSONResponse(status_code=422, content={"detail": str(exc)})
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok"}
+
+    @app.get("/stats")
+    def stats():
+        return service.stats()
+
+    @app.get("/partitions")
+    def partitions():
+        return service.partitions()
+
+    @app.get("/cost-catalog")
+    def cost_catalog():
+        return service.cost_catalog()
+
+    @app.get("/trends")
+    def trends():
+        return service.trend_summary()
+
+    @app.get("/trends/{week_label}")
+    def trend_week(week_label: str):
+        return Response(service.trend_week(week_label), media_type="application/octet-stream")
+
+    @app.get("/jobs")
+    def jobs():
+        return service.jobs()
+
+    @app.post("/jobs")
+    def submit(week_label: str = Form(...),
+               reports: list[UploadFile] = File(default=[]),
+               cost: UploadFile | None = File(default=None),
+               stored_keys: list[str] = Form(default=[]),
+               bundle_format: str = Form(default=""),
+               use_cost_catalog: bool = Form(default=False),
+               cost_effective: str = Form(default=""),
+               out_of_core: bool = Form(default=False),
+               backend: str = Form(default=""),
+               profile: bool = Form(default=False)):
+        return service.submit(
+            [(f.filename, f.file.read()) for f in reports],
+            week_label,
+            cost=None if cost is None else (cost.filename, cost.file.read()),
+            stored_keys=stored_keys,
+            bundle_format=bundle_format or None,
+            use_cost_catalog=use_cost_catalog,
+            cost_effective=cost_effective or None,
+            out_of_core=out_of_core,
+            backend=backend or None,
+            profile=profile,
+        )
+
+    @app.get("/jobs/{job_id}")
+    def status(job_id: str):
+        return service.status(job_id)
+
+    @app.get("/jobs/{job_id}/result")
+    def result(job_id: str):
+        return service.result_meta(job_id)
+
+    @app.get("/jobs/{job_id}/summary.xlsx")
+    def summary_excel(job_id: str):
+        return Response(
+            service.summary_excel(job_id),
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
+    @app.get("/jobs/{job_id}/bundle.zip")
+    def data_bundle(job_id: str):
+        return Response(service.data_bundle(job_id), media_type="application/zip")
+
+    # 要在 /tables/{name} 之前注册，否则 {name} 会匹配到 "xxx.parquet"
+    @app.get("/jobs/{job_id}/tables/{name}.parquet")
+    def table_parquet(job_id: str, name: str):
+        return Response(service.table_parquet(job_id, name), media_type="application/octet-stream")
+
+    @app.get("/jobs/{job_id}/tables/{name}")
+    def table(job_id: str, name: str, search: str = "", sort_by: str = None, descending: bool = False,
+              page: int = 1, page_size: int = DEFAULT_PAGE_SIZE):
+        return service.table_page(job_id, name, search, sort_by, descending, page, page_size)
+
+    return app
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="WB 财务报表分析服务（本机多人共用缓存）")
+    parser.add_argument("--host", default=SERVICE_HOST, help="监听地址（默认只监听本机）")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT, help="端口")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="每个任务解析报表的进程数")
+    args = parser.parse_args(argv)
+    if FastAPI is None or uvicorn is None:
+        print("分析服务需要 fastapi、uvicorn 和 python-multipart：pip install fastapi uvicorn python-multipart",
+              file=sys.stderr)
+        return 1
+    # 只有一个服务进程：所有会话共用同一份内存缓存
+    uvicorn.run(create_app(AnalysisService(workers=args.workers, trends=TrendStore())), host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,370 @@
+import io
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Mapping
+from urllib.error import HTTPError
+from urllib.parse import quote, urlencode
+from urllib.request import Request, urlopen
+
+import pandas as pd
+
+from jobs import STATUS_DONE, STATUS_FAILED
+from pipeline import file_bytes, file_name
+from profiling import StageProfiler
+from rollup_store import PARTITION_COLUMNS
+from table_pages import DEFAULT_PAGE_SIZE
+from trends import TrendMatrix
+
+# ==============================
+# 分析服务（service.py）的客户端：只用标准库 urllib，网页和压测脚本共用
+# ==============================
+#
+# RemoteJobQueue / RemoteJob 的用法与 jobs.JobQueue / jobs.Job 相同（submit、get、jobs、status、progress、result …），
+# 设置 WB_SERVICE_URL 后网页把任务提交给服务，自己不再解析、计算，只展示结果。
+# 已完成任务的结果不会再变。结果只先取概况（各表的列名、行数等），网页上的表按页向服务请求，
+# 需要整张表时（总览指标、情景模拟）才下载该表并按任务 ID 留在本进程中；summary.xlsx 和数据包在点击下载时才取。
+
+SERVICE_URL = os.environ.get("WB_SERVICE_URL", "").rstrip("/")
+SERVICE_TIMEOUT = float(os.environ.get("WB_SERVICE_TIMEOUT", "300"))
+# 本进程保留结果的任务数
+CLIENT_RESULTS = int(os.environ.get("WB_SERVICE_CLIENT_RESULTS", "4"))
+
+
+class ServiceError(Exception):
+    """服务返回了错误（status 为 HTTP 状态码）。"""
+
+    def __init__(self, status: int, detail: str):
+        super().__init__(f"分析服务返回 {status}：{detail}")
+        self.status = status
+        self.detail = detail
+
+
+def _multipart(fields, files):
+    """fields：[(名称, 值)]，files：[(名称, 文件名, 字节)] -> (请求体, Content-Type)。"""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields:
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode())
+        body.write(str(value).encode())
+        body.write(b"\r\n")
+    for name, filename, data in files:
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{quote(filename)}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n".encode()
+        )
+        body.write(data)
+        body.write(b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    return body.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+
+class RemoteTable:
+    """
+    服务端任务的一张结果表。columns / len() 来自结果概况；page() 由服务端搜索、排序、分页，只返回当前页，
+    参数和返回值与 table_pages.page_table 相同；frame() 下载整张表（只下载一次）。
+    """
+
+    def __init__(self, client: "ServiceClient", job_id: str, name: str, columns: list, rows: int):
+        self.client = client
+        self.job_id = job_id
+        self.name = name
+        self.columns = pd.Index(columns)
+        self.rows = rows
+        self._frame = None
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def page(self, search: str = "", sort_by: str = None, descending: bool = False,
+             page: int = 1, page_size: int = DEFAULT_PAGE_SIZE):
+        data = self.client.table_page(
+            self.job_id, self.name, search=search, sort_by=sort_by, descending=descending,
+            page=page, page_size=page_size,
+        )
+        return pd.DataFrame(data["rows"], columns=data["columns"]), data["matched"], data["pages"]
+
+    def frame(self) -> pd.DataFrame:
+        if self._frame is None:
+            self._frame = self.client.table_frame(self.job_id, self.name)
+        return self._frame
+
+
+class RemoteResults(Mapping):
+    """
+    服务端任务的结果，键与 jobs.analyze 返回的 results 相同：results[表名] 为整张表（第一次取用时下载），
+    summary_excel / data_bundle 每次取用时下载、不在本进程保留。网页上分页显示的表用 table(表名)。
+    """
+
+    def __init__(self, client: "ServiceClient", job_id: str, tables: dict, has_bundle: bool):
+        self.client = client
+        self.job_id = job_id
+        self.has_bundle = has_bundle
+        self._tables = {name: RemoteTable(client, job_id, name, **info) for name, info in tables.items()}
+
+    def table(self, name: str) -> RemoteTable:
+        return self._tables[name]
+
+    def __getitem__(self, name: str):
+        if name == "summary_excel":
+            return self.client.summary_excel(self.job_id)
+        if name == "data_bundle":
+            return self.client.data_bundle(self.job_id) if self.has_bundle else None
+        return self._tables[name].frame()
+
+    def __iter__(self):
+        return iter([*self._tables, "summary_excel", "data_bundle"])
+
+    def __len__(self) -> int:
+        return len(self._tables) + 2
+
+
+class ServiceClient:
+    def __init__(self, base_url: str = SERVICE_URL, timeout: float = SERVICE_TIMEOUT):
+        if not base_url:
+            raise ValueError("没有分析服务地址：请设置 WB_SERVICE_URL（例如 http://127.0.0.1:8765）。")
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, path: str, data: bytes = None, content_type: str = None) -> bytes:
+        request = Request(self.base_url + path, data=data)
+        if content_type:
+            request.add_header("Content-Type", content_type)
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return response.read()
+        except HTTPError as e:
+            try:
+                detail = json.loads(e.read()).get("detail", e.reason)
+            except ValueError:
+                detail = e.reason
+            raise ServiceError(e.code, detail) from None
+
+    def _json(self, path: str, **kwargs):
+        return json.loads(self._request(path, **kwargs))
+
+    def health(self) -> dict:
+        return self._json("/health")
+
+    def stats(self) -> dict:
+        return self._json("/stats")
+
+    def partitions(self) -> pd.DataFrame:
+        return pd.DataFrame(self._json("/partitions"), columns=PARTITION_COLUMNS)
+
+    def cost_catalog(self) -> dict:
+        return self._json("/cost-catalog")
+
+    def trends(self) -> dict:
+        return self._json("/trends")
+
+    def trend_week(self, week_label: str) -> pd.DataFrame:
+        return pd.read_parquet(io.BytesIO(self._request(f"/trends/{quote(week_label)}")))
+
+    def submit(self,
+               files,
+               week_label: str,
+               cost_file=None,
+               stored_keys=(),
+               bundle_format=None,
+               use_cost_catalog: bool = False,
+               cost_effective=None,
+               out_of_core: bool = False,
+               backend: str = None,
+               profile: bool = False) -> dict:
+        """files / cost_file 为上传的文件对象（或带 .name 的 BytesIO）。返回 {"job_id", "coalesced"}。"""
+        fields = [
+            ("week_label", week_label),
+            ("bundle_format", bundle_format or ""),
+            ("use_cost_catalog", str(bool(use_cost_catalog)).lower()),
+            ("cost_effective", "" if cost_effective is None else str(cost_effective)),
+            ("out_of_core", str(bool(out_of_core)).lower()),
+            ("backend", backend or ""),
+            ("profile", str(bool(profile)).lower()),
+            *(("stored_keys", key) for key in stored_keys),
+        ]
+        uploads = [("reports", file_name(f), file_bytes(f)) for f in files]
+        if cost_file is not None:
+            uploads.append(("cost", file_name(cost_file), file_bytes(cost_file)))
+        body, content_type = _multipart(fields, uploads)
+        return self._json("/jobs", data=body, content_type=content_type)
+
+    def jobs(self) -> list:
+        return self._json("/jobs")
+
+    def status(self, job_id: str) -> dict:
+        return self._json(f"/jobs/{quote(job_id)}")
+
+    def result(self, job_id: str) -> dict:
+        """已完成任务的结果，结构与 jobs.analyze 的返回值相同；results 为 RemoteResults，表在取用时才下载。"""
+        meta = self._json(f"/jobs/{quote(job_id)}/result")
+        profiler = StageProfiler(enabled=meta["profiler"]["enabled"])
+        profiler.records = meta["profiler"]["records"]
+        duplicates = meta["duplicates"]
+        return {
+            "results": RemoteResults(self, job_id, meta["tables"], meta["has_bundle"]),
+            "stage_timings": meta["stage_timings"],
+            "duplicates": pd.DataFrame(duplicates["data"], columns=duplicates["columns"]),
+            "profiler": profiler,
+            "week_label": meta["week_label"],
+            "bundle_format": meta["bundle_format"],
+        }
+
+    def summary_excel(self, job_id: str) -> bytes:
+        return self._request(f"/jobs/{quote(job_id)}/summary.xlsx")
+
+    def data_bundle(self, job_id: str) -> bytes:
+        return self._request(f"/jobs/{quote(job_id)}/bundle.zip")
+
+    def table_frame(self, job_id: str, name: str) -> pd.DataFrame:
+        return pd.read_parquet(io.BytesIO(self._request(f"/jobs/{quote(job_id)}/tables/{quote(name)}.parquet")))
+
+    def table_page(self, job_id: str, name: str, **params) -> dict:
+        query = urlencode({
+            k: str(v).lower() if isinstance(v, bool) else v
+            for k, v in params.items() if v is not None
+        })
+        return self._json(f"/jobs/{quote(job_id)}/tables/{quote(name)}?{query}")
+
+    def wait(self, job_id: str, poll: float = 0.5, timeout: float = None) -> dict:
+        """轮询到任务结束（完成或失败），返回最后一次的状态。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            status = self.status(job_id)
+            if status["status"] in (STATUS_DONE, STATUS_FAILED):
+                return status
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"任务 {job_id} 在 {timeout} 秒内没有完成")
+            time.sleep(poll)
+
+
+class RemoteJob:
+    """服务上一个任务某一时刻的状态，属性与 jobs.Job 相同；result 在第一次访问时取。"""
+
+    def __init__(self, queue: "RemoteJobQueue", status: dict):
+        self._queue = queue
+        self._status = status
+        self.id = status["id"]
+        self.label = status["label"]
+        self.status = status["status"]
+        self.created = status["created"]
+        self.error = status.get("error")
+        self.notes = [tuple(n) for n in status.get("notes", [])]
+        self.meta = queue.meta.get(self.id, {})
+
+    @property
+    def result(self):
+        if self.status != STATUS_DONE:
+            return None
+        return self._queue.result(self.id)
+
+    def progress(self) -> dict:
+        return {"status": self.status, **self._status["progress"], "steps": self._status["steps"]}
+
+    def steps_frame(self) -> pd.DataFrame:
+        steps = pd.DataFrame(self._status["steps"], columns=["stage", "status", "seconds"])
+        if steps.empty:
+            return steps
+        return (
+            steps.assign(done=steps["status"] == STATUS_DONE)
+            .groupby("stage", sort=False)
+            .agg(runs=("stage", "size"), done=("done", "sum"), seconds=("seconds", "sum"))
+            .reset_index()
+        )
+
+    def elapsed(self):
+        return self._status.get("elapsed")
+
+
+class RemoteJobQueue:
+    """
+    接口与 jobs.JobQueue 相同的远程任务队列。submit 的第一个参数（任务函数）和 store / memo / cache / trends
+    由服务端决定，这里忽略；cost_catalog 不为 None 表示使用服务端的成本库。
+    """
+
+    def __init__(self, client: ServiceClient = None):
+        self.client = client or ServiceClient()
+        self.meta = {}  # 任务 ID -> 提交时的 meta（只在本进程中使用，例如网页上选择的数据包格式）
+        self._results = OrderedDict()
+
+    def submit(self, fn, files, stored_keys, cost_file, week_label, bundle_format,
+               label: str = "", meta: dict = None, coalesce_key=None, cost_catalog=None, cost_effective=None,
+               out_of_core: bool = False, backend: str = None, profile: bool = False, **_server_side) -> str:
+        job_id = self.client.submit(
+            files, week_label, cost_file=cost_file, stored_keys=stored_keys, bundle_format=bundle_format,
+            use_cost_catalog=cost_catalog is not None, cost_effective=cost_effective, out_of_core=out_of_core,
+            backend=backend, profile=profile,
+        )["job_id"]
+        if meta:
+            self.meta[job_id] = meta
+        return job_id
+
+    def get(self, job_id):
+        try:
+            return RemoteJob(self, self.client.status(job_id))
+        except ServiceError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def jobs(self) -> list:
+        return [
+            RemoteJob(self, {**job, "progress": {}, "steps": []})
+            for job in self.client.jobs()
+        ]
+
+    def result(self, job_id: str) -> dict:
+        result = self._results.get(job_id)
+        if result is None:
+            result = self._results[job_id] = self.client.result(job_id)
+            while len(self._results) > CLIENT_RESULTS:
+                self._results.popitem(last=False)
+        return result
+
+
+class RemoteRollupStore:
+    """服务端汇总库的只读视图（网页上列出可选的历史分区）；分区的读写都在服务端完成。"""
+
+    def __init__(self, client: ServiceClient = None):
+        self.client = client or ServiceClient()
+
+    def partitions(self) -> pd.DataFrame:
+        return self.client.partitions()
+
+
+class RemoteCostCatalog:
+    """服务端的采购成本库：传给 RemoteJobQueue.submit 表示使用服务端的成本库，len() 为其中的 SKU 数。"""
+
+    def __init__(self, client: ServiceClient = None):
+        self.client = client or ServiceClient()
+
+    def __len__(self) -> int:
+        return self.client.cost_catalog()["skus"]
+
+
+class RemoteTrendStore:
+    """
+    服务端的周趋势库（只读），读取接口与 trends.TrendStore 相同（version、weeks、fee_totals、matrix）；
+    周趋势由服务端的任务写入。
+    """
+
+    def __init__(self, client: ServiceClient = None):
+        self.client = client or ServiceClient()
+
+    def version(self) -> str:
+        return self.client.trends()["version"]
+
+    def weeks(self) -> list:
+        return self.client.trends()["weeks"]
+
+    def fee_totals(self, weeks=None) -> pd.DataFrame:
+        summary = self.client.trends()
+        weeks = summary["weeks"] if weeks is None else list(weeks)
+        df = pd.DataFrame([summary["fees"][w] for w in weeks], index=pd.Index(weeks, name="week_label"))
+        return df.fillna(0.0)
+
+    def matrix(self, weeks=None) -> TrendMatrix:
+        weeks = self.weeks() if weeks is None else list(weeks)
+        return TrendMatrix.from_frames(weeks, [self.client.trend_week(w) for w in weeks])
@@ -0,0 +1,56 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+# ==============================
+# 共享 SKU 字典：条码文本 <-> 整数编码
+# ==============================
+#
+# 明细表里的 barcode 是文本，groupby / isin 都要做字符串哈希。
+# 这里给每个条码分配一个只增不减的 int32 编码，聚合时直接按整数分组。
+# 编码只在字典的作用范围内有效：写入缓存、汇总库的结果仍然使用条码文本。
+# 字典只增不减，所以没有进程内共用的字典，由调用方限定作用范围：aggregate_report 每次用一本新字典，
+# load_week_data_from_upload 的紧凑明细用调用方传入的字典（之后聚合也传同一本），用完即随之释放，
+# 常驻的分析服务、监视目录进程不会越积越大。
+
+MISSING_CODE = -1
+
+
+class SkuDictionary:
+    def __init__(self):
+        self._codes = {}
+        self._barcodes = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._barcodes)
+
+    def encode(self, values) -> np.ndarray:
+        """条码（文本）-> int32 编码；缺失值编码为 MISSING_CODE。只对去重后的条码查字典。"""
+        codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=True)
+        uniques = np.asarray(uniques, dtype=object).tolist()
+        with self._lock:
+            unique_codes = np.array([self._code(u) for u in uniques], dtype=np.int32)
+        out = np.full(len(codes), MISSING_CODE, dtype=np.int32)
+        present = codes >= 0
+        out[present] = unique_codes[codes[present]]
+        return out
+
+    def _code(self, barcode) -> int:
+        code = self._codes.get(barcode)
+        if code is None and not isinstance(barcode, str):
+            barcode = str(barcode)
+            code = self._codes.get(barcode)
+        if code is None:
+            code = len(self._barcodes)
+            self._codes[barcode] = code
+            self._barcodes.append(barcode)
+        return code
+
+    def decode(self, codes) -> np.ndarray:
+        """int 编码 -> 条码文本（object 数组），MISSING_CODE 还原为 None。只查本次出现的编码，不复制整本字典。"""
+        inverse, uniques = pd.factorize(np.asarray(codes))
+        with self._lock:
+            labels = [None if c == MISSING_CODE else self._barcodes[c] for c in uniques.tolist()]
+        return np.array(labels + [None], dtype=object)[inverse]
@@ -0,0 +1,67 @@
+import math
+
+import pandas as pd
+
+from pipeline import TOTAL_LABEL
+
+# ==============================
+# 结果表的服务端分页、排序和 SKU 搜索
+# ==============================
+#
+# 按 SKU 的结果表可能有几万行，整表交给 st.dataframe 会把所有行序列化后发到浏览器。
+# 这里在服务端先筛选、排序、切出当前页，前端只收到一页数据。
+# 净销售、利润表首行的“总计”固定显示在每一页的最上面，不参与搜索和排序。
+# 本模块不依赖 streamlit。
+
+PAGE_SIZES = [50, 100, 500, 1000]
+DEFAULT_PAGE_SIZE = 100
+SKU_COLUMNS = ["SKU", "barcode"]
+
+
+def sku_column(df: pd.DataFrame):
+    """表中的 SKU 列名；不是按 SKU 的表时返回 None。"""
+    for col in SKU_COLUMNS:
+        if col in df.columns:
+            return col
+    return None
+
+
+def split_total_row(df: pd.DataFrame):
+    """(总计行, 其余行)；没有总计行时前者为空表。"""
+    col = sku_column(df)
+    if col is None:
+        return df.iloc[:0], df
+    is_total = (df[col] == TOTAL_LABEL).to_numpy()
+    if not is_total.any():
+        return df.iloc[:0], df
+    return df[is_total], df[~is_total]
+
+
+def page_table(df: pd.DataFrame,
+               search: str = "",
+               sort_by: str = None,
+               descending: bool = False,
+               page: int = 1,
+               page_size: int = DEFAULT_PAGE_SIZE):
+    """
+    按 SKU 搜索（子串匹配，不区分大小写）、按 sort_by 排序后取出第 page 页（从 1 开始）。
+    返回 (当前页的表, 匹配的行数, 总页数)；page 超出范围时取最后一页。
+    """
+    total, rows = split_total_row(df)
+
+    col = sku_column(rows)
+    search = (search or "").strip()
+    if search and col is not None:
+        rows = rows[rows[col].astype("str").str.contains(search, case=False, regex=False, na=False)]
+
+    if sort_by is not None and sort_by in rows.columns:
+        rows = rows.sort_values(sort_by, ascending=not descending, kind="stable", na_position="last")
+
+    matched = len(rows)
+    pages = max(1, math.ceil(matched / page_size))
+    page = min(max(1, int(page)), pages)
+    start = (page - 1) * page_size
+    page_df = rows.iloc[start:start + page_size]
+    if len(total):
+        page_df = pd.concat([total, page_df])
+    return page_df, matched, pages
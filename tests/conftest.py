@@ -0,0 +1,23 @@
+import pytest
+
+from rollup_store import RollupStore
+from synthetic_reports import report_file
+
+# ==============================
+# 测试共用的夹具：合成报表（benchmarks/synthetic_reports.py）写成内存中的 .xlsx、临时汇总库
+# ==============================
+
+
+@pytest.fixture
+def split_report():
+    """把一份合成报表从中间拆成两份 .xlsx：split_report(df, 第一份文件名, 第二份文件名)。"""
+    def split(df, first: str, second: str):
+        half = len(df) // 2
+        return [report_file(df.iloc[:half], first), report_file(df.iloc[half:], second)]
+    return split
+
+
+@pytest.fixture
+def rollup_store(tmp_path):
+    """临时目录中的汇总库。"""
+    return RollupStore(tmp_path / "rollups")
@@ -0,0 +1,32 @@
+import io
+
+import pytest
+
+from backend_parity import diff_tables, run_backend
+from pipeline import aggregate_report
+from synthetic_reports import generate_cost_table, iter_reports, report_to_parsed, report_to_xlsx
+
+SKUS = 300
+
+
+@pytest.fixture(scope="module")
+def weekly_tables():
+    return [
+        aggregate_report(report_to_parsed(report)).table
+        for report in iter_reports(30_000, rows_per_file=10_000, skus=SKUS, seed=3)
+    ]
+
+
+@pytest.fixture(scope="module")
+def cost_bytes():
+    buf = io.BytesIO()
+    report_to_xlsx(generate_cost_table(SKUS, seed=3), buf)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("name", ["polars", "duckdb"])
+def test_backend_matches_pandas(name, weekly_tables, cost_bytes):
+    pytest.importorskip(name)
+    expected, _, _ = run_backend("pandas", weekly_tables, cost_bytes)
+    actual, _, _ = run_backend(name, weekly_tables, cost_bytes)
+    assert diff_tables(expected, actual) == []
@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from run_benchmarks import compare, main, run_size
+
+# ==============================
+# 基准脚本的冒烟测试：最小规模跑通，结果 JSON 能保存并与基线对比
+# ==============================
+
+ROWS = 10_000
+SKUS = 500
+
+
+@pytest.fixture(scope="module")
+def run():
+    return run_size(ROWS, SKUS, rows_per_file=ROWS, xlsx_max_rows=ROWS, bundle_format="parquet")
+
+
+def test_run_size_reports_every_stage(run):
+    assert run["rows"] == ROWS and run["files"] == 1 and run["agg_rows"] > 0
+    assert run["stages"] and all(s["seconds"] >= 0 for s in run["stages"])
+    assert "summary_excel" in {s["stage"] for s in run["stages"]}
+    json.dumps(run)
+
+
+def test_main_saves_json_and_flags_regressions(tmp_path, run, capsys):
+    baseline = tmp_path / "base.json"
+    baseline.write_text(json.dumps({
+        "runs": [{**run, "stages": [{**s, "seconds": 1e-6} for s in run["stages"]]}],
+    }))
+    out = tmp_path / "new.json"
+
+    code = main(["--sizes", "10k", "--skus", str(SKUS), "--out", str(out), "--baseline", str(baseline),
+                 "--min-seconds", "0"])
+
+    result = json.loads(out.read_text(encoding="utf-8"))
+    assert [r["rows"] for r in result["runs"]] == [ROWS] and "error" not in result["runs"][0]
+    assert code == 1
+    assert "变慢" in capsys.readouterr().out
+    # 与自己对比不算变慢
+    assert compare(result, result, threshold=0.2, min_seconds=0.05) == []
@@ -0,0 +1,32 @@
+import numpy as np
+
+from pipeline import load_week_data_from_upload
+from sku_dictionary import SkuDictionary
+from synthetic_reports import generate_report, report_file
+
+# ==============================
+# 重复上传检测：互不重叠的报表不能丢行
+# ==============================
+
+
+def test_disjoint_files_without_srid_keep_every_row(split_report):
+    # 合成报表没有 Srid，同一 SKU、同一仓库、同一天的物流行完全相同，这些都是真实的行
+    df = generate_report(4000, skus=100, seed=1)
+    out = load_week_data_from_upload(split_report(df, "境内_20251103.xlsx", "境外_20251103.xlsx"), SkuDictionary())
+    assert len(out) == len(df)
+
+
+def test_rows_with_empty_srid_are_never_overlaps(split_report):
+    df = generate_report(4000, skus=100, seed=2)
+    srid = np.array([f"s{i}" for i in range(len(df))], dtype=object)
+    srid[::3] = None  # 仓储费、罚款等没有 Srid 的行
+    df.insert(0, "Srid", srid)
+    out = load_week_data_from_upload(split_report(df, "境内_20251103.xlsx", "境外_20251103.xlsx"), SkuDictionary())
+    assert len(out) == len(df)
+
+
+def test_overlapping_rows_with_srid_are_removed_once():
+    df = generate_report(4000, skus=100, seed=3)
+    df.insert(0, "Srid", [f"s{i}" for i in range(len(df))])
+    files = [report_file(df.iloc[:3000], "境内_202511.xlsx"), report_file(df.iloc[2000:], "境内_20251124.xlsx")]
+    assert len(load_week_data_from_upload(files, SkuDictionary())) == len(df)
@@ -0,0 +1,44 @@
+import io
+
+from jobs import Job, StageMemo, run_analysis_job
+from pipeline import load_week_aggregates
+from synthetic_reports import generate_report, report_file
+
+# ==============================
+# 区域来自文件名：同一内容换个文件名再上传，以本次的文件名为准
+# ==============================
+
+
+def _renamed(f, name: str) -> io.BytesIO:
+    """内容完全相同（同一个汇总库分区）、只是文件名不同的副本。"""
+    buf = io.BytesIO(f.getvalue())
+    buf.name = name
+    return buf
+
+
+def _regions(table) -> set:
+    return set(table["region"].dropna())
+
+
+def test_reused_partition_takes_region_from_current_file_name(rollup_store):
+    first = report_file(generate_report(2000, skus=50, seed=4), "20251103.xlsx")
+    agg, reused, processed = load_week_aggregates([first], rollup_store)
+    assert (reused, processed) == (0, 1)
+    assert _regions(agg.table) == {"未知"}
+
+    agg, reused, processed = load_week_aggregates([_renamed(first, "20251103境内.xlsx")], rollup_store)
+    assert (reused, processed) == (1, 0)
+    assert _regions(agg.table) == {"境内"}
+
+
+def test_job_memo_does_not_serve_region_of_earlier_file_name(rollup_store):
+    first = report_file(generate_report(2000, skus=50, seed=5), "20251103.xlsx")
+    memo = StageMemo()
+
+    def regions(f) -> set:
+        result = run_analysis_job(Job("t"), [f], [], None, "20251103-1109", None, rollup_store, memo)
+        return _regions(result["results"]["logistics_by_warehouse_region"])
+
+    assert "未知" in regions(first)
+    renamed = regions(_renamed(first, "20251103境外.xlsx"))
+    assert "境外" in renamed and "未知" not in renamed
@@ -0,0 +1,24 @@
+import pandas as pd
+import pytest
+
+from pipeline import aggregate_report, load_reports, load_week_data_from_upload
+from sku_dictionary import SkuDictionary
+from synthetic_reports import generate_report, report_file
+
+# ==============================
+# SKU 字典由调用方限定作用范围：紧凑明细用哪本字典编码，聚合时就传哪本
+# ==============================
+
+
+def test_compact_rows_aggregate_like_raw_rows():
+    f = report_file(generate_report(3000, skus=80, seed=4), "境内_20251103.xlsx")
+    dictionary = SkuDictionary()
+    compact = load_week_data_from_upload([f], dictionary)
+    raw = load_reports([f])[0].drop(columns="row_hash", errors="ignore")
+    pd.testing.assert_frame_equal(aggregate_report(compact, dictionary).table, aggregate_report(raw).table)
+
+
+def test_compact_rows_need_their_dictionary():
+    compact = load_week_data_from_upload([report_file(generate_report(500, skus=10, seed=5), "a.xlsx")], SkuDictionary())
+    with pytest.raises(ValueError):
+        aggregate_report(compact)
@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from jobs import StageMemo
+
+# ==============================
+# 阶段缓存：同时到达的相同请求只计算一次
+# ==============================
+
+CALLERS = 4
+
+
+def _run_concurrently(memo: StageMemo, compute):
+    with ThreadPoolExecutor(CALLERS) as pool:
+        futures = [pool.submit(memo.get_or_compute, "agg", "k", compute) for _ in range(CALLERS)]
+    return [f.exception() or f.result() for f in futures]
+
+
+def _slow(calls: list, release: threading.Event, fail: bool = False):
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        if fail:
+            raise RuntimeError("boom")
+        return "value"
+
+    return compute
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_concurrent_callers_share_one_computation(fail):
+    memo = StageMemo()
+    calls, release = [], threading.Event()
+    # 计算要等 0.2 秒才结束，其余调用都在这期间到达
+    threading.Timer(0.2, release.set).start()
+    results = _run_concurrently(memo, _slow(calls, release, fail))
+    assert len(calls) == 1
+    assert memo.stats["agg"] == {"calls": CALLERS, "misses": 1}
+    if fail:
+        assert all(isinstance(r, RuntimeError) for r in results)
+        # 失败的结果不记住，下次重新计算
+        assert memo.get_or_compute("agg", "k", lambda: "retry") == "retry"
+    else:
+        assert results == ["value"] * CALLERS
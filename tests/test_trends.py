@@ -0,0 +1,57 @@
+import pytest
+
+from jobs import Job, StageMemo, run_analysis_job
+from synthetic_reports import generate_report, report_file
+from trends import TrendStore, report_week, trend_week
+
+# ==============================
+# 周趋势只记录恰好一周的分析，按报表文件名中的期间归周
+# ==============================
+
+
+@pytest.mark.parametrize("name, monday", [
+    ("20251103-1109境内.xlsx", "2025-11-03"),
+    ("境外_20251103-20251109.xlsx", "2025-11-03"),
+    ("20251105.xlsx", "2025-11-03"),
+    ("20251229-0104.xlsx", "2025-12-29"),
+    ("20251001-1231.xlsx", None),  # 季度报表
+    ("20251105-1111.xlsx", None),  # 跨了两个自然周
+    ("report.xlsx", None),
+])
+def test_report_week(name, monday):
+    week = report_week(name)
+    assert (None if week is None else f"{week:%Y-%m-%d}") == monday
+
+
+def test_trend_week_needs_every_report_in_the_same_week():
+    assert trend_week(["20251103-1109境内.xlsx", "20251103-1109境外.xlsx"]) == "20251103-1109"
+    assert trend_week(["20251103-1109.xlsx", "20251110-1116.xlsx"]) is None
+    assert trend_week(["20251103-1109.xlsx", "report.xlsx"]) is None
+    assert trend_week([]) is None
+
+
+def test_multi_week_run_does_not_overwrite_a_week(tmp_path, rollup_store):
+    trends = TrendStore(tmp_path / "trends")
+    memo = StageMemo()
+    first = report_file(generate_report(2000, skus=50, seed=6), "20251103-1109境内.xlsx")
+    second = report_file(generate_report(2000, skus=50, seed=7), "20251110-1116境内.xlsx")
+
+    def run(files, stored_keys, label):
+        job = Job("t")
+        run_analysis_job(job, files, stored_keys, None, label, None, rollup_store, memo, trends=trends)
+        return job
+
+    # 周标签是季度，但只有一份周报：按报表的期间存为那一周
+    run([first], [], "20251001-1231")
+    assert trends.weeks() == ["20251103-1109"]
+    week_rows = trends.matrix().frame("sales_qty")["20251103-1109"].sum()
+
+    # 默认周标签 + 从汇总库中加入的另一周：两周合计不能覆盖 20251103-1109
+    stored = rollup_store.partitions()["key"].tolist()
+    job = run([second], stored, "20251103-1109")
+    assert trends.weeks() == ["20251103-1109"]
+    assert trends.matrix().frame("sales_qty")["20251103-1109"].sum() == week_rows
+    assert any("不计入周趋势" in text for _, text in job.notes)
+
+    run([second], [], "whatever")
+    assert trends.weeks() == ["20251103-1109", "20251110-1116"]
@@ -0,0 +1,311 @@
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cost_catalog import week_as_of
+from pipeline import SkuIndex, sku_rows
+from rollup_store import _file_lock
+
+# ==============================
+# 周趋势：每周的按 SKU 指标与费用汇总按 week_label 存档，向量化计算环比与异常
+# ==============================
+#
+# 每次分析（网页任务、批处理）结束后，把利润表、取消率表中每个 SKU 的
+# 件数 / 应付金额 / 利润 / 利润率 / 取消率，以及费用汇总的各项金额，按周存成一个 Parquet。
+# 哪一周不看用户填写的周标签，而看参与分析的各报表文件名中的期间（trend_week）：
+# 所有报表都在同一个自然周（周一～周日）内才记录，周标签统一写成 20251103-1109 的形式；
+# 加入了其它周的历史分区、季度报表、文件名中没有日期时都不记录，以免多周合计覆盖某一周的数据。
+# 同一周再次分析时覆盖。
+#
+# 趋势计算把各周的同一指标拼成 SKU × 周 的稠密矩阵（缺失为 NaN），
+# 用沿周方向的累加和一次得到每一周“此前 window 周”的均值、标准差（忽略缺失），
+# 环比变化 = 本周 − 此前均值，z = 变化 / 标准差。变化的绝对值和 z 都超过阈值的 SKU 记为异常。
+# 5 万 SKU × 52 周只是几个 260 万元素的数组运算。本模块不依赖 streamlit。
+
+DEFAULT_TRENDS_DIR = Path(
+    os.environ.get("WB_TRENDS_DIR", Path.home() / ".local" / "share" / "wb-finance-analyzer" / "trends")
+)
+
+TREND_METRICS = ["sales_qty", "revenue", "profit", "margin", "cancellation_rate"]
+METRIC_NAMES_ZH = {
+    "sales_qty": "销售件数",
+    "revenue": "商品应付金额",
+    "profit": "利润",
+    "margin": "利润率",
+    "cancellation_rate": "取消率",
+}
+# 异常检测默认看利润率和取消率；变化的绝对值至少要达到这些值（比例，0.05 = 5 个百分点）
+ANOMALY_MIN_DELTA = {"margin": 0.05, "cancellation_rate": 0.05}
+DEFAULT_WINDOW = 8
+DEFAULT_Z = 3.0
+MIN_HISTORY = 3
+# 历史几乎不变时标准差接近 0，z 会无穷大；标准差至少按这个值计算
+MIN_STD = 0.01
+
+
+# 文件名中的期间：8 位起始日期，后面可以跟结束日期（8 位，或与起始日期同年的 4 位月日）
+_PERIOD_RE = re.compile(r"(\d{8})(?:\s*[-~_]\s*(\d{8}|\d{4})(?!\d))?")
+
+
+def report_week(name: str):
+    """
+    一份报表文件名中的期间（20251103-1109、20251103-20251109 或 20251103）所在自然周的周一；
+    没有日期、或期间跨了不止一周时返回 None。
+    """
+    m = _PERIOD_RE.search(Path(name).stem)
+    if m is None:
+        return None
+    start_text, end_text = m.groups()
+    try:
+        start = pd.Timestamp(start_text)
+        if end_text is None:
+            end = start
+        elif len(end_text) == 4:
+            # 只有月日时与起始日期同年，跨年的周（20251229-0104）结束日期在下一年
+            end = pd.Timestamp(start_text[:4] + end_text)
+            if end < start:
+                end = pd.Timestamp(f"{start.year + 1}{end_text}")
+        else:
+            end = pd.Timestamp(end_text)
+    except ValueError:
+        return None
+    monday = start - pd.Timedelta(days=start.weekday())
+    if end < start or end - monday > pd.Timedelta(days=6):
+        return None
+    return monday
+
+
+def trend_week(names):
+    """参与本次分析的报表（文件名）都在同一周内时，返回该周的周标签（例如 20251103-1109），否则 None。"""
+    weeks = {report_week(name) for name in names}
+    if len(weeks) != 1 or None in weeks:
+        return None
+    monday = weeks.pop()
+    return f"{monday:%Y%m%d}-{monday + pd.Timedelta(days=6):%m%d}"
+
+
+def week_metrics(profit_by_sku: pd.DataFrame, cancellation_rate_by_sku: pd.DataFrame) -> pd.DataFrame:
+    """一周的按 SKU 指标：利润表（不含总计行）与取消率表按 SKU 对齐。"""
+    profit = sku_rows(profit_by_sku)
+    index = SkuIndex.from_keys(profit["SKU"], cancellation_rate_by_sku["barcode"])
+    profit_pos = index.positions(profit["SKU"])
+    cancel_pos = index.positions(cancellation_rate_by_sku["barcode"])
+
+    revenue = index.align(profit_pos, profit["商品应付金额"].to_numpy(dtype="float64"), fill=np.nan)
+    profit_values = index.align(profit_pos, profit["利润"].to_numpy(dtype="float64"), fill=np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        margin = np.where(revenue > 0, profit_values / revenue, np.nan)
+
+    return index.select(index.present(profit_pos) | index.present(cancel_pos), {
+        "sales_qty": index.align(profit_pos, profit["销售件数"].to_numpy(dtype="float64"), fill=np.nan),
+        "revenue": revenue,
+        "profit": profit_values,
+        "margin": margin,
+        "cancellation_rate": index.align(
+            cancel_pos, cancellation_rate_by_sku["cancellation_rate"].to_numpy(dtype="float64"), fill=np.nan,
+        ),
+    })
+
+
+class TrendStore:
+    def __init__(self, root=DEFAULT_TRENDS_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._manifest_path = self.root / "manifest.json"
+        self._lock_path = self.root / "manifest.lock"
+        self._lock = threading.Lock()
+
+    def _path(self, week_label: str) -> Path:
+        safe = re.sub(r"[^\w.-]+", "_", week_label)
+        return self.root / f"{safe}.parquet"
+
+    def _read_manifest(self) -> dict:
+        try:
+            return json.loads(self._manifest_path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_manifest(self, manifest: dict):
+        tmp_path = self._manifest_path.with_name(f"manifest.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp_path, self._manifest_path)
+
+    def record(self, week_label: str, profit_by_sku, cancellation_rate_by_sku, fee_summary) -> bool:
+        """
+        存档一周的结果（同一 week_label 覆盖），week_label 通常来自 trend_week；
+        week_label 不以日期开头时不记录，返回 False。
+        """
+        week_start = week_as_of(week_label)
+        if week_start is None:
+            return False
+        metrics = week_metrics(profit_by_sku, cancellation_rate_by_sku)
+        path = self._path(week_label)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        metrics.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+        with self._lock, _file_lock(self._lock_path):
+            manifest = self._read_manifest()
+            manifest[week_label] = {
+                "file": path.name,
+                "week_start": week_start,
+                "skus": len(metrics),
+                "fees": dict(zip(fee_summary["description"], fee_summary["total_fee"].astype(float))),
+                "stored_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            self._write_manifest(manifest)
+        return True
+
+    def delete(self, week_label: str):
+        self._path(week_label).unlink(missing_ok=True)
+        with self._lock, _file_lock(self._lock_path):
+            manifest = self._read_manifest()
+            manifest.pop(week_label, None)
+            self._write_manifest(manifest)
+
+    def weeks(self) -> list:
+        """已存档的周标签，按周的起始日期排列。"""
+        manifest = self._read_manifest()
+        return sorted(
+            (label for label, meta in manifest.items() if (self.root / meta["file"]).exists()),
+            key=lambda label: (manifest[label]["week_start"], label),
+        )
+
+    def version(self) -> str:
+        """存档内容的标识：任何一周写入或删除后都会变化，用作缓存键。"""
+        try:
+            stat = self._manifest_path.stat()
+        except FileNotFoundError:
+            return "empty"
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def fee_totals(self, weeks=None) -> pd.DataFrame:
+        """各周的费用汇总：行为周标签（按日期排列），列为费用项目。"""
+        manifest = self._read_manifest()
+        weeks = self.weeks() if weeks is None else list(weeks)
+        df = pd.DataFrame([manifest[w]["fees"] for w in weeks], index=pd.Index(weeks, name="week_label"))
+        return df.fillna(0.0)
+
+    def read_week(self, week_label: str) -> pd.DataFrame:
+        """一周存档的按 SKU 指标（week_metrics 的结果）；没有这一周时抛出 KeyError。"""
+        if week_label not in self._read_manifest():
+            raise KeyError(week_label)
+        return pd.read_parquet(self._path(week_label))
+
+    def matrix(self, weeks=None) -> "TrendMatrix":
+        """读取各周的按 SKU 指标，拼成 SKU × 周 的矩阵。"""
+        weeks = self.weeks() if weeks is None else list(weeks)
+        return TrendMatrix.from_frames(weeks, [self.read_week(w) for w in weeks])
+
+
+class TrendMatrix:
+    """SKU × 周 的指标矩阵：values[metric] 为 (SKU 数, 周数) 的 float64 数组，缺失为 NaN。"""
+
+    def __init__(self, skus: pd.Index, weeks: list, values: dict):
+        self.skus = skus
+        self.weeks = weeks
+        self.values = values
+
+    @classmethod
+    def from_frames(cls, weeks, frames):
+        index = SkuIndex.from_keys(*[f["SKU"] for f in frames]) if frames else SkuIndex.from_keys([])
+        values = {m: np.full((len(index), len(weeks)), np.nan) for m in TREND_METRICS}
+        for col, frame in enumerate(frames):
+            pos = index.positions(frame["SKU"])
+            for m in TREND_METRICS:
+                values[m][pos, col] = frame[m].to_numpy(dtype="float64")
+        return cls(index.keys, list(weeks), values)
+
+    def frame(self, metric: str) -> pd.DataFrame:
+        """某个指标的 SKU × 周 表（行索引为 SKU，列为周标签）。"""
+        return pd.DataFrame(self.values[metric], index=pd.Index(self.skus, name="SKU"), columns=self.weeks)
+
+
+def trailing_stats(values: np.ndarray, window: int = DEFAULT_WINDOW, min_history: int = MIN_HISTORY):
+    """
+    每个 (SKU, 周) 之前 window 周（不含本周）的均值、标准差和有效周数，忽略 NaN。
+    用沿周方向的累加和相减得到窗口和，不逐周循环。有效周数少于 min_history 时均值、标准差为 NaN。
+    """
+    valid = ~np.isnan(values)
+    x = np.where(valid, values, 0.0)
+    zeros = np.zeros((values.shape[0], 1))
+    count_cum = np.hstack([zeros, np.cumsum(valid, axis=1)])
+    sum_cum = np.hstack([zeros, np.cumsum(x, axis=1)])
+    sq_cum = np.hstack([zeros, np.cumsum(x * x, axis=1)])
+
+    hi = np.arange(values.shape[1])
+    lo = np.maximum(hi - window, 0)
+    count = count_cum[:, hi] - count_cum[:, lo]
+    total = sum_cum[:, hi] - sum_cum[:, lo]
+    sq = sq_cum[:, hi] - sq_cum[:, lo]
+
+    enough = count >= min_history
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(enough, total / count, np.nan)
+        var = np.where(enough, (sq - total * total / count) / (count - 1), np.nan)
+    std = np.sqrt(np.clip(var, 0.0, None))
+    return mean, std, count
+
+
+def detect_anomalies(trend: TrendMatrix,
+                     week: str = None,
+                     metrics=tuple(ANOMALY_MIN_DELTA),
+                     window: int = DEFAULT_WINDOW,
+                     z_threshold: float = DEFAULT_Z,
+                     min_delta: dict = None) -> pd.DataFrame:
+    """
+    week（默认最新一周）中与此前 window 周相比变化剧烈的 SKU：
+    |本周 − 此前均值| >= min_delta[指标] 且 |z| >= z_threshold。
+    返回列：SKU / metric / value / baseline / delta / z / history_weeks，按 |z| 从大到小排列。
+    """
+    columns = ["SKU", "metric", "value", "baseline", "delta", "z", "history_weeks"]
+    if not trend.weeks:
+        return pd.DataFrame(columns=columns)
+    col = trend.weeks.index(week) if week is not None else len(trend.weeks) - 1
+    min_delta = {**ANOMALY_MIN_DELTA, **(min_delta or {})}
+
+    parts = []
+    for m in metrics:
+        # 只需要本周和此前 window 周这几列
+        values = trend.values[m][:, max(col - window, 0):col + 1]
+        mean, std, count = trailing_stats(values, window=window)
+        current, baseline = values[:, -1], mean[:, -1]
+        delta = current - baseline
+        z = delta / np.maximum(std[:, -1], MIN_STD)
+        with np.errstate(invalid="ignore"):
+            flagged = (np.abs(delta) >= min_delta.get(m, 0.0)) & (np.abs(z) >= z_threshold)
+        parts.append(pd.DataFrame({
+            "SKU": trend.skus[flagged],
+            "metric": m,
+            "value": current[flagged],
+            "baseline": baseline[flagged],
+            "delta": delta[flagged],
+            "z": z[flagged],
+            "history_weeks": count[flagged, -1].astype("int64"),
+        }))
+    out = pd.concat(parts, ignore_index=True)
+    order = np.argsort(-np.abs(out["z"].to_numpy()), kind="stable")
+    return out.iloc[order].reset_index(drop=True)[columns]
+
+
+def week_over_week(trend: TrendMatrix, metric: str, window: int = DEFAULT_WINDOW) -> pd.DataFrame:
+    """某个指标每个 SKU 最新一周的值、上一周的值、环比变化和此前 window 周均值。"""
+    values = trend.values[metric]
+    if values.shape[1] == 0:
+        return pd.DataFrame(columns=["SKU", "value", "previous", "wow_delta", "baseline"])
+    mean, _, _ = trailing_stats(values[:, -window - 1:], window=window, min_history=1)
+    current = values[:, -1]
+    previous = values[:, -2] if values.shape[1] > 1 else np.full(len(current), np.nan)
+    return pd.DataFrame({
+        "SKU": trend.skus,
+        "value": current,
+        "previous": previous,
+        "wow_delta": current - previous,
+        "baseline": mean[:, -1],
+    })
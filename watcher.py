@@ -0,0 +1,314 @@
+import argparse
+import os
+import sys
+import threading
+import time
+import traceback
+import zipfile
+from pathlib import Path
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # 没装 watchdog 时按固定间隔扫描目录
+    Observer = None
+
+from backends import BACKENDS
+from cost_catalog import CostCatalog
+from ingest import DEFAULT_WORKERS
+from jobs import Job, new_stage_memo, run_analysis_job
+from pipeline import BUNDLE_FORMATS, PARSED_REPORT_FORMAT
+from report_cache import ReportCache, content_hash
+from rollup_store import RollupStore
+
+# ==============================
+# 监视目录：报表放进共享目录后自动增量汇总，输出最新的 summary.xlsx（不依赖 streamlit）
+# ==============================
+#
+# 每周一的报表放进共享目录后，不再需要有人手动在网页上上传：
+#   - 新增或改动过的 .xlsx 写完后才处理（去抖）：文件大小和修改时间连续 --debounce 秒不变、
+#     且能作为完整的 zip 打开（.xlsx 写到一半时缺少目录区），Excel 的锁文件 ~$xxx.xlsx 忽略；
+#   - 只有汇总库中还没有的报表（按内容哈希）才解析，仍然经过 COLUMN_MAP 的列名映射，
+#     解析用有上限的进程池（--workers 个进程，每批最多 --workers 份）；
+#   - 之前各周的聚合表从阶段缓存 / 汇总库读取，不重新解析；重复 / 重叠的行照常去掉（dedup.py），
+#     新到的文件排在最后，与已有报表重叠的行从新文件中去掉，已有报表的结果不变；
+#   - 合并后跑步骤1～8，原子地写出 <out>/<label>_summary.xlsx（先写临时文件再替换，读的人不会看到写了一半的文件）。
+# 目录中名为 --cost-name 的文件（默认 cost.xlsx）作为采购成本表，改动后同样触发重新汇总。
+# 装了 watchdog 时文件一有变化就检查，否则每 --interval 秒扫描一次目录。
+# 从文件写完到汇总更新的时间主要是解析这一份新报表的时间（另加 --debounce 秒的等待）。
+#
+#   python watcher.py /share/wb_reports --out /share/wb_summary --label 20251103-1109 --workers 4
+
+DEBOUNCE_SECONDS = float(os.environ.get("WB_WATCH_DEBOUNCE", "2"))
+POLL_INTERVAL = float(os.environ.get("WB_WATCH_INTERVAL", "5"))
+
+
+class WatchedReport:
+    """目录中一份已写完的文件：路径、签名（大小, 修改时间）和内容哈希。字节在需要解析时才从磁盘读取。"""
+
+    def __init__(self, path: Path, signature: tuple, digest: str):
+        self.path = path
+        self.name = path.name
+        self.signature = signature
+        self.content_hash = digest  # pipeline.partition_key 直接使用，内容未变的文件不再读取
+
+    def getvalue(self) -> bytes:
+        stat = self.path.stat()
+        if (stat.st_size, stat.st_mtime_ns) != self.signature:
+            raise RuntimeError(f"{self.name} 在汇总期间被改动，等它写完后重新汇总")
+        return self.path.read_bytes()
+
+
+class FolderWatcher:
+    """
+    记录目录中各 .xlsx 的签名，poll() 一次扫描：签名连续 debounce 秒不变且文件完整时才算“就绪”。
+    reports 按就绪的先后排列（新到的、改动过的文件在最后），cost 为目录中的采购成本文件。
+    """
+
+    def __init__(self, root, debounce: float = DEBOUNCE_SECONDS, cost_name: str = "cost.xlsx"):
+        self.root = Path(root)
+        self.debounce = debounce
+        self.cost_name = cost_name
+        self.reports = {}
+        self.cost = None
+        self._pending = {}  # 路径 -> (签名, 第一次看到这个签名的时间)
+        self._incomplete = set()
+
+    def _scan(self) -> dict:
+        found = {}
+        for p in sorted(self.root.glob("*.xlsx")):
+            if p.name.startswith(("~$", ".")):  # Excel 的锁文件、同步工具的临时文件
+                continue
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                continue
+            found[p] = (stat.st_size, stat.st_mtime_ns)
+        return found
+
+    @property
+    def pending(self) -> bool:
+        """是否有还没写完（或还在去抖等待中）的文件。"""
+        return bool(self._pending)
+
+    def poll(self, now: float = None) -> bool:
+        """扫描一次目录，返回就绪的文件集合是否有变化（新增、改动、删除）。"""
+        now = time.monotonic() if now is None else now
+        found = self._scan()
+        changed = False
+
+        for p in [p for p in self.reports if p not in found]:
+            del self.reports[p]
+            changed = True
+        if self.cost is not None and self.cost.path not in found:
+            self.cost = None
+            changed = True
+        for p in [p for p in self._pending if p not in found]:
+            del self._pending[p]
+
+        for p, signature in found.items():
+            current = self.cost if p.name == self.cost_name else self.reports.get(p)
+            if current is not None and current.signature == signature:
+                continue
+            seen = self._pending.get(p)
+            if seen is None or seen[0] != signature:
+                self._pending[p] = (signature, now)
+                continue
+            if now - seen[1] < self.debounce:
+                continue
+            if not zipfile.is_zipfile(p):
+                if (p, signature) not in self._incomplete:
+                    self._incomplete.add((p, signature))
+                    print(f"{p.name} 不是完整的 .xlsx，等它写完再处理", file=sys.stderr, flush=True)
+                continue
+            try:
+                report = WatchedReport(p, signature, content_hash(p.read_bytes()))
+            except FileNotFoundError:
+                continue
+            del self._pending[p]
+            if p.name == self.cost_name:
+                self.cost = report
+            else:
+                self.reports.pop(p, None)
+                self.reports[p] = report
+            changed = True
+        return changed
+
+
+def _write_atomic(path: Path, data: bytes):
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+class WatchDaemon:
+    """监视一个目录：就绪的文件集合一变化就增量汇总一次。阶段缓存在整个进程中保留，之前各周的聚合表不重复读取。"""
+
+    def __init__(self,
+                 root,
+                 out_dir,
+                 label: str = None,
+                 cost_path=None,
+                 cost_name: str = "cost.xlsx",
+                 bundle_format=None,
+                 cost_catalog=None,
+                 cost_effective=None,
+                 backend: str = None,
+                 out_of_core: bool = False,
+                 workers: int = DEFAULT_WORKERS,
+                 debounce: float = DEBOUNCE_SECONDS,
+                 store: RollupStore = None,
+                 cache: ReportCache = None):
+        self.watcher = FolderWatcher(root, debounce=debounce, cost_name=cost_name)
+        self.out_dir = Path(out_dir)
+        self.label = label
+        self.cost_path = None if cost_path is None else Path(cost_path)
+        self.bundle_format = bundle_format
+        self.catalog = None if cost_catalog is None else CostCatalog(cost_catalog)
+        self.cost_effective = cost_effective
+        self.backend = backend
+        self.out_of_core = out_of_core
+        self.workers = workers
+        self.store = store or RollupStore()
+        self.cache = cache or ReportCache(namespace=PARSED_REPORT_FORMAT)
+        self.memo = new_stage_memo()
+        self.runs = 0
+
+    def rebuild(self) -> dict:
+        """用当前就绪的全部报表汇总一次，写出 summary.xlsx，返回本次的文件数、耗时等信息。"""
+        reports = list(self.watcher.reports.values())
+        if not reports:
+            return {"files": 0}
+        label = self.label or time.strftime("%Y%m%d")
+        self.runs += 1
+        job = Job(f"watch-{self.runs}", label)
+        # 成本表很小，直接按路径读取（pd.read_excel 需要路径或文件对象）
+        cost = self.watcher.cost.path if self.watcher.cost is not None else self.cost_path
+        start = time.perf_counter()
+        result = run_analysis_job(
+            job, reports, [], cost, label, self.bundle_format,
+            store=self.store, memo=self.memo, cache=self.cache, workers=self.workers,
+            cost_catalog=self.catalog, cost_effective=self.cost_effective,
+            out_of_core=self.out_of_core, backend=self.backend,
+        )
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        out_path = self.out_dir / f"{label}_summary.xlsx"
+        _write_atomic(out_path, result["results"]["summary_excel"])
+        if result["results"]["data_bundle"] is not None:
+            _write_atomic(out_path.with_name(f"{label}_{self.bundle_format}.zip"), result["results"]["data_bundle"])
+        steps = job.steps_frame()
+        return {
+            "files": len(reports),
+            "parsed": int(steps.loc[steps["stage"] == "aggregate_report", "runs"].sum()) if not steps.empty else 0,
+            "output": str(out_path),
+            "seconds": time.perf_counter() - start,
+            "notes": job.notes,
+            "steps": steps,
+        }
+
+    def run(self, interval: float = POLL_INTERVAL, once: bool = False):
+        """
+        一直运行（Ctrl+C 退出）。once=True 时等目录中已有的文件都写完、汇总一次后返回。
+        有未就绪的文件时按去抖间隔复查；否则等 watchdog 的文件事件，最多 interval 秒扫描一次。
+        """
+        wake = threading.Event()
+        observer = _start_observer(self.watcher.root, wake)
+        try:
+            while True:
+                wake.clear()
+                if self.watcher.poll():
+                    _print_run(self._rebuild_safe())
+                if once and not self.watcher.pending:
+                    return
+                wake.wait(max(0.1, self.watcher.debounce / 4) if self.watcher.pending else interval)
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+    def _rebuild_safe(self) -> dict:
+        try:
+            return self.rebuild()
+        except Exception as e:
+            return {"error": f"{e}\n{traceback.format_exc()}"}
+
+
+def _start_observer(root: Path, wake: threading.Event):
+    """装了 watchdog 时，目录中有任何变化就唤醒主循环；否则返回 None，主循环按间隔扫描。"""
+    if Observer is None:
+        return None
+
+    class WakeHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            wake.set()
+
+    observer = Observer()
+    observer.schedule(WakeHandler(), str(root), recursive=False)
+    observer.start()
+    return observer
+
+
+def _print_run(run: dict):
+    stamp = time.strftime("%H:%M:%S")
+    if "error" in run:
+        print(f"[{stamp}] 汇总失败：{run['error']}", file=sys.stderr, flush=True)
+        return
+    if not run["files"]:
+        print(f"[{stamp}] 目录中没有报表", flush=True)
+        return
+    print(
+        f"[{stamp}] {run['files']} 份报表（新解析 {run['parsed']} 份），耗时 {run['seconds']:.2f}s -> {run['output']}",
+        flush=True,
+    )
+    for level, text in run["notes"]:
+        if level in ("warning", "error"):
+            print(f"    {text}", flush=True)
+    for row in run["steps"].sort_values("seconds", ascending=False).head(5).itertuples():
+        print(f"    {row.stage:<34} {row.seconds:8.3f}s", flush=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="监视报表目录，新报表写完后自动增量汇总并输出 summary.xlsx")
+    parser.add_argument("folder", type=Path, help="要监视的目录（其中的 .xlsx 为 WB 报表）")
+    parser.add_argument("--out", type=Path, required=True, help="输出目录（不能是监视目录本身）")
+    parser.add_argument("--label", default=None, help="本次分析的名称/标签（用于文件名，默认每次汇总时的日期）")
+    parser.add_argument("--cost", type=Path, default=None, help="采购成本文件（监视目录中没有 --cost-name 时使用）")
+    parser.add_argument("--cost-name", default="cost.xlsx", help="监视目录中采购成本文件的文件名")
+    parser.add_argument("--cost-catalog", type=Path, default=None,
+                        help="本地采购成本库（SQLite 文件）：成本文件导入其中，按周标签的日期查询成本")
+    parser.add_argument("--cost-effective", default=None,
+                        help="导入成本文件时的生效日期（YYYY-MM-DD，默认一直有效）")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="解析新报表的进程数上限")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE_SECONDS,
+                        help="文件大小和修改时间连续多少秒不变才认为已写完")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="扫描目录的间隔（秒）")
+    parser.add_argument("--backend", choices=list(BACKENDS), default=None,
+                        help="计算后端（默认取环境变量 WB_COMPUTE_BACKEND，未设置时为 pandas）")
+    parser.add_argument("--bundle", choices=BUNDLE_FORMATS, default=None,
+                        help="同时输出数据包 zip（每张结果表一个 Parquet/CSV 文件）")
+    parser.add_argument("--out-of-core", action="store_true",
+                        help="大数据量模式：逐份累加部分和，内存占用与报表份数无关")
+    parser.add_argument("--once", action="store_true", help="等目录中已有的文件写完、汇总一次后退出")
+    args = parser.parse_args(argv)
+
+    if not args.folder.is_dir():
+        parser.error(f"{args.folder} 不是目录")
+    if args.out.resolve() == args.folder.resolve():
+        parser.error("输出目录不能是监视目录本身（输出的 summary.xlsx 会被当作新报表）")
+
+    daemon = WatchDaemon(
+        args.folder, args.out, label=args.label, cost_path=args.cost, cost_name=args.cost_name,
+        bundle_format=args.bundle, cost_catalog=args.cost_catalog, cost_effective=args.cost_effective,
+        backend=args.backend, out_of_core=args.out_of_core, workers=args.workers, debounce=args.debounce,
+    )
+    mode = "watchdog 文件事件" if Observer is not None else f"每 {args.interval:g} 秒扫描"
+    print(f"监视 {args.folder}（{mode}，去抖 {args.debounce:g} 秒，解析进程 {args.workers} 个）", flush=True)
+    try:
+        daemon.run(interval=args.interval, once=args.once)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())